@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# coding: utf-8
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+from config import Config
+from backend.utility import EvaEx, Const, make_response, g_logger
+
+
+class Overloaded(EvaEx):
+    def __init__(self, retry_after):
+        EvaEx.__init__(self, Const.OVERLOADED)
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return '{}, retry after {}s'.format(self.msg, self.retry_after)
+
+
+def media_seconds(asr_result):
+    '''
+    :param asr_result: [{'begin_time', 'end_time'},] in ms as sent by the caller
+    :return: end of the last sentence in seconds
+    '''
+    if not asr_result:
+        return 0.0
+    return max(int(x['end_time']) for x in asr_result) / 1000.0
+
+
+def check_size(input_dict):
+    '''
+    raise EvaEx(FILE_TOO_BIG) for a request longer than MAX_MEDIA_SECONDS or with more than MAX_ASR_SENTENCES,
+    a limit of 0 is none
+    '''
+    asr_result = input_dict.get('asr_result') or []
+    if 0 < Config.MAX_ASR_SENTENCES < len(asr_result) or 0 < Config.MAX_MEDIA_SECONDS < media_seconds(asr_result):
+        raise EvaEx(Const.FILE_TOO_BIG)
+
+
+def estimate_cost(input_dict):
+    '''
+    :return: media seconds plus ADMISSION_SENTENCE_COST per asr sentence, download and decoding grow with the
+    first, clips to extract and score with the second
+    '''
+    asr_result = input_dict.get('asr_result') or []
+    return media_seconds(asr_result) + Config.ADMISSION_SENTENCE_COST * len(asr_result)
+
+
+class AdmissionController(object):
+    """
+    a counting semaphore like utility.ReadLock, weighted by the estimated cost of each request.
+    a request is admitted while the cost in flight stays under `capacity`, or when nothing runs, so one
+    request bigger than the capacity is not blocked forever. others wait up to `max_wait` seconds, then
+    get Overloaded with a retry-after estimated from the cost finished per second.
+    """
+
+    def __init__(self, capacity=Config.ADMISSION_CAPACITY, max_wait=Config.ADMISSION_MAX_WAIT,
+                 max_waiting=Config.ADMISSION_MAX_WAITING):
+        self.capacity = capacity
+        self.max_wait = max_wait
+        self.max_waiting = max_waiting
+        self.cost = 0.0
+        self.inflight = 0
+        self.waiting = 0
+        self.rate = None
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.stats = {'admitted': 0, 'rejected': 0, 'waited': 0}
+
+    def _fits(self, cost):
+        return self.inflight == 0 or self.cost + cost <= self.capacity
+
+    def _retry_after(self, cost):
+        if not self.rate:
+            return Config.ADMISSION_RETRY_AFTER
+        excess = self.cost + cost - self.capacity
+        return int(min(max(math.ceil(excess / self.rate), 1), 300))
+
+    def acquire(self, cost, wait=None):
+        '''
+        :param wait: seconds to wait for capacity, max_wait when None
+        :raise Overloaded: no capacity within the wait
+        '''
+        wait = self.max_wait if wait is None else wait
+        with self.not_full:
+            if not self._fits(cost):
+                if wait <= 0 or self.waiting >= self.max_waiting:
+                    self.stats['rejected'] += 1
+                    raise Overloaded(self._retry_after(cost))
+                self.waiting += 1
+                self.stats['waited'] += 1
+                deadline = time.time() + wait
+                try:
+                    while not self._fits(cost):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.stats['rejected'] += 1
+                            raise Overloaded(self._retry_after(cost))
+                        self.not_full.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.cost += cost
+            self.inflight += 1
+            self.stats['admitted'] += 1
+
+    def release(self, cost, seconds=None):
+        '''
+        :param seconds: how long the request ran, updates the throughput behind retry-after
+        '''
+        with self.not_full:
+            self.cost = max(self.cost - cost, 0.0)
+            self.inflight -= 1
+            if seconds and seconds > 0:
+                # cost finished per second with all in-flight requests sharing the workers
+                rate = cost / seconds * max(self.inflight + 1, 1)
+                self.rate = rate if self.rate is None else 0.8 * self.rate + 0.2 * rate
+            self.not_full.notify_all()
+
+    @contextmanager
+    def admit(self, input_dict, wait=None):
+        '''
+        with g_admission.admit(body): Pipeline(body).run()
+        '''
+        cost = min(estimate_cost(input_dict), self.capacity)
+        self.acquire(cost, wait)
+        start = time.time()
+        try:
+            yield cost
+        finally:
+            self.release(cost, time.time() - start)
+
+    def info(self):
+        '''
+        :return: {'load', 'cost', 'capacity', 'inflight', 'waiting', 'retry_after', 'admitted', 'rejected', 'waited'},
+        load is cost / capacity, an upstream router should prefer instances below 1
+        '''
+        with self.lock:
+            return dict(self.stats, load=round(self.cost / self.capacity, 4), cost=round(self.cost, 1),
+                        capacity=self.capacity, inflight=self.inflight, waiting=self.waiting,
+                        retry_after=self._retry_after(0) if self.cost >= self.capacity else 0)
+
+
+g_admission = AdmissionController()
+
+
+def reject_response(e, req_id):
+    '''
+    503 with a Retry-After header for an Overloaded raised by admit()
+    '''
+    g_logger.warning('{} - 服务繁忙, {}'.format(req_id, e))
+    return make_response(Const.OVERLOADED, req_id, headers={'Retry-After': str(e.retry_after)})
+
+
+def load_blueprint(controller=g_admission):
+    '''
+    GET <APP_URL>/load returns controller.info(), for the load balancer to route by
+    '''
+    from flask import Blueprint, Response
+    bp = Blueprint('admission', __name__)
+
+    @bp.route(Config.APP_URL + '/load', methods=['GET'])
+    def load():
+        return Response(json.dumps(controller.info()), content_type='application/json')
+
+    return bp
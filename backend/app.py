@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# coding: utf-8
+from config import Config
+
+
+def create_app(app=None):
+    '''
+    register the blueprints of the service: GET <APP_URL>/metrics, GET <APP_URL>/load and the live sessions
+    under <APP_URL>/live
+    :param app: the Flask app serving the job api, a new one when None
+    :return: app
+    '''
+    from flask import Flask
+    from backend.metrics import metrics_blueprint
+    from backend.admission import load_blueprint
+    from backend.live_session import live_blueprint
+    if app is None:
+        app = Flask(__name__)
+    app.register_blueprint(metrics_blueprint())
+    app.register_blueprint(load_blueprint())
+    app.register_blueprint(live_blueprint())
+    return app
+
+
+if __name__ == '__main__':
+    # python -m backend.app, registered in eureka under EUREKA_APP_NAME
+    from backend.c_eureka import eureka_register
+    eureka_register()
+    create_app().run(host='0.0.0.0', port=Config.PORT, threaded=True)
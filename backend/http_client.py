@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# coding: utf-8
+import time
+import threading
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from config import Config
+
+
+class HostStats(object):
+    def __init__(self, window=1000):
+        self.requests = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.latency = deque(maxlen=window)
+
+
+class HttpClient(object):
+    """
+    one keep-alive requests.Session per scheme://host, so repeated calls to the same service reuse
+    their TCP/TLS connections instead of opening one per call. video urls come from many hosts, only the
+    `max_hosts` used last keep their session, the least recently used one is closed
+    """
+
+    def __init__(self, pool_size=Config.HTTP_POOL_SIZE,
+                 timeout=(Config.HTTP_CONNECT_TIMEOUT, Config.HTTP_READ_TIMEOUT), max_hosts=Config.HTTP_MAX_HOSTS):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_hosts = max_hosts
+        self.sessions = OrderedDict()
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        host = '{0.scheme}://{0.netloc}'.format(urlsplit(url))
+        evicted = None
+        with self.lock:
+            if host in self.sessions:
+                self.sessions.move_to_end(host)
+            else:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                self.sessions[host] = s
+                self.stats[host] = HostStats()
+                if len(self.sessions) > self.max_hosts:
+                    old, evicted = self.sessions.popitem(last=False)
+                    self.stats.pop(old, None)
+            s = self.sessions[host]
+        if evicted is not None:
+            # requests still running on it finish, their connections are not kept
+            evicted.close()
+        return host, s
+
+    def request(self, method, url, **kwargs):
+        """
+        requests.request through the pooled session of the url's host, timeout defaults to the client's
+        """
+        host, s = self.session(url)
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.time()
+        try:
+            return s.request(method, url, **kwargs)
+        except Exception:
+            with self.lock:
+                if host in self.stats:
+                    self.stats[host].errors += 1
+            raise
+        finally:
+            cost = time.time() - start
+            with self.lock:
+                stats = self.stats.get(host)
+                if stats is not None:
+                    stats.requests += 1
+                    stats.seconds += cost
+                    stats.latency.append(cost)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def info(self):
+        """
+        :return: {host: {'requests', 'errors', 'connections', 'reuse', 'avg_ms', 'p95_ms'}}, connections is how many
+        were opened, reuse the share of requests that found an idle one
+        """
+        result = {}
+        with self.lock:
+            for host, s in self.sessions.items():
+                pools = s.get_adapter(host).poolmanager.pools
+                # RecentlyUsedContainer refuses iteration, keys() takes its lock
+                connections = sum(pools[k].num_connections for k in pools.keys())
+                stats = self.stats[host]
+                latency = sorted(stats.latency)
+                result[host] = {
+                    'requests': stats.requests,
+                    'errors': stats.errors,
+                    'connections': connections,
+                    'reuse': round(1 - connections / stats.requests, 4) if stats.requests else 0.0,
+                    'avg_ms': round(stats.seconds / stats.requests * 1000, 2) if stats.requests else 0.0,
+                    'p95_ms': round(latency[int(0.95 * (len(latency) - 1))] * 1000, 2) if latency else 0.0,
+                }
+        return result
+
+
+g_http = HttpClient()
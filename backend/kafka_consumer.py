@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# coding: utf-8
+import json
+import time
+import heapq
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from backend.admission import Overloaded
+from backend.utility import g_logger
+
+
+class _Partition(object):
+    """
+    offsets in arrival order, the records not yet handed to a worker, the jobs deferred while overloaded as
+    (when, offset, value), the offsets whose job is finished and how many still run
+    """
+
+    def __init__(self):
+        self.pending = deque()
+        self.backlog = deque()
+        self.delayed = []
+        self.done = set()
+        self.running = 0
+        self.commit = None
+
+    def advance(self):
+        # the committed offset only moves past a contiguous run of finished jobs
+        moved = False
+        while self.pending and self.pending[0] in self.done:
+            offset = self.pending.popleft()
+            self.done.discard(offset)
+            self.commit = offset + 1
+            moved = True
+        return moved
+
+
+def offset_and_metadata(offset):
+    from kafka.structs import OffsetAndMetadata
+    # kafka-python 2.1 added leader_epoch, -1 is unknown
+    if len(OffsetAndMetadata._fields) > 2:
+        return OffsetAndMetadata(offset, None, -1)
+    return OffsetAndMetadata(offset, None)
+
+
+class KafkaIngest(object):
+    """
+    run the jobs of a kafka topic with `concurrency` pipelines shared by all assigned partitions.
+    an offset is committed once its job and every earlier job of the partition finished, i.e. the callback was
+    delivered or the job went to the dead letters after `max_retry` attempts, so a restart replays everything
+    not yet answered. at most `partition_inflight` jobs of a partition run, records polled past that wait in
+    its backlog and the partition is paused until it has room again. a job that raised Overloaded is run again
+    after its retry_after, without counting an attempt, and its partition stays paused and starts nothing else
+    until then.
+    the consumer is only touched from the thread running serve(), as kafka clients are not thread safe.
+    """
+
+    def __init__(self, consumer, handler, concurrency=Config.POOL_PROCESS,
+                 partition_inflight=Config.KAFKA_PARTITION_INFLIGHT, max_retry=Config.KAFKA_MAX_RETRY,
+                 dead_letter=None):
+        """
+        :param consumer: KafkaConsumer with enable_auto_commit=False, or anything with its poll/commit/pause/resume
+        :param handler: called with the decoded job, returns True once the result reached the callback. it
+        retries the callback itself, an exception is a failed attempt and runs the job again, Overloaded defers
+        the job
+        :param dead_letter: called with (raw value, reason) for a job that failed max_retry times, raises when
+        it could not keep it. the offset of a job it kept is committed. None only logs the job
+        """
+        self.consumer = consumer
+        self.handler = handler
+        self.partition_inflight = partition_inflight
+        self.max_retry = max_retry
+        self.dead_letter = dead_letter
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.partitions = {}
+        self.paused = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.stats = {'received': 0, 'done': 0, 'failed': 0, 'dead': 0, 'deferred': 0, 'committed': 0}
+
+    def _attempt(self, tp, offset, value):
+        """
+        :return: None once the job is finished, or why it failed
+        """
+        reason = None
+        for attempt in range(self.max_retry):
+            try:
+                if self.handler(json.loads(value)):
+                    return None
+                # the handler already retried the callback, running the job again would not help
+                return 'callback not delivered'
+            except Overloaded:
+                raise
+            except Exception as e:
+                g_logger.error('{}:{} job error: {}'.format(tp, offset, e))
+                reason = str(e)
+            if attempt + 1 < self.max_retry:
+                time.sleep(min(2 ** attempt, 30))
+        return reason
+
+    def _defer(self, tp, offset, value, e):
+        g_logger.warning('{}:{} 服务繁忙, {}s后重试'.format(tp, offset, e.retry_after))
+        with self.lock:
+            state = self.partitions.get(tp)
+            # a revoked partition's job is replayed by its new owner
+            if state is not None:
+                state.running -= 1
+                heapq.heappush(state.delayed, (time.time() + (e.retry_after or 1), offset, value))
+            self.stats['deferred'] += 1
+
+    def _run(self, tp, offset, value):
+        try:
+            reason = self._attempt(tp, offset, value)
+        except Overloaded as e:
+            self._defer(tp, offset, value, e)
+            return
+        finished = reason is None
+        if not finished:
+            try:
+                if self.dead_letter is not None:
+                    self.dead_letter(value, reason)
+                else:
+                    g_logger.error('{}:{} dropped job: {}'.format(tp, offset, value))
+                g_logger.error('{}:{} {}次未成功, 放入死信队列: {}'.format(tp, offset, self.max_retry, reason))
+                finished = True
+            except Exception as e:
+                # the commit stays below this offset, so a restart or a rebalance replays from here
+                g_logger.error('{}:{} 死信队列写入失败, offset不提交: {}'.format(tp, offset, e))
+        with self.lock:
+            state = self.partitions.get(tp)
+            if state is not None:
+                state.running -= 1
+                if finished:
+                    state.done.add(offset)
+            self.stats['done' if reason is None else 'failed'] += 1
+            if reason is not None and finished:
+                self.stats['dead'] += 1
+
+    def _dispatch(self, records):
+        with self.lock:
+            for tp, batch in records.items():
+                state = self.partitions.setdefault(tp, _Partition())
+                for record in batch:
+                    state.pending.append(record.offset)
+                    state.backlog.append(record)
+                self.stats['received'] += len(batch)
+        self._fill()
+
+    def _fill(self):
+        # hand deferred jobs whose time has come, then backlog records, to workers while their partition has fewer
+        # than partition_inflight running. the backlog waits while the partition has deferred jobs
+        ready = []
+        now = time.time()
+        with self.lock:
+            for tp, state in self.partitions.items():
+                while state.delayed and state.delayed[0][0] <= now and state.running < self.partition_inflight:
+                    state.running += 1
+                    ready.append((tp,) + heapq.heappop(state.delayed)[1:])
+                while state.backlog and not state.delayed and state.running < self.partition_inflight:
+                    state.running += 1
+                    record = state.backlog.popleft()
+                    ready.append((tp, record.offset, record.value))
+        for tp, offset, value in ready:
+            self.executor.submit(self._run, tp, offset, value)
+
+    def _commit(self):
+        offsets = {}
+        with self.lock:
+            for tp, state in self.partitions.items():
+                if state.advance():
+                    offsets[tp] = state.commit
+        if offsets:
+            self.consumer.commit(dict((tp, offset_and_metadata(x)) for tp, x in offsets.items()))
+            with self.lock:
+                self.stats['committed'] += len(offsets)
+
+    def _flow(self):
+        # paused before the next poll, so a full partition gets no records beyond its backlog
+        with self.lock:
+            busy = set(tp for tp, x in self.partitions.items()
+                       if x.backlog or x.delayed or x.running >= self.partition_inflight)
+        if busy - self.paused:
+            self.consumer.pause(*(busy - self.paused))
+        if self.paused - busy:
+            self.consumer.resume(*(self.paused - busy))
+        self.paused = busy
+
+    def revoke(self, partitions):
+        """
+        rebalance listener hook: commit what is finished and forget the partitions, their running jobs still
+        finish but are committed by the new owner's replay, their backlog is left to it
+        """
+        self._commit()
+        with self.lock:
+            for tp in partitions:
+                self.partitions.pop(tp, None)
+        self.paused -= set(partitions)
+
+    def step(self, poll_ms=500):
+        self._fill()
+        self._commit()
+        self._flow()
+        records = self.consumer.poll(timeout_ms=poll_ms, max_records=self.partition_inflight)
+        self._dispatch(records)
+
+    def serve(self, poll_ms=500):
+        while not self.stopped.is_set():
+            self.step(poll_ms)
+        self.executor.shutdown(wait=True)
+        self._commit()
+
+    def stop(self):
+        self.stopped.set()
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, inflight=sum(x.running for x in self.partitions.values()),
+                        backlog=sum(len(x.backlog) for x in self.partitions.values()),
+                        delayed=sum(len(x.delayed) for x in self.partitions.values()),
+                        uncommitted=sum(len(x.pending) for x in self.partitions.values()),
+                        paused=len(self.paused))
+
+
+def bootstrap_servers():
+    from backend.c_apollo import g_apollo
+    if Config.KAFKA_SERVERS:
+        return Config.KAFKA_SERVERS
+    return g_apollo.get_value(Config.APOLLO_KAFKA, namespace=Config.APOLLO_NAMESPACE)
+
+
+def make_consumer(ingest_holder):
+    from kafka import KafkaConsumer, ConsumerRebalanceListener
+
+    class Listener(ConsumerRebalanceListener):
+        def on_partitions_revoked(self, revoked):
+            if ingest_holder:
+                ingest_holder[0].revoke(revoked)
+
+        def on_partitions_assigned(self, assigned):
+            pass
+
+    consumer = KafkaConsumer(bootstrap_servers=bootstrap_servers().split(','), group_id=Config.KAFKA_GROUP,
+                             enable_auto_commit=False, auto_offset_reset='earliest')
+    consumer.subscribe([Config.KAFKA_TOPIC], listener=Listener())
+    return consumer
+
+
+def make_dead_letter():
+    from kafka import KafkaProducer
+    producer = KafkaProducer(bootstrap_servers=bootstrap_servers().split(','), acks='all')
+
+    def dead_letter(value, reason):
+        # the job as it was received, the reason is in the log. get() raises when the broker did not take
+        # it and KafkaIngest then leaves the offset uncommitted
+        producer.send(Config.KAFKA_DEAD_TOPIC, value=value).get(timeout=30)
+    return dead_letter
+
+
+def run_pipeline(body):
+    """
+    KafkaIngest handler: a callback that was not delivered is sent again up to KAFKA_MAX_RETRY times in all,
+    without running the job again. Overloaded, out of scratch space or admission refused after
+    ADMISSION_WORKER_WAIT, is raised for KafkaIngest to defer the job
+    """
+    from backend.pipeline import run_job
+    return run_job(body, Config.KAFKA_MAX_RETRY)
+
+
+if __name__ == '__main__':
+    # python -m backend.kafka_consumer, one consumer group member per process
+    holder = []
+    ingest = KafkaIngest(make_consumer(holder), run_pipeline, dead_letter=make_dead_letter())
+    holder.append(ingest)
+    ingest.serve()
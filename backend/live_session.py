@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# coding: utf-8
+import json
+import time
+import uuid
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from config import Config
+from backend.slice_helper import IntervalBuilder, SAMPLE_RATE
+from backend.utility import EvaEx, Const, make_response, g_logger
+
+
+def _score(clip, is_male):
+    if Config.PROCESS_ENGINE:
+        from backend.process_engine import get_engine
+        return get_engine().inference([clip], is_male).result()
+    from emotion_model.rehearsal_emo import RehearsalEmo
+    return RehearsalEmo.inference([clip], is_male)
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return round(values[int(q * (len(values) - 1))], 1) if values else 0.0
+
+
+class LiveSession(object):
+    """
+    one live class: 16k mono int16 audio and asr sentences arrive in any interleaving, every interval of
+    IntervalBuilder is scored once both its sentences and its audio are in, and turns into a 'segment' event
+    with the running 'total'. audio before the earliest interval that can still be cut is dropped, and at most
+    `max_seconds` of audio and `max_events` events are kept, so a session's memory does not grow with its length.
+    """
+
+    def __init__(self, session_id, is_male, executor, max_seconds=Config.LIVE_MAX_BUFFER_SECONDS,
+                 max_events=Config.LIVE_MAX_EVENTS, on_latency=None):
+        self.session_id = session_id
+        self.is_male = is_male
+        self.executor = executor
+        self.max_samples = max_seconds * SAMPLE_RATE
+        self.on_latency = on_latency
+        # same thresholds as clip_pcm(..., "emotion") in the offline pipeline
+        self.builder = IntervalBuilder(12, 8, 4)
+        self.chunks = deque()
+        self.start = 0
+        self.received = 0
+        self.arrivals = deque()
+        self.waiting = deque()
+        self.last_begin = None
+        self.running = 0
+        self.closed = False
+        self.score_sum = 0.0
+        self.score_count = 0
+        self.seq = 0
+        self.events = deque(maxlen=max_events)
+        self.last_active = time.time()
+        self.lock = threading.Lock()
+
+    def push_audio(self, pcm):
+        '''
+        :param pcm: s16le bytes or an int16 array, continuing the samples pushed before
+        '''
+        pcm = np.frombuffer(pcm, dtype='<i2') if isinstance(pcm, (bytes, bytearray)) else np.asarray(pcm, 'int16')
+        with self.lock:
+            self._check_open()
+            self.chunks.append((self.received, pcm))
+            self.received += len(pcm)
+            self.arrivals.append((self.received, time.time()))
+            self._trim()
+            ready = self._take_ready()
+        self._submit(ready)
+
+    def push_asr(self, sentences):
+        '''
+        :param sentences: [{'begin_time', 'end_time'},] in ms from the first audio sample, in asr order
+        '''
+        with self.lock:
+            self._check_open()
+            for line in sentences:
+                self.last_begin = int(line['begin_time'])
+                self.waiting.extend(self.builder.push(line))
+            ready = self._take_ready()
+        self._submit(ready)
+
+    def close(self):
+        '''
+        no more audio or sentences, the last interval is cut and a final 'end' event follows the last segment
+        '''
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.waiting.extend(self.builder.close())
+            ready = self._take_ready()
+            # intervals whose audio never arrived are not scored
+            for begin, end in self.waiting:
+                g_logger.warning('{} - live interval {}-{} has no audio'.format(self.session_id, begin, end))
+            self.waiting.clear()
+            self._maybe_end()
+        self._submit(ready)
+
+    def poll(self, after=0):
+        '''
+        :return: events with a seq above `after`, oldest first
+        '''
+        with self.lock:
+            self.last_active = time.time()
+            return [x for x in self.events if x['seq'] > after]
+
+    def _check_open(self):
+        if self.closed:
+            raise EvaEx(Const.BAD_REQ)
+        self.last_active = time.time()
+
+    def _emit(self, event):
+        self.seq += 1
+        event['seq'] = self.seq
+        self.events.append(event)
+
+    def _trim(self):
+        keep = self.received - self.max_samples
+        # the next interval starts at the open interval's begin or at a later sentence
+        candidates = [b for b, _ in self.waiting]
+        if self.builder.count and not self.builder.decided:
+            candidates.append(self.builder.interval_begin)
+        elif self.last_begin is not None:
+            candidates.append(self.last_begin)
+        if candidates:
+            keep = max(keep, int(min(candidates) * SAMPLE_RATE / 1000))
+        while self.chunks and self.chunks[0][0] + len(self.chunks[0][1]) <= keep:
+            offset, pcm = self.chunks.popleft()
+            self.start = offset + len(pcm)
+        while self.arrivals and self.arrivals[0][0] <= self.start:
+            self.arrivals.popleft()
+
+    def _slice(self, begin, end):
+        parts = [pcm[max(begin - offset, 0):end - offset] for offset, pcm in self.chunks
+                 if offset < end and offset + len(pcm) > begin]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int16)
+
+    def _arrival(self, sample):
+        for received, t in self.arrivals:
+            if received >= sample:
+                return t
+        return time.time()
+
+    def _take_ready(self):
+        ready = []
+        while self.waiting:
+            begin_ms, end_ms = self.waiting[0]
+            begin = int(round(begin_ms * SAMPLE_RATE / 1000))
+            end = int(round(end_ms * SAMPLE_RATE / 1000))
+            if end > self.received and not self.closed:
+                break
+            self.waiting.popleft()
+            if begin < self.start:
+                g_logger.warning('{} - live interval {}-{} dropped, audio buffer exceeded'.format(
+                    self.session_id, begin_ms, end_ms))
+                continue
+            clip = {'clip_id': uuid.uuid4().hex, 'pcm': self._slice(begin, end), 'begin_time': begin_ms,
+                    'end_time': end_ms}
+            ready.append((clip, self._arrival(min(end, self.received))))
+            self.running += 1
+        self._trim()
+        return ready
+
+    def _submit(self, ready):
+        for clip, arrival in ready:
+            self.executor.submit(self._run, clip, arrival)
+
+    def _run(self, clip, arrival):
+        try:
+            segment = _score(clip, self.is_male)['segment'][0]
+        except Exception as e:
+            g_logger.error('{} - live segment error: {}'.format(self.session_id, e))
+            segment = {'begin_time': clip['begin_time'], 'end_time': clip['end_time'], 'score': -1, 'label': -1}
+        latency = (time.time() - arrival) * 1000
+        with self.lock:
+            self.running -= 1
+            if segment['score'] != -1:
+                self.score_sum += float(segment['score'])
+                self.score_count += 1
+            self._emit({'type': 'segment', 'begin_time': segment['begin_time'], 'end_time': segment['end_time'],
+                        'score': float(segment['score']), 'label': int(segment['label']),
+                        'latency_ms': round(latency, 1), 'total': self._total()})
+            self._maybe_end()
+        if self.on_latency is not None:
+            self.on_latency(latency)
+
+    def _total(self):
+        if not self.score_count:
+            return {'score': -1, 'label': -1}
+        score = self.score_sum / self.score_count
+        return {'score': score, 'label': int(score > 0.5)}
+
+    def _maybe_end(self):
+        if self.closed and not self.running and not self.waiting:
+            self._emit({'type': 'end', 'total': self._total()})
+
+    def finished(self):
+        with self.lock:
+            return self.closed and not self.running
+
+    def info(self):
+        with self.lock:
+            return {'buffered_seconds': round(sum(len(x) for _, x in self.chunks) / float(SAMPLE_RATE), 1),
+                    'received_seconds': round(self.received / float(SAMPLE_RATE), 1),
+                    'waiting': len(self.waiting), 'running': self.running, 'segments': self.score_count,
+                    'closed': self.closed}
+
+
+class SessionManager(object):
+    """
+    all live sessions of the node share `workers` scoring threads, with MICRO_BATCH on the segments of
+    concurrent sessions are scored together. sessions idle for `idle_timeout` seconds are closed and, once
+    their events are older than that again, forgotten.
+    """
+
+    def __init__(self, workers=Config.LIVE_WORKERS, max_sessions=Config.LIVE_MAX_SESSIONS,
+                 idle_timeout=Config.LIVE_IDLE_TIMEOUT):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.latency = deque(maxlen=10000)
+        self.stats = {'opened': 0, 'rejected': 0, 'expired': 0}
+
+    def _record(self, latency):
+        with self.lock:
+            self.latency.append(latency)
+
+    def open(self, is_male, session_id=None):
+        '''
+        :return: LiveSession, raises EvaEx(OVERLOADED) beyond max_sessions
+        '''
+        self.reap()
+        session_id = session_id or uuid.uuid4().hex
+        with self.lock:
+            if len(self.sessions) >= self.max_sessions:
+                self.stats['rejected'] += 1
+                raise EvaEx(Const.OVERLOADED)
+            session = LiveSession(session_id, is_male, self.executor, on_latency=self._record)
+            self.sessions[session_id] = session
+            self.stats['opened'] += 1
+        return session
+
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+        if session is None:
+            raise EvaEx(Const.BAD_REQ)
+        return session
+
+    def reap(self):
+        now = time.time()
+        with self.lock:
+            sessions = list(self.sessions.items())
+        for session_id, session in sessions:
+            if now - session.last_active <= self.idle_timeout:
+                continue
+            if not session.closed:
+                g_logger.warning('{} - live session idle, closed'.format(session_id))
+                session.close()
+                session.last_active = now
+            elif session.finished():
+                with self.lock:
+                    self.sessions.pop(session_id, None)
+                    self.stats['expired'] += 1
+
+    def info(self):
+        '''
+        :return: session counts and the p50/p95/max segment latency in ms, from the arrival of the audio that
+        completed a segment to its event
+        '''
+        with self.lock:
+            latency = list(self.latency)
+            stats = dict(self.stats, sessions=len(self.sessions))
+        stats.update(segments=len(latency), p50_ms=_percentile(latency, 0.5), p95_ms=_percentile(latency, 0.95),
+                     max_ms=round(max(latency), 1) if latency else 0.0)
+        return stats
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = SessionManager()
+    return _manager
+
+
+def live_blueprint():
+    '''
+    POST <APP_URL>/live                      {"gender": 0|1} -> {"sessionId"}
+    POST <APP_URL>/live/<id>/audio           16k mono s16le body
+    POST <APP_URL>/live/<id>/asr             [{"begin_time", "end_time"},]
+    GET  <APP_URL>/live/<id>/events?after=n  events with a seq above n
+    POST <APP_URL>/live/<id>/close
+    '''
+    from flask import Blueprint, Response, request
+    bp = Blueprint('live', __name__)
+    prefix = Config.APP_URL + '/live'
+
+    def as_json(data):
+        return Response(json.dumps(data, ensure_ascii=False), content_type='application/json')
+
+    def guarded(func):
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except EvaEx as e:
+                return make_response(e.msg, kwargs.get('session_id', ''))
+            except (ValueError, KeyError, TypeError) as e:
+                g_logger.error('live request error: {}'.format(e))
+                return make_response(Const.BAD_REQ, kwargs.get('session_id', ''))
+        wrapper.__name__ = func.__name__
+        return wrapper
+
+    @bp.route(prefix, methods=['POST'])
+    @guarded
+    def open_session():
+        session = get_manager().open(int(request.get_json(force=True).get('gender')))
+        return as_json({'sessionId': session.session_id})
+
+    @bp.route(prefix + '/<session_id>/audio', methods=['POST'])
+    @guarded
+    def audio(session_id):
+        get_manager().get(session_id).push_audio(request.get_data())
+        return as_json({'sessionId': session_id})
+
+    @bp.route(prefix + '/<session_id>/asr', methods=['POST'])
+    @guarded
+    def asr(session_id):
+        get_manager().get(session_id).push_asr(request.get_json(force=True))
+        return as_json({'sessionId': session_id})
+
+    @bp.route(prefix + '/<session_id>/events', methods=['GET'])
+    @guarded
+    def events(session_id):
+        return as_json({'sessionId': session_id,
+                        'events': get_manager().get(session_id).poll(int(request.args.get('after', 0)))})
+
+    @bp.route(prefix + '/<session_id>/close', methods=['POST'])
+    @guarded
+    def close(session_id):
+        get_manager().get(session_id).close()
+        return as_json({'sessionId': session_id})
+
+    return bp
+
+
+def simulate(n_sessions=8, seconds=60, chunk_ms=200, speed=4.0):
+    '''
+    n_sessions concurrent sessions replaying emotion_model/test.wav in a loop, `speed` times faster than real
+    time, with one 3s asr sentence every 3.5s sent once its audio is in
+    :return: SessionManager.info()
+    '''
+    import os
+    from emotion_model.feature_matrix import read_pcm
+    wav = read_pcm(os.path.join(Config.BASE_FOLDER, 'emotion_model/test.wav'))
+    manager = SessionManager(max_sessions=n_sessions)
+    step = chunk_ms * SAMPLE_RATE // 1000
+
+    def feed(session):
+        sent = 0
+        for i in range(seconds * 1000 // chunk_ms):
+            offset = (i * step) % (len(wav) - step)
+            session.push_audio(wav[offset:offset + step])
+            now_ms = (i + 1) * chunk_ms
+            lines = []
+            while sent * 3500 + 3000 <= now_ms:
+                lines.append({'begin_time': sent * 3500, 'end_time': sent * 3500 + 3000})
+                sent += 1
+            if lines:
+                session.push_asr(lines)
+            time.sleep(chunk_ms / 1000.0 / speed)
+        session.close()
+
+    sessions = [manager.open(i % 2) for i in range(n_sessions)]
+    threads = [threading.Thread(target=feed, args=(x,)) for x in sessions]
+    [x.start() for x in threads]
+    [x.join() for x in threads]
+    while not all(x.finished() for x in sessions):
+        time.sleep(0.05)
+    info = manager.info()
+    info['buffered_seconds_max'] = max(x.info()['buffered_seconds'] for x in sessions)
+    manager.executor.shutdown()
+    return info
+
+
+if __name__ == '__main__':
+    import sys
+    # python -m backend.live_session [n_sessions] [seconds]: segment latency under concurrent live sessions
+    print(simulate(int(sys.argv[1]) if len(sys.argv) > 1 else 8, int(sys.argv[2]) if len(sys.argv) > 2 else 60))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# coding: utf-8
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from config import Config
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, n=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(_label_key(labels), 0)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} counter'.format(self.name)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('{}{} {}'.format(self.name, _format_labels(key), _format_value(value)))
+        return lines
+
+
+class Histogram(object):
+    """
+    cumulative buckets per label set as prometheus expects them, quantile() estimates from the buckets
+    """
+
+    def __init__(self, name, doc, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0, 0.0]
+            series[0][i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def quantile(self, q, **labels):
+        '''
+        :return: upper bound of the bucket holding the q quantile, None without observations
+        '''
+        with self.lock:
+            series = self.series.get(_label_key(labels))
+            if series is None:
+                return None
+            rank = q * series[1]
+            seen = 0
+            for bound, n in zip(self.buckets, series[0]):
+                seen += n
+                if seen >= rank and n:
+                    return bound
+        return None
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            for key, (counts, n, total) in sorted(self.series.items()):
+                seen = 0
+                for bound, count in zip(self.buckets, counts):
+                    seen += count
+                    lines.append('{}_bucket{} {}'.format(self.name, _format_labels(key, [('le', _format_value(bound))]),
+                                                         seen))
+                lines.append('{}_count{} {}'.format(self.name, _format_labels(key), n))
+                lines.append('{}_sum{} {}'.format(self.name, _format_labels(key), repr(total)))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, doc):
+        metric = Counter(name, doc)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, doc, buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, doc, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''
+        :return: prometheus text exposition of every metric
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+g_metrics = Registry()
+
+# worker processes of process_engine keep their own counts, only this process' work is exposed
+REQUEST_SECONDS = g_metrics.histogram('emotion_request_seconds', 'pipeline runs from start to callback, by status')
+STAGE_SECONDS = g_metrics.histogram('emotion_stage_seconds', 'pipeline stages: download, cut, ai, callback')
+STEP_SECONDS = g_metrics.histogram('emotion_step_seconds', 'sub-steps: url_convert, download_http, transcode, '
+                                                           'decode_pcm, cut_clip, smile_call, feature_frame, predict')
+FAILURES = g_metrics.counter('emotion_failures_total', 'stages and steps that raised, by stage')
+RETRIES = g_metrics.counter('emotion_retries_total', 'repeated attempts: download, callback, smile')
+DOWNLOAD_BYTES = g_metrics.counter('emotion_download_bytes_total', 'bytes fetched by http_download, divide by '
+                                                                   'emotion_step_seconds_sum{step="download_http"} '
+                                                                   'for throughput')
+CLIPS_PER_REQUEST = g_metrics.histogram('emotion_clips_per_request', 'clips cut from one request', COUNT_BUCKETS)
+# called with (labels, seconds) after every timed() block, see backend/profiling.py
+LISTENERS = []
+
+
+@contextmanager
+def timed(histogram, **labels):
+    '''
+    observe the seconds of the block, or of every call when used as a decorator. an exception in the block is
+    counted in FAILURES under the label values
+    '''
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        FAILURES.inc(stage=','.join(str(v) for _, v in _label_key(labels)))
+        raise
+    finally:
+        seconds = time.time() - start
+        histogram.observe(seconds, **labels)
+        for listener in LISTENERS:
+            listener(labels, seconds)
+
+
+def metrics_blueprint():
+    '''
+    GET <APP_URL>/metrics in prometheus text format
+    '''
+    from flask import Blueprint, Response
+    bp = Blueprint('metrics', __name__)
+
+    @bp.route(Config.APP_URL + '/metrics', methods=['GET'])
+    def metrics():
+        return Response(g_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    return bp
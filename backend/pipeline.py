@@ -1,72 +1,196 @@
 import functools
 import os
-import shutil
 import time
-from backend.slice_helper import clip_wav
+from backend.slice_helper import clip_wav, clip_pcm, decode_pcm, transcode_wav
 from emotion_model.rehearsal_emo import RehearsalEmo
-from multiprocessing.pool import ThreadPool
 from config import Config
+from backend.admission import Overloaded, check_size, media_seconds
+from backend.scratch import get_scratch, MB, PCM_BYTES_PER_SECOND, TXT_BYTES_PER_CLIP
+from backend.metrics import timed, REQUEST_SECONDS, STAGE_SECONDS, CLIPS_PER_REQUEST
+from backend.profiling import should_profile, RequestProfile
 from backend.utility import EvaEx, Const, get_internal_url, http_download, make_callback, try_post_json, g_logger
 
 
-def run_in_pool(pool: ThreadPool):
+def run_in_pool(pool):
+    """
+    run the decorated function on `pool`, a concurrent.futures executor. calls return a Future at once,
+    so callers can start several before waiting on any. for process_engine.ProcessEngine call
+    engine.submit(func, ...) instead, a decorated module function cannot be pickled by name.
+    """
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            result = pool.apply_async(func, args=args)
-            return result.get()
+            return pool.submit(func, *args, **kwargs)
         return wrapper
     return decorator
 
 
 class Pipeline:
-    def __init__(self, input_dict):
+    def __init__(self, input_dict, retry_overloaded=False):
+        '''
+        retry_overloaded: raise an Overloaded of a stage from run() and finish() without calling back, for the
+        queue workers that give the job back. otherwise the caller gets an OVERLOADED callback
+        '''
         self.input_dict = input_dict
+        self.retry_overloaded = retry_overloaded
         self.output_dict = {}
         self.uid = input_dict['requestId']
-        self.video_file = os.path.join(Config.TMP_FOLDER, self.uid)
-        self.tmp_folder = os.path.join(Config.TMP_FOLDER, self.uid+"_video")
+        # every file of the request lives in the workspace, closed with the callback
+        self.workspace = get_scratch().workspace(self.uid)
+        self.video_file = self.workspace.join('video.src')
+        self.pcm_file = self.workspace.join('audio.pcm')
+        self.wav_file = self.workspace.join('audio.wav')
+        self.pcm = None
+        self.buffer = None
+        self.wav_clips = []
+        self.status = Const.SUCCESS
+        # an Overloaded of a stage with retry_overloaded, finish() raises it instead of calling back
+        self.overloaded = None
+        self.start = time.time()
 
     def run(self):
+        '''
+        return: whether the callback was delivered
+        raise Overloaded: with retry_overloaded only, out of scratch space, nothing was called back and the job
+        should be retried later
+        '''
+        try:
+            if should_profile(self.input_dict):
+                with RequestProfile(self.uid):
+                    return self._run()
+            return self._run()
+        finally:
+            self.workspace.close()
+
+    def _run(self):
         try:
             self._download()
             self._cut()
             self._ai()
-            self._callback()
-        except EvaEx as e:
-            g_logger.error("{} - eva error: {}".format(self.uid, e))
-            self._callback(e.msg)
         except Exception as e:
+            self.fail(e)
+        return self.finish()
+
+    def fail(self, e):
+        if isinstance(e, Overloaded) and self.retry_overloaded:
+            g_logger.warning("{} - overloaded, retry in {}s".format(self.uid, e.retry_after))
+            self.overloaded = e
+        elif isinstance(e, EvaEx):
+            g_logger.error("{} - eva error: {}".format(self.uid, e))
+            self.status = e.msg
+        else:
             g_logger.error("{} - unknown error: {}".format(self.uid, e))
-            self._callback(Const.INTERNAL_ERR)
+            self.status = Const.INTERNAL_ERR
+
+    def finish(self):
+        if self.overloaded is not None:
+            self.pcm = None
+            self.buffer = None
+            self.wav_clips = []
+            self.workspace.close()
+            raise self.overloaded
+        try:
+            return self._callback(self.status)
+        except Exception as e:
+            if self.status == Const.SUCCESS:
+                self.fail(e)
+                return self._callback(self.status)
+            raise
 
+    @timed(STAGE_SECONDS, stage='download')
     def _download(self):
         g_logger.debug(f'{self.uid} - download')
+        if Config.ADMISSION:
+            check_size(self.input_dict)
+        self.workspace.open()
         self.internal_url = get_internal_url(self.input_dict['video_url'], self.uid)
         if self.internal_url != self.input_dict['video_url']:
             self.input_dict['internal_url'] = self.internal_url
-        http_download(self.internal_url, self.video_file, self.uid)
+        if Config.STREAM_INGEST:
+            self._stream_decode()
+            return
+        limit = self.workspace.quota - self.workspace.reserved
+        if Config.MAX_VIDEO_MB:
+            limit = min(Config.MAX_VIDEO_MB * MB, limit)
+        available = self.workspace.available()
+        try:
+            http_download(self.internal_url, self.video_file, self.uid, min(limit, available))
+        except EvaEx as e:
+            # short of space for all requests, not a video over the limits
+            if e.msg == Const.FILE_TOO_BIG and available < limit:
+                raise Overloaded(Config.ADMISSION_RETRY_AFTER)
+            raise
         if not os.path.exists(self.video_file):
             raise EvaEx(Const.DOWNLOAD_ERR)
+        self.workspace.refresh()
 
+    def _audio_bytes(self):
+        # decoded audio up to the last sentence, the media may run a little longer
+        return int(media_seconds(self.input_dict['asr_result']) * PCM_BYTES_PER_SECOND * 1.05) + MB
+
+    def _stream_decode(self):
+        # ffmpeg reads the url itself, only the 16k mono audio ever reaches disk or memory
+        if not Config.PCM_IN_MEMORY or Config.PCM_MMAP:
+            self.workspace.reserve(self._audio_bytes())
+        for _ in range(3):
+            try:
+                if Config.PCM_IN_MEMORY:
+                    self.pcm = self._decode(self.internal_url)
+                else:
+                    transcode_wav(self.internal_url, self.wav_file)
+                return
+            except Exception as e:
+                g_logger.error("{} - stream decode error: {}".format(self.uid, e))
+        raise EvaEx(Const.DOWNLOAD_ERR)
+
+    def _decode(self, source):
+        if Config.PCM_MMAP:
+            return decode_pcm(source, self.pcm_file)
+        if self.buffer is None:
+            self.buffer = self.workspace.buffer(self._audio_bytes())
+        return decode_pcm(source, buffer=self.buffer)
+
+    @timed(STAGE_SECONDS, stage='cut')
     def _cut(self):
         g_logger.debug('{} - cut'.format(self.uid))
-        os.mkdir(self.tmp_folder)
-        self.wav_clips = clip_wav(self.input_dict['asr_result'], self.video_file, "emotion")
+        if Config.PCM_IN_MEMORY:
+            if self.pcm is None:
+                if Config.PCM_MMAP:
+                    self.workspace.reserve(self._audio_bytes())
+                self.pcm = self._decode(self.video_file)
+            self.wav_clips = clip_pcm(self.input_dict['asr_result'], self.pcm, "emotion")
+        else:
+            # the decoded wav, unless streamed, and the clips cut from it
+            self.workspace.reserve(self._audio_bytes() * (1 if Config.STREAM_INGEST else 2))
+            source = self.wav_file if Config.STREAM_INGEST else self.video_file
+            self.wav_clips = clip_wav(self.input_dict['asr_result'], source, "emotion")
+            self.workspace.refresh()
+        CLIPS_PER_REQUEST.observe(len(self.wav_clips))
 
+    @timed(STAGE_SECONDS, stage='ai')
     def _ai(self):
         g_logger.debug('{} - ai'.format(self.uid))
-        emotions = RehearsalEmo.inference(self.wav_clips, int(self.input_dict.get('gender')))
-        self.output_dict.update({"emotion": emotions})
+        txt_root = None
+        if self.wav_clips and 'wav_path' in self.wav_clips[0]:
+            self.workspace.reserve(len(self.wav_clips) * TXT_BYTES_PER_CLIP)
+            txt_root = self.workspace.join('txt')
+        gender = int(self.input_dict.get('gender'))
+        # the FAN_OUT_MODELS results go under "models", scored on the same features
+        if Config.PROCESS_ENGINE:
+            from backend.process_engine import get_engine
+            output = get_engine().score_all(self.wav_clips, gender, Config.FAN_OUT_MODELS, txt_root).result()
+        else:
+            output = RehearsalEmo.score_all(self.wav_clips, gender, Config.FAN_OUT_MODELS, txt_root)
+        self.output_dict.update(output)
 
+    @timed(STAGE_SECONDS, stage='callback')
     def _callback(self, status=Const.SUCCESS):
         g_logger.info("{} - callback:{}".format(self.uid, status))
-        if os.path.exists(self.video_file):
-            os.remove(self.video_file)
-        if os.path.exists(self.tmp_folder):
-            shutil.rmtree(self.tmp_folder)
-        if os.path.exists('/'.join(self.wav_clips[0].get('wav_path').split('/')[:-1])):
-            shutil.rmtree('/'.join(self.wav_clips[0].get('wav_path').split('/')[:-1]))
+        # the clips may be views into a pooled buffer the next request reuses
+        self.pcm = None
+        self.buffer = None
+        self.wav_clips = []
+        self.workspace.close()
         if status == Const.SUCCESS:
             ret_data = make_callback(Const.SUCCESS, self.uid, self.output_dict)
         else:
@@ -75,6 +199,47 @@ class Pipeline:
         g_logger.debug("{} - return data: {}".format(self.uid, ret_data))
         ret = try_post_json(self.input_dict['callback'], ret_data, self.uid)
         g_logger.info("{} - callback return:{}".format(self.uid, ret))
+        REQUEST_SECONDS.observe(time.time() - self.start, status=status)
+        return ret is not None
+
+
+def _compute(pipeline):
+    if Config.STAGED_PIPELINE:
+        from backend.stage_executor import get_executor
+        return get_executor().submit(pipeline).result()
+    return pipeline.run()
+
+
+def _run_job(pipeline):
+    if Config.RESULT_CACHE:
+        from backend.result_cache import get_result_cache
+        return get_result_cache().run(pipeline, _compute)
+    return _compute(pipeline)
+
+
+def run_job(body, deliveries):
+    """
+    a job of the redis or kafka worker: Pipeline(body, retry_overloaded=True) through ADMISSION, RESULT_CACHE and
+    STAGED_PIPELINE when they are on. a callback that was not delivered is sent again, without running the job
+    again, up to `deliveries` times in all
+    :return: whether the callback was delivered
+    :raise Overloaded: nothing was called back, the worker should give the job back to run later
+    """
+    pipeline = Pipeline(body, retry_overloaded=True)
+    if Config.ADMISSION:
+        from backend.admission import g_admission
+        # the job is the worker's while it waits, an Overloaded after the wait is deferred like one of a stage
+        with g_admission.admit(body, wait=Config.ADMISSION_WORKER_WAIT):
+            delivered = _run_job(pipeline)
+    else:
+        delivered = _run_job(pipeline)
+    for attempt in range(1, deliveries):
+        if delivered:
+            break
+        time.sleep(min(2 ** attempt, 30))
+        g_logger.warning('{} - 回调未送达, 第{}次重发'.format(pipeline.uid, attempt))
+        delivered = pipeline.finish()
+    return delivered
 
 
 if __name__ == '__main__':
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import Future
+from config import Config
+from backend.utility import g_logger
+
+
+def _init_worker(counter, pin_cpu):
+    # models are loaded once per worker here, not per task. mapped read-only, the workers share their pages
+    from emotion_model.model_registry import g_models
+    from emotion_model.smile_prune import serving_config
+    g_models.preload()
+    serving_config()
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    if pin_cpu and hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[index % len(cpus)]})
+    g_logger.info('engine worker {} ready, pid {}'.format(index, os.getpid()))
+
+
+def _extract(clip_list):
+    from emotion_model.rehearsal_emo import features_from_pcm_list
+    return features_from_pcm_list(clip_list)
+
+
+def _score(features, is_male):
+    from emotion_model.rehearsal_emo import RehearsalEmo
+    return RehearsalEmo.predict(features, is_male)
+
+
+def _inference(input_list, is_male, txt_root=None):
+    from emotion_model.rehearsal_emo import RehearsalEmo
+    return RehearsalEmo.inference(input_list, is_male, txt_root)
+
+
+def _score_all(input_list, is_male, models, txt_root=None):
+    from emotion_model.rehearsal_emo import RehearsalEmo
+    return RehearsalEmo.score_all(input_list, is_male, models, txt_root)
+
+
+class ProcessEngine(object):
+    """
+    worker processes with the models preloaded for the cpu heavy steps, the gil does not serialize them.
+    every call returns a Future, so a caller can fan out the clips of a request or several requests.
+    workers are spawned, not forked, as the serving process already runs threads.
+    """
+
+    def __init__(self, processes=Config.POOL_PROCESS, pin_cpu=Config.PROCESS_PIN_CPU):
+        ctx = multiprocessing.get_context('spawn')
+        self.processes = processes
+        self.pool = ctx.Pool(processes, initializer=_init_worker, initargs=(ctx.Value('i', 0), pin_cpu))
+
+    def submit(self, func, *args, **kwargs):
+        """
+        run a module level function in a worker
+        :return: Future of its result
+        """
+        future = Future()
+        self.pool.apply_async(func, args, kwargs, callback=future.set_result, error_callback=future.set_exception)
+        return future
+
+    def extract(self, clip_list):
+        """
+        :return: Future of (clip_ids, float32 matrix) of rehearsal_emo.features_from_pcm_list
+        """
+        return self.submit(_extract, clip_list)
+
+    def score(self, features, is_male=0):
+        return self.submit(_score, features, is_male)
+
+    def inference(self, input_list, is_male=0, txt_root=None):
+        return self.submit(_inference, input_list, is_male, txt_root)
+
+    def score_all(self, input_list, is_male=0, models=(), txt_root=None):
+        return self.submit(_score_all, input_list, is_male, models, txt_root)
+
+    def map_extract(self, clip_list, chunk=8):
+        """
+        split the clips of one request over the workers
+        :return: (clip_ids, float32 matrix) in clip_list order
+        """
+        import numpy as np
+        futures = [self.extract(clip_list[i:i + chunk]) for i in range(0, len(clip_list), chunk)]
+        parts = [x.result() for x in futures]
+        return [x for ids, _ in parts for x in ids], np.concatenate([x for _, x in parts], 0)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = ProcessEngine()
+    return _engine
+
+
+def benchmark(clip_list, process_counts=(1, 2, 4), chunk=4):
+    """
+    seconds to extract and score clip_list with map_extract for each worker count
+    """
+    result = {}
+    for n in process_counts:
+        engine = ProcessEngine(n)
+        # first task waits for the workers to load the models
+        [x.result() for x in [engine.extract(clip_list[:1]) for _ in range(n)]]
+        start = time.time()
+        _, features = engine.map_extract(clip_list, chunk)
+        engine.score(features, 0).result()
+        result[n] = round(time.time() - start, 3)
+        engine.close()
+    return result
+
+
+if __name__ == '__main__':
+    import sys
+    from emotion_model.feature_matrix import read_pcm
+    # python -m backend.process_engine [n_clips]: extraction scaling with the worker count
+    n_clips = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    pcm = read_pcm(os.path.join(Config.BASE_FOLDER, 'emotion_model/test.wav'))
+    clips = [{'clip_id': str(i), 'pcm': pcm[(i * 4000) % (len(pcm) - 48000):][:48000]} for i in range(n_clips)]
+    print('cpus:', os.cpu_count(), 'seconds by worker count:', benchmark(clips))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# coding: utf-8
+import io
+import os
+import json
+import time
+import random
+import pstats
+import cProfile
+import threading
+import functools
+import tracemalloc
+from config import Config
+from backend import metrics
+from backend.utility import g_logger, safe_name
+
+# steps that block on ffmpeg or SMILExtract
+SUBPROCESS_STEPS = ('transcode', 'decode_pcm', 'smile_call')
+
+_local = threading.local()
+# tracemalloc and the profiler are process wide, one request is profiled at a time
+_active = threading.Lock()
+
+
+def should_profile(input_dict):
+    '''
+    a request asks for it with "profile": true, otherwise PROFILE_SAMPLE_PERCENT of the requests are profiled
+    '''
+    if input_dict.get('profile'):
+        return True
+    return Config.PROFILE_SAMPLE_PERCENT > 0 and random.random() * 100 < Config.PROFILE_SAMPLE_PERCENT
+
+
+def current():
+    return getattr(_local, 'profile', None)
+
+
+def bind(func):
+    '''
+    run func with the caller's profile, for work handed to pool threads
+    '''
+    profile = current()
+    if profile is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _local.profile = profile
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.profile = None
+    return wrapper
+
+
+def _on_step(labels, seconds):
+    profile = current()
+    if profile is not None:
+        profile.add_step(labels.get('step') or labels.get('stage'), seconds)
+
+
+metrics.LISTENERS.append(_on_step)
+
+
+class RequestProfile(object):
+    """
+    cProfile of the request thread, tracemalloc peak and top allocations, and the seconds of every timed step
+    attributed to the request, including those run on pool threads through bind(). written to
+    PROFILE_DIR/<requestId>.json with the raw profile in <requestId>.prof for snakeviz or pstats, the requestId
+    made safe for a file name. only one request is profiled at a time, tracemalloc and cProfile are process
+    wide: while one runs, and when the profiler cannot start, the request runs without a profile.
+    """
+
+    def __init__(self, uid, folder=Config.PROFILE_DIR, top=Config.PROFILE_TOP):
+        self.uid = uid
+        self.folder = folder
+        self.top = top
+        self.steps = {}
+        self.lock = threading.Lock()
+        self.profiler = None
+        self.active = False
+        self.started_tracing = False
+
+    def add_step(self, step, seconds):
+        with self.lock:
+            n, total = self.steps.get(step, (0, 0.0))
+            self.steps[step] = (n + 1, total + seconds)
+
+    def __enter__(self):
+        if not _active.acquire(False):
+            g_logger.info('{} - another request is being profiled, not profiled'.format(self.uid))
+            return self
+        try:
+            self.profiler = cProfile.Profile()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(Config.PROFILE_TRACE_FRAMES)
+                self.started_tracing = True
+            self.start_memory = tracemalloc.get_traced_memory()[0]
+            self.start = time.time()
+            self.start_cpu = time.process_time()
+            # raises when another profiler is active, sys.monitoring on python 3.12+
+            self.profiler.enable()
+        except Exception as e:
+            g_logger.error('{} - profiler not started, running without: {}'.format(self.uid, e))
+            self._stop_tracing()
+            _active.release()
+            return self
+        self.active = True
+        _local.profile = self
+        return self
+
+    def _stop_tracing(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def __exit__(self, *exc):
+        if not self.active:
+            return False
+        self.active = False
+        try:
+            self.profiler.disable()
+            _local.profile = None
+            wall = time.time() - self.start
+            cpu = time.process_time() - self.start_cpu
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            self._stop_tracing()
+            self._write(wall, cpu, peak, snapshot)
+        except Exception as e:
+            g_logger.error('{} - profile not written: {}'.format(self.uid, e))
+        finally:
+            self._stop_tracing()
+            _active.release()
+        return False
+
+    def _write(self, wall, cpu, peak, snapshot):
+        os.makedirs(self.folder, exist_ok=True)
+        name = safe_name(self.uid)
+        prof_path = os.path.join(self.folder, name + '.prof')
+        self.profiler.dump_stats(prof_path)
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(self.top)
+        with self.lock:
+            steps = dict((k, {'calls': n, 'seconds': round(s, 4)}) for k, (n, s) in self.steps.items())
+        report = {
+            'requestId': self.uid,
+            'wall_seconds': round(wall, 4),
+            # process wide, includes other requests running at the same time
+            'process_cpu_seconds': round(cpu, 4),
+            'subprocess_wait_seconds': round(sum(steps[x]['seconds'] for x in SUBPROCESS_STEPS if x in steps), 4),
+            'steps': steps,
+            'traced_peak_mb': round(peak / 1048576.0, 2),
+            'traced_start_mb': round(self.start_memory / 1048576.0, 2),
+            'top_allocations': [{'where': str(x.traceback), 'kb': round(x.size / 1024.0, 1), 'count': x.count}
+                                for x in snapshot.statistics('lineno')[:self.top]],
+            'profile': prof_path,
+            'top_functions': out.getvalue().splitlines(),
+        }
+        json_path = os.path.join(self.folder, name + '.json')
+        with open(json_path, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        g_logger.info('{} - profile: {:.2f}s wall, {:.2f}s in subprocesses, {:.1f}MB traced peak, {}'.format(
+            self.uid, wall, report['subprocess_wait_seconds'], report['traced_peak_mb'], json_path))
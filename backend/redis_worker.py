@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# coding: utf-8
+import json
+import time
+import uuid
+import threading
+from config import Config
+from backend.admission import Overloaded
+from backend.utility import g_logger
+
+
+def make_redis():
+    import redis
+    return redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB,
+                             password=Config.REDIS_PW)
+
+
+def enqueue(client, body, queue=Config.REDIS_QUEUE):
+    """
+    push one job for the workers, the front end only needs this
+    :param body: the request dict Pipeline is built from
+    :return: job id
+    """
+    job_id = uuid.uuid4().hex
+    client.lpush(queue, json.dumps({'id': job_id, 'attempts': 0, 'body': body}, ensure_ascii=False))
+    return job_id
+
+
+class RedisWorker(object):
+    """
+    jobs move atomically from `queue` to `queue:processing` and get a deadline in `queue:deadline`.
+    a running job's deadline is pushed forward every heartbeat, so a job whose deadline passed belongs to
+    a dead worker and is put back on the queue by whichever worker notices it first. a job that raised or
+    timed out `max_retry` times goes to `queue:dead`. a job that raised Overloaded waits in `queue:delayed`,
+    scored by when it may run again, and that is not an attempt.
+    """
+
+    def __init__(self, client, handler, queue=Config.REDIS_QUEUE, concurrency=Config.POOL_PROCESS,
+                 visibility=Config.REDIS_VISIBILITY_TIMEOUT, max_retry=Config.REDIS_MAX_RETRY):
+        """
+        :param handler: called with the job body, an exception counts as a failed attempt and Overloaded defers
+        the job by its retry_after. False is a job that ran but whose callback was not delivered, it goes to
+        `queue:dead` without running again
+        """
+        self.client = client
+        self.handler = handler
+        self.queue = queue
+        self.processing = queue + ':processing'
+        self.deadline = queue + ':deadline'
+        self.dead = queue + ':dead'
+        self.delayed = queue + ':delayed'
+        self.visibility = visibility
+        self.max_retry = max_retry
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.running = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.stats = {'done': 0, 'failed': 0, 'requeued': 0, 'dead': 0, 'deferred': 0}
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def _retry(self, raw, reason, delay=0, dead=False):
+        '''
+        move a job from processing back to the queue, or to the dead letters after max_retry attempts, in one
+        MULTI/EXEC watching processing, so a job that a reaper or its worker moves at the same time is moved once
+        :param delay: seconds the job waits in the delayed set first, it is not counted as an attempt
+        :param dead: to the dead letters whatever the attempts
+        :return: whether the job was still in processing
+        '''
+        from redis.exceptions import WatchError
+        job = json.loads(raw)
+        if not delay:
+            job['attempts'] += 1
+        job['error'] = reason
+        dead = dead or (not delay and job['attempts'] >= self.max_retry)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.processing)
+                    if raw not in pipe.lrange(self.processing, 0, -1):
+                        pipe.reset()
+                        return False
+                    pipe.multi()
+                    pipe.lrem(self.processing, 1, raw)
+                    pipe.zrem(self.deadline, raw)
+                    if dead:
+                        pipe.lpush(self.dead, json.dumps(job, ensure_ascii=False))
+                    elif delay:
+                        pipe.zadd(self.delayed, {json.dumps(job, ensure_ascii=False): time.time() + delay})
+                    else:
+                        pipe.rpush(self.queue, json.dumps(job, ensure_ascii=False))
+                    pipe.execute()
+                    break
+                except WatchError:
+                    continue
+        if dead:
+            g_logger.error('job {} 重试{}次后放入死信队列: {}'.format(job['id'], job['attempts'], reason))
+            self._count('dead')
+        elif delay:
+            g_logger.warning('job {} 服务繁忙, {}s后重试: {}'.format(job['id'], delay, reason))
+            self._count('deferred')
+        else:
+            g_logger.warning('job {} 第{}次失败, 重新入队: {}'.format(job['id'], job['attempts'], reason))
+            self._count('requeued')
+        return True
+
+    def _finish(self, raw):
+        # lrem tells whether the job was still ours, a reaper may have taken it after a missed heartbeat
+        removed = self.client.lrem(self.processing, 1, raw)
+        self.client.zrem(self.deadline, raw)
+        return removed > 0
+
+    def _run(self, raw):
+        try:
+            job = json.loads(raw)
+            result = self.handler(job['body'])
+        except Overloaded as e:
+            self._retry(raw, str(e), delay=e.retry_after or 1)
+        except Exception as e:
+            g_logger.error('job failed: {}'.format(e))
+            self._count('failed')
+            self._retry(raw, str(e))
+        else:
+            if result is False:
+                # the callback was sent again already, running the job again would not help
+                self._count('failed')
+                self._retry(raw, 'callback not delivered', dead=True)
+            else:
+                self._finish(raw)
+                self._count('done')
+        finally:
+            with self.lock:
+                self.running.pop(raw, None)
+            self.slots.release()
+
+    def reap(self):
+        """
+        extend the deadlines of our running jobs and put back expired jobs of other workers
+        :return: number of jobs put back
+        """
+        now = time.time()
+        with self.lock:
+            running = list(self.running)
+        if running:
+            self.client.zadd(self.deadline, dict((x, now + self.visibility) for x in running))
+        # a worker that died between the pop and the zadd left a job without a deadline
+        for raw in self.client.lrange(self.processing, 0, -1):
+            if self.client.zscore(self.deadline, raw) is None:
+                self.client.zadd(self.deadline, {raw: now + self.visibility}, nx=True)
+        n = 0
+        for raw in self.client.zrangebyscore(self.deadline, 0, now):
+            if self._retry(raw, 'visibility timeout'):
+                n += 1
+            else:
+                self.client.zrem(self.deadline, raw)
+        return n
+
+    def promote(self):
+        '''
+        put the delayed jobs whose time has come back on the queue, in one MULTI/EXEC watching the delayed set
+        :return: number of jobs put back
+        '''
+        from redis.exceptions import WatchError
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.delayed)
+                    ready = pipe.zrangebyscore(self.delayed, 0, time.time())
+                    if not ready:
+                        pipe.reset()
+                        return 0
+                    pipe.multi()
+                    pipe.zrem(self.delayed, *ready)
+                    pipe.rpush(self.queue, *ready)
+                    pipe.execute()
+                    return len(ready)
+                except WatchError:
+                    continue
+
+    def _reaper(self, interval):
+        # delayed jobs are checked every second, the deadlines every interval
+        last = time.time()
+        while not self.stopped.wait(min(interval, 1.0)):
+            try:
+                self.promote()
+                if time.time() - last >= interval:
+                    last = time.time()
+                    self.reap()
+            except Exception as e:
+                g_logger.error('reap failed: {}'.format(e))
+
+    def serve(self, poll=1, max_jobs=None):
+        """
+        pull jobs with a blocking pop until stop(), at most `concurrency` at a time
+        """
+        reaper = threading.Thread(target=self._reaper, args=(max(self.visibility / 3.0, 0.1),))
+        reaper.daemon = True
+        reaper.start()
+        taken = 0
+        while not self.stopped.is_set() and (max_jobs is None or taken < max_jobs):
+            self.slots.acquire()
+            raw = self.client.brpoplpush(self.queue, self.processing, timeout=poll)
+            if raw is None:
+                self.slots.release()
+                continue
+            with self.lock:
+                self.running[raw] = time.time()
+            self.client.zadd(self.deadline, {raw: time.time() + self.visibility})
+            taken += 1
+            worker = threading.Thread(target=self._run, args=(raw,))
+            worker.daemon = True
+            worker.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def join(self):
+        while True:
+            with self.lock:
+                if not self.running:
+                    return
+            time.sleep(0.05)
+
+    def info(self):
+        with self.lock:
+            stats = dict(self.stats, running=len(self.running))
+        stats.update(queued=self.client.llen(self.queue), processing=self.client.llen(self.processing),
+                     dead_letter=self.client.llen(self.dead), delayed=self.client.zcard(self.delayed))
+        return stats
+
+
+def run_pipeline(body):
+    '''
+    RedisWorker handler: a callback that was not delivered is sent again up to REDIS_MAX_RETRY times in all,
+    without running the job again, and the job then goes to the dead letters
+    '''
+    from backend.pipeline import run_job
+    return run_job(body, Config.REDIS_MAX_RETRY)
+
+
+if __name__ == '__main__':
+    # python -m backend.redis_worker, as many workers as wanted against the same REDIS_QUEUE
+    RedisWorker(make_redis(), run_pipeline).serve()
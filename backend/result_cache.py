@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# coding: utf-8
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from config import Config
+from backend.utility import Const, g_logger
+
+# query parameters of the signatures our media urls carry, they change with every resubmission of the same object:
+# oss signed urls (OSSAccessKeyId, Expires, Signature, security-token, and the x-oss-* of v4 signatures) and cdn
+# type A auth_key. generic names such as t or sign are kept, many urls use them for offsets or content
+SIGNATURE_PARAMS = ('expires', 'signature', 'ossaccesskeyid', 'security-token', 'auth_key')
+
+
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if k.lower() not in SIGNATURE_PARAMS and not k.lower().startswith('x-oss-'))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ''))
+
+
+def fingerprint(input_dict):
+    '''
+    sha1 of what decides the result: the media url without its signature, the asr times, the gender and
+    the engines. requestId and callback are left out, so a retry of the same job has the same fingerprint
+    '''
+    key = {
+        'url': normalize_url(input_dict['video_url']),
+        'asr': [(int(x['begin_time']), int(x['end_time'])) for x in input_dict.get('asr_result') or []],
+        'gender': int(input_dict.get('gender')),
+        'engine': [Config.VERSION, Config.GBDT_ENGINE] + Config.FAN_OUT_MODELS,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.status = None
+        self.output = None
+        # an exception of the leader's compute, e.g. Overloaded, the followers fail with it too
+        self.error = None
+        self.followers = 0
+
+
+class ResultCache(object):
+    """
+    finished results by fingerprint, in a local lru of `max_entries` and optionally in redis for
+    Config.REDIS_EXPIRE seconds. identical jobs running at the same time share one computation: the first is the
+    leader, the others wait for its status and output and then send their own callback. with redis a running
+    leader is also visible to the other workers through a `:flight` key.
+    """
+
+    def __init__(self, max_entries=Config.RESULT_CACHE_SIZE, use_redis=False):
+        self.max_entries = max_entries
+        self.local = OrderedDict()
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'local_hit': 0, 'redis_hit': 0, 'deduplicated': 0, 'computed': 0,
+                      'stored': 0}
+        self.redis = None
+        if use_redis:
+            import redis
+            self.redis = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB,
+                                           password=Config.REDIS_PW, socket_timeout=2)
+
+    def _key(self, fp):
+        return Config.REDIS_QUEUE + ':result:' + fp
+
+    def get(self, fp):
+        '''
+        :return: output dict or None
+        '''
+        with self.lock:
+            if fp in self.local:
+                self.local.move_to_end(fp)
+                self.stats['local_hit'] += 1
+                return self.local[fp]
+        if self.redis is not None:
+            try:
+                data = self.redis.get(self._key(fp))
+            except Exception as e:
+                g_logger.warning('result cache redis get failed: {}'.format(e))
+                data = None
+            if data is not None:
+                output = json.loads(data)
+                self._put_local(fp, output)
+                self._count('redis_hit')
+                return output
+        return None
+
+    def _put_local(self, fp, output):
+        with self.lock:
+            self.local[fp] = output
+            self.local.move_to_end(fp)
+            while len(self.local) > self.max_entries:
+                self.local.popitem(last=False)
+
+    def put(self, fp, output):
+        self._put_local(fp, output)
+        self._count('stored')
+        if self.redis is not None:
+            try:
+                self.redis.setex(self._key(fp), Config.REDIS_EXPIRE, json.dumps(output, ensure_ascii=False))
+            except Exception as e:
+                g_logger.warning('result cache redis set failed: {}'.format(e))
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def _wait_remote(self, fp, timeout):
+        # another worker holds the flight key, poll for its result until the key is gone
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            output = self.get(fp)
+            if output is not None:
+                return output
+            try:
+                if not self.redis.exists(self._key(fp) + ':flight'):
+                    return self.get(fp)
+            except Exception as e:
+                g_logger.warning('result cache redis flight check failed: {}'.format(e))
+                return None
+            time.sleep(0.5)
+        return None
+
+    def run(self, pipeline, compute):
+        '''
+        :param pipeline: backend.pipeline.Pipeline of the job
+        :param compute: called with the pipeline when no result is cached or running, runs it including its
+        callback and returns whether the callback was delivered
+        :return: whether the pipeline's callback was delivered
+        :raise: what compute raised. the followers of a running computation that raised fail with its error, an
+        Overloaded is raised again by those with retry_overloaded
+        '''
+        fp = fingerprint(pipeline.input_dict)
+        self._count('requests')
+        output = self.get(fp)
+        if output is not None:
+            g_logger.info('{} - result cache hit {}'.format(pipeline.uid, fp))
+            pipeline.output_dict = dict(output)
+            return pipeline.finish()
+        with self.lock:
+            flight = self.flights.get(fp)
+            leader = flight is None
+            if leader:
+                flight = self.flights[fp] = _Flight()
+            else:
+                flight.followers += 1
+                self.stats['deduplicated'] += 1
+        if not leader:
+            g_logger.info('{} - 等待相同任务的结果 {}'.format(pipeline.uid, fp))
+            flight.done.wait()
+            if flight.error is not None:
+                pipeline.fail(flight.error)
+                return pipeline.finish()
+            pipeline.status = flight.status
+            pipeline.output_dict = dict(flight.output)
+            return pipeline.finish()
+        holding = False
+        try:
+            if self.redis is not None:
+                output, holding = self._join_remote(fp)
+                if output is not None:
+                    flight.status, flight.output = Const.SUCCESS, output
+                    pipeline.output_dict = dict(output)
+                    return pipeline.finish()
+            self._count('computed')
+            flight.status, flight.output = Const.INTERNAL_ERR, {}
+            try:
+                delivered = compute(pipeline)
+            except Exception as e:
+                flight.error = e
+                raise
+            flight.status, flight.output = pipeline.status, dict(pipeline.output_dict)
+            if pipeline.status == Const.SUCCESS:
+                self.put(fp, flight.output)
+            return delivered
+        finally:
+            with self.lock:
+                self.flights.pop(fp, None)
+            if holding:
+                try:
+                    self.redis.delete(self._key(fp) + ':flight')
+                except Exception as e:
+                    g_logger.warning('result cache redis flight release failed: {}'.format(e))
+            flight.done.set()
+
+    def _join_remote(self, fp):
+        '''
+        :return: (output of another worker's leader or None, whether this worker holds the flight key)
+        '''
+        counted = False
+        try:
+            while not self.redis.set(self._key(fp) + ':flight', 1, nx=True, ex=Config.REDIS_VISIBILITY_TIMEOUT):
+                if not counted:
+                    self._count('deduplicated')
+                    counted = True
+                output = self._wait_remote(fp, Config.REDIS_VISIBILITY_TIMEOUT)
+                if output is not None:
+                    return output, False
+        except Exception as e:
+            g_logger.warning('result cache redis flight failed: {}'.format(e))
+            return None, False
+        return None, True
+
+    def info(self):
+        '''
+        :return: counters with hit_rate (cached results per request) and dedup_rate (requests that attached to a
+        running computation), together the share of requests that did no download or extraction
+        '''
+        with self.lock:
+            n = self.stats['requests']
+            hits = self.stats['local_hit'] + self.stats['redis_hit']
+            return dict(self.stats, entries=len(self.local), running=len(self.flights),
+                        hit_rate=round(hits / n, 4) if n else 0.0,
+                        dedup_rate=round(self.stats['deduplicated'] / n, 4) if n else 0.0)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(use_redis=Config.RESULT_CACHE_REDIS)
+    return _cache
+
+
+def _compute(pipeline):
+    if Config.STAGED_PIPELINE:
+        from backend.stage_executor import get_executor
+        return get_executor().submit(pipeline).result()
+    return pipeline.run()
+
+
+def run_cached(body, retry_overloaded=False):
+    '''
+    Pipeline(body, retry_overloaded).run() through the result cache and single flight
+    :return: whether the callback was delivered
+    '''
+    from backend.pipeline import Pipeline
+    return get_result_cache().run(Pipeline(body, retry_overloaded), _compute)
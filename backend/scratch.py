@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import re
+import time
+import shutil
+import socket
+import threading
+from config import Config
+from backend.admission import Overloaded
+from backend.utility import EvaEx, Const, safe_name, g_logger
+
+MB = 1024 * 1024
+# bytes of 16k mono int16 audio per second
+PCM_BYTES_PER_SECOND = 32000
+# an emobase2010 arff per clip, header included
+TXT_BYTES_PER_CLIP = 64 * 1024
+# in the workspace names, the pid of a process is only meaningful on its host or container
+HOST = re.sub(r'[^A-Za-z0-9.-]', '-', socket.gethostname())[:64] or 'localhost'
+
+
+def _pid_alive(pid):
+    '''
+    :return: True, False, or None for a pid of another user we may not signal
+    '''
+    if pid == os.getpid():
+        # a workspace with our pid before we made any is from an earlier process with the same pid
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return None
+    return True
+
+
+def _dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class Workspace(object):
+    """
+    the folder of one request under the scratch root, w<host>_<pid>_<requestId> with the requestId made
+    safe_name. nothing is created before open(), close() removes the folder, frees its quota and gives its
+    buffers back, both can be called more than once.
+    used as a context manager it is opened on enter and closed on exit.
+    """
+
+    def __init__(self, manager, uid, quota):
+        self.manager = manager
+        self.uid = uid
+        self.quota = quota
+        self.path = os.path.join(manager.root, 'w{}_{}_{}'.format(manager.host, os.getpid(), safe_name(uid)))
+        self.reserved = 0
+        self.buffers = []
+        self.opened = False
+
+    def join(self, *names):
+        return os.path.join(self.path, *names)
+
+    def open(self):
+        if not self.opened:
+            os.makedirs(self.path, exist_ok=True)
+            self.opened = True
+            self.manager._opened(self)
+        return self
+
+    def available(self):
+        '''
+        :return: bytes this request may still write, for writers that can stop on a limit like http_download
+        '''
+        return self.manager._available(self)
+
+    def reserve(self, nbytes):
+        '''
+        account nbytes about to be written, raise EvaEx(FILE_TOO_BIG) past the request quota and Overloaded past
+        the global one or the free space of the volume
+        '''
+        self.manager._reserve(self, int(nbytes))
+
+    def refresh(self):
+        '''
+        account what the folder really holds when that is more than reserved, raises like reserve()
+        '''
+        used = _dir_bytes(self.path) if self.opened else 0
+        if used > self.reserved:
+            self.reserve(used - self.reserved)
+        return used
+
+    def buffer(self, nbytes):
+        '''
+        a pooled bytearray of at least nbytes, valid until close()
+        '''
+        buf = self.manager._lease(nbytes)
+        self.buffers.append(buf)
+        return buf
+
+    def close(self):
+        if self.opened:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.opened = False
+        self.manager._closed(self)
+        buffers, self.buffers = self.buffers, []
+        for buf in buffers:
+            self.manager._give_back(buf)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class ScratchManager(object):
+    """
+    per-request workspaces under one root, SCRATCH_DIR, which can be a tmpfs like /dev/shm or a local ssd.
+    bytes are accounted per request against `request_bytes` and over all requests of this process against
+    `total_bytes`, and no request may leave the volume with less than `min_free_bytes`, which also covers the
+    other processes sharing it. `request_bytes` 0 lets one request use all of `total_bytes`. large bytearrays for
+    decoded audio are pooled, `buffers` of at most `buffer_bytes` are kept.
+    """
+
+    def __init__(self, root=Config.SCRATCH_DIR, request_bytes=Config.SCRATCH_REQUEST_MB * MB,
+                 total_bytes=Config.SCRATCH_TOTAL_MB * MB, min_free_bytes=Config.SCRATCH_MIN_FREE_MB * MB,
+                 buffers=Config.SCRATCH_BUFFERS, buffer_bytes=Config.SCRATCH_BUFFER_MB * MB, host=HOST):
+        self.root = root
+        self.host = host
+        self.request_bytes = min(request_bytes, total_bytes) if request_bytes else total_bytes
+        self.total_bytes = total_bytes
+        self.min_free_bytes = min_free_bytes
+        self.max_buffers = buffers
+        self.buffer_bytes = buffer_bytes
+        self.lock = threading.Lock()
+        self.reserved = 0
+        self.workspaces = {}
+        self.free_buffers = []
+        self.stats = {'opened': 0, 'rejected': 0, 'buffer_hits': 0, 'buffer_misses': 0}
+        os.makedirs(root, exist_ok=True)
+
+    def workspace(self, uid):
+        return Workspace(self, uid, self.request_bytes)
+
+    def _opened(self, ws):
+        with self.lock:
+            self.workspaces[ws.path] = ws
+            self.stats['opened'] += 1
+
+    def _closed(self, ws):
+        with self.lock:
+            self.workspaces.pop(ws.path, None)
+            self.reserved -= ws.reserved
+            ws.reserved = 0
+
+    def _available(self, ws):
+        with self.lock:
+            free = shutil.disk_usage(self.root).free - self.min_free_bytes
+            return max(0, min(ws.quota - ws.reserved, self.total_bytes - self.reserved, free))
+
+    def _reserve(self, ws, nbytes):
+        with self.lock:
+            if ws.reserved + nbytes > ws.quota:
+                self.stats['rejected'] += 1
+                g_logger.error('{} - scratch quota: {:.1f}MB over {:.1f}MB'.format(
+                    ws.uid, (ws.reserved + nbytes) / MB, ws.quota / MB))
+                raise EvaEx(Const.FILE_TOO_BIG)
+            if self.reserved + nbytes > self.total_bytes or \
+                    shutil.disk_usage(self.root).free - nbytes < self.min_free_bytes:
+                self.stats['rejected'] += 1
+                g_logger.error('{} - 临时空间不足: {}MB in use'.format(ws.uid, self.reserved // MB))
+                raise Overloaded(Config.ADMISSION_RETRY_AFTER)
+            ws.reserved += nbytes
+            self.reserved += nbytes
+
+    def _lease(self, nbytes):
+        with self.lock:
+            fits = [x for x in self.free_buffers if len(x) >= nbytes]
+            if fits:
+                buf = min(fits, key=len)
+                self.free_buffers.remove(buf)
+                self.stats['buffer_hits'] += 1
+                return buf
+            self.stats['buffer_misses'] += 1
+        return bytearray(nbytes)
+
+    def _give_back(self, buf):
+        if len(buf) > self.buffer_bytes:
+            return
+        with self.lock:
+            self.free_buffers.append(buf)
+            if len(self.free_buffers) > self.max_buffers:
+                # keep the largest, they fit the most requests
+                self.free_buffers.remove(min(self.free_buffers, key=len))
+
+    def sweep(self, max_age=Config.SCRATCH_ORPHAN_SECONDS):
+        '''
+        remove workspaces left by dead processes of this host, and those of a pid we may not signal once older
+        than max_age seconds. the workspaces of a live process are its running requests and are kept whatever
+        their age, those of other hosts sharing the volume are left to them
+        :return: number of workspaces removed
+        '''
+        removed = 0
+        now = time.time()
+        prefix = 'w{}_'.format(self.host)
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not name.startswith(prefix) or path in self.workspaces:
+                continue
+            try:
+                pid = int(name[len(prefix):].split('_', 1)[0])
+                alive = _pid_alive(pid)
+                stale = alive is False or (alive is None and now - os.path.getmtime(path) > max_age)
+            except (ValueError, OSError):
+                continue
+            if stale:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        if removed:
+            g_logger.info('scratch: removed {} orphan workspaces from {}'.format(removed, self.root))
+        return removed
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, root=self.root, workspaces=len(self.workspaces), reserved_mb=self.reserved // MB,
+                        free_mb=shutil.disk_usage(self.root).free // MB, pooled_buffers=len(self.free_buffers))
+
+
+_scratch = None
+_scratch_lock = threading.Lock()
+
+
+def get_scratch():
+    '''
+    the manager of this process, orphans are swept when it is first created
+    '''
+    global _scratch
+    with _scratch_lock:
+        if _scratch is None:
+            _scratch = ScratchManager()
+            _scratch.sweep()
+    return _scratch
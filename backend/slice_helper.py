@@ -1,9 +1,15 @@
 from backend.utility import g_logger
+from backend.metrics import timed, STEP_SECONDS
 import uuid
+import tempfile
 import subprocess
+import wave
 import ffmpy
+import numpy as np
 import os
 
+SAMPLE_RATE = 16000
+
 
 def interval_gen(asr_content, time1, time2, time3, time4=None):
     '''
@@ -76,6 +82,98 @@ def interval_gen(asr_content, time1, time2, time3, time4=None):
     return interval_result
 
 
+class IntervalBuilder:
+    """
+    interval_gen fed one asr sentence at a time: push() returns the intervals that closed, close() the last one.
+    an interval is returned as soon as no later sentence can change it, i.e. once it is longer than time1 and
+    time2, otherwise when the next sentence arrives. the results equal interval_gen over the same sentences,
+    see tests/test_interval_builder.py.
+    time4 is compared with the accumulated milliseconds unscaled, as in interval_gen.
+    """
+
+    def __init__(self, time1, time2, time3, time4=None):
+        self.time1 = time1 * 1000
+        self.time2 = time2 * 1000
+        self.time3 = time3 * 1000
+        self.time4 = time4
+        self.count = 0
+        self.accumulate_time = 0
+        self.previous_end = -1
+        self.interval_begin = -1
+        self.interval_end = -1
+        # the accumulated interval was already emitted or dropped, the next sentence starts a new one
+        self.decided = False
+
+    def _take(self):
+        if self.time4 is None or self.accumulate_time <= self.time4:
+            return [(self.interval_begin, self.interval_end)]
+        return []
+
+    def _restart(self, begin, end):
+        self.accumulate_time = 0
+        self.previous_end = begin
+        self.interval_begin = begin
+        self.interval_end = end
+        self.decided = False
+
+    def push(self, line):
+        '''
+        :param line: {'begin_time', 'end_time'} in ms, in asr order
+        :return: [(begin_ms, end_ms),] closed by this sentence
+        '''
+        begin = int(line['begin_time'])
+        end = int(line['end_time'])
+        result = []
+        if self.count == 0:
+            self._restart(begin, end)
+        if self.accumulate_time > self.time1:
+            if not self.decided:
+                result += self._take()
+            self._restart(begin, end)
+        if self.count != 0 and (begin - self.previous_end) > self.time3:
+            if self.accumulate_time > self.time2:
+                result.append((self.interval_begin, self.interval_end))
+            self._restart(begin, end)
+
+        self.accumulate_time += end - self.previous_end
+        self.previous_end = end
+        self.interval_end = end
+        self.count += 1
+        if self.accumulate_time > self.time1 and self.accumulate_time > self.time2:
+            # emitted now whether or not more sentences follow, the next one only starts a new interval
+            result += self._take()
+            self.decided = True
+        return result
+
+    def close(self):
+        '''
+        :return: [(begin_ms, end_ms),] still open after the last sentence
+        '''
+        if self.count == 0 or self.decided or self.accumulate_time <= self.time2:
+            return []
+        self.decided = True
+        return self._take()
+
+
+def interval_stream(asr_iter, time1, time2, time3, time4=None):
+    '''
+    generator version of interval_gen, yields every interval as soon as it closes
+    :param asr_iter: iterable of asr sentences, e.g. a queue being filled by the asr
+    '''
+    builder = IntervalBuilder(time1, time2, time3, time4)
+    for line in asr_iter:
+        for interval in builder.push(line):
+            yield interval
+    for interval in builder.close():
+        yield interval
+
+
+def stream_intervals(asr_iter, _type='fluency'):
+    if _type != "fluency":
+        return interval_stream(asr_iter, 12, 8, 4)
+    return interval_stream(asr_iter, 30, 20, 5)
+
+
 def get_wav_clips(video_task, video_file_path):
     """
 
@@ -126,6 +224,143 @@ def get_wav_clips(video_task, video_file_path):
         return files
 
 
+def clip_intervals(asr_result: list, _type='fluency') -> list:
+    if _type != "fluency":
+        return interval_gen(asr_result, 12, 8, 4)
+    return interval_gen(asr_result, 30, 20, 5)
+
+
+def _input_options(video_file_path):
+    # ffmpeg fetches remote media itself, so download and decode overlap and the video never hits the disk
+    if video_file_path.startswith('http://') or video_file_path.startswith('https://'):
+        return '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -rw_timeout 10000000'
+    return None
+
+
+def transcode_wav(video_file_path, wav_file_path):
+    """
+    decode the audio track of a video (or any media ffmpeg understands) to a 16k mono wav
+    :param video_file_path: local file path or url
+    :param wav_file_path: target wav path
+    :return: wav_file_path
+    """
+    with timed(STEP_SECONDS, step='transcode'):
+        ffmpy.FFmpeg(inputs={'{}'.format(video_file_path): _input_options(video_file_path)},
+                     outputs={'{}'.format(wav_file_path): '-y -ar 16000 -ac 1'}).run(stderr=subprocess.PIPE,
+                                                                                  stdout=subprocess.PIPE)
+    return wav_file_path
+
+
+def split_wav(wav_file_path, intervals, wav_dir_path):
+    """
+    cut all intervals out of one decoded wav in a single pass, without starting ffmpeg per clip
+    :param wav_file_path: 16k mono wav, e.g. the output of transcode_wav
+    :param intervals: [(begin_ms, end_ms),] as returned by interval_gen
+    :param wav_dir_path: folder for the clips
+    :return: [{"wav_path":"path/to/your/clips/1.wav", "begin_time":0, "end_time":1000},]
+    """
+    ret = []
+    src = wave.open(wav_file_path, 'rb')
+    try:
+        params = src.getparams()
+        n_frames = src.getnframes()
+        for st, ed in intervals:
+            begin = min(int(round(st * params.framerate / 1000)), n_frames)
+            end = min(int(round(ed * params.framerate / 1000)), n_frames)
+            wav_name = os.path.join(wav_dir_path, uuid.uuid4().hex) + '.wav'
+            with timed(STEP_SECONDS, step='cut_clip'):
+                src.setpos(begin)
+                dst = wave.open(wav_name, 'wb')
+                dst.setparams(params)
+                dst.writeframes(src.readframes(end - begin))
+                dst.close()
+            ret.append({"wav_path": wav_name, "begin_time": st, "end_time": ed})
+    finally:
+        src.close()
+    return ret
+
+
+def _read_pipe_into(ff, buffer):
+    '''
+    run ffmpeg as ff.run() would, with its stdout read straight into buffer, a bytearray that is never resized, so
+    arrays over an earlier use of it stay valid
+    :return: (buffer, bytes read), a bigger bytearray when the output did not fit
+    '''
+    size = 0
+    with tempfile.TemporaryFile() as err:
+        p = subprocess.Popen(ff._cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=err)
+        while True:
+            if size == len(buffer):
+                bigger = bytearray(max(2 * len(buffer), 1 << 20))
+                bigger[:size] = buffer[:size]
+                buffer = bigger
+            with memoryview(buffer) as view, view[size:] as free:
+                n = p.stdout.readinto(free)
+            if not n:
+                break
+            size += n
+        p.stdout.close()
+        p.wait()
+        if p.returncode != 0:
+            err.seek(0)
+            raise ffmpy.FFRuntimeError(ff.cmd, p.returncode, b'', err.read())
+    return buffer, size
+
+
+@timed(STEP_SECONDS, step='decode_pcm')
+def decode_pcm(video_file_path, pcm_file_path=None, buffer=None):
+    """
+    decode the audio track once into a 16k mono int16 buffer
+    :param video_file_path: local file path or url
+    :param pcm_file_path: if given, the raw samples are written there and memory-mapped,
+                          otherwise they are read from ffmpeg's stdout into memory
+    :param buffer: bytearray to read ffmpeg's stdout into, e.g. from scratch.Workspace.buffer, saves
+                   allocating and joining the output per request
+    :return: 1-d np.int16 array
+    """
+    if pcm_file_path is None and buffer is not None:
+        ff = ffmpy.FFmpeg(inputs={'{}'.format(video_file_path): _input_options(video_file_path)},
+                          outputs={'pipe:1': '-f s16le -ar {} -ac 1'.format(SAMPLE_RATE)})
+        buffer, size = _read_pipe_into(ff, buffer)
+        return np.frombuffer(buffer, dtype=np.int16, count=size // 2)
+    if pcm_file_path is None:
+        out, _ = ffmpy.FFmpeg(inputs={'{}'.format(video_file_path): _input_options(video_file_path)},
+                              outputs={'pipe:1': '-f s16le -ar {} -ac 1'.format(SAMPLE_RATE)}).run(
+            stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+        return np.frombuffer(out, dtype=np.int16)
+    ffmpy.FFmpeg(inputs={'{}'.format(video_file_path): _input_options(video_file_path)},
+                 outputs={'{}'.format(pcm_file_path): '-y -f s16le -ar {} -ac 1'.format(SAMPLE_RATE)}).run(
+        stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+    if os.path.getsize(pcm_file_path) == 0:
+        return np.zeros(0, dtype=np.int16)
+    return np.memmap(pcm_file_path, dtype=np.int16, mode='r')
+
+
+def clip_pcm(asr_result: list, pcm, _type='fluency') -> list:
+    """
+    same intervals as clip_wav, but the clips are views into the decoded buffer instead of wav files
+    :param asr_result: list [{'begin_time':0,'end_time':100,'text':'the result returned by asr api'},]
+    :param pcm: 1-d np.int16 array from decode_pcm
+    :param _type:
+    :return: [{"clip_id":"9f3c...", "pcm":array([...], dtype=int16), "begin_time":0, "end_time":1000},]
+    """
+    ret = []
+    for st, ed in clip_intervals(asr_result, _type):
+        begin = int(round(st * SAMPLE_RATE / 1000))
+        end = int(round(ed * SAMPLE_RATE / 1000))
+        ret.append({"clip_id": uuid.uuid4().hex, "pcm": pcm[begin:end], "begin_time": st, "end_time": ed})
+    return ret
+
+
+def _is_clip_ready(wav_file_path):
+    # split_wav copies samples as they are, so the source must already be in the model's format
+    try:
+        with wave.open(wav_file_path, 'rb') as f:
+            return f.getframerate() == 16000 and f.getnchannels() == 1 and f.getsampwidth() == 2
+    except (wave.Error, EOFError):
+        return False
+
+
 def clip_wav(asr_result: list, video_file_path, _type='fluency') -> list:
     """
     :param asr_result: list [{'begin_time':0,'end_time':100,'text':'the result returned by asr api'},]
@@ -133,16 +368,11 @@ def clip_wav(asr_result: list, video_file_path, _type='fluency') -> list:
     :param _type:
     :return: [{"wav_path":"path/to/your/clips/1.wav", "begin_time":0, "end_time":1000},]
     """
-    if _type != "fluency":
-        intervals = interval_gen(asr_result, 12, 8, 4)
-    else:
-        intervals = interval_gen(asr_result, 30, 20, 5)
-    if '.wav' not in video_file_path:
+    intervals = clip_intervals(asr_result, _type)
+    if '.wav' not in video_file_path or not _is_clip_ready(video_file_path):
         index = video_file_path.rfind('.')
         tpath = video_file_path[:index] + uuid.uuid4().hex + '.wav'
-        ffmpy.FFmpeg(inputs={'{}'.format(video_file_path): None},
-                     outputs={'{}'.format(tpath): '-ar 16000 -ac 1'}).run(stderr=subprocess.PIPE,
-                                                                          stdout=subprocess.PIPE)
+        transcode_wav(video_file_path, tpath)
         # os.remove(video_file_path)
         video_file_path = tpath
     index = video_file_path.rfind('.')
@@ -151,14 +381,7 @@ def clip_wav(asr_result: list, video_file_path, _type='fluency') -> list:
         os.mkdir(wav_dir_path)
     g_logger.debug(f"video_path:{video_file_path}, wav_dir_path:{wav_dir_path}, exist:"
                    f"{os.path.exists(wav_dir_path)}")
-    ret = []
-    for item in intervals:
-        st, ed = item
-        wav_name = os.path.join(wav_dir_path, uuid.uuid4().hex) + '.wav'
-        ffmpy.FFmpeg(inputs={'{}'.format(video_file_path): '-ss {} -t {}'.format(st / 1000, (ed - st) / 1000)},
-                     outputs={'{}'.format(wav_name): '-ar 16000 -ac 1'}).run(stderr=subprocess.PIPE,
-                                                                             stdout=subprocess.PIPE)
-        ret.append({"wav_path": wav_name, "begin_time": st, "end_time": ed})
+    ret = split_wav(video_file_path, intervals, wav_dir_path)
     if os.path.exists(video_file_path):
         os.remove(video_file_path)
     return ret
@@ -192,3 +415,4 @@ if __name__ == "__main__":
     # for fluency classification
     asr_content = [{'begin_time': 0, 'end_time': 100, 'text': 'the result returned by asr api'}, ]
     time1, time2, time3 = 12, 8, 4
+    print(interval_gen(asr_content, time1, time2, time3))
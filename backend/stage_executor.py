@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# coding: utf-8
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from config import Config
+from backend.utility import g_logger
+
+
+class Stage(object):
+    def __init__(self, name, func, workers, queue_size, always=False):
+        """
+        :param func: called with the job, an exception skips the remaining stages but the `always` ones
+        :param always: run even for a failed job, e.g. the callback. when the last stage is one and raises, the
+        future gets its exception, e.g. the Overloaded of a job that has to be retried
+        """
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.always = always
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.busy = 0
+        self.done = 0
+        self.failed = 0
+        self.seconds = 0.0
+
+
+class StagedExecutor(object):
+    """
+    every stage has its own bounded queue and worker threads, so while job N is in one stage job N+1 can be
+    in the one before. a full queue blocks the stage before it, and submit() once the first one is full.
+    """
+
+    def __init__(self, stages, on_error=None):
+        """
+        :param stages: [Stage,] in order
+        :param on_error: called with (job, exception) when a stage raised
+        """
+        self.stages = stages
+        self.on_error = on_error
+        self.lock = threading.Lock()
+        for i, stage in enumerate(stages):
+            for k in range(stage.workers):
+                t = threading.Thread(target=self._work, args=(i,), name='stage-{}-{}'.format(stage.name, k))
+                t.daemon = True
+                t.start()
+
+    def submit(self, job):
+        """
+        :return: Future resolved with the result of the last stage
+        """
+        future = Future()
+        self.stages[0].queue.put((job, future, None))
+        return future
+
+    def _work(self, i):
+        stage = self.stages[i]
+        while True:
+            job, future, error = stage.queue.get()
+            result = None
+            raised = None
+            if error is None or stage.always:
+                with self.lock:
+                    stage.busy += 1
+                start = time.time()
+                try:
+                    result = stage.func(job)
+                    failed = False
+                except Exception as e:
+                    failed = True
+                    raised = e
+                    if error is None:
+                        error = e
+                        if self.on_error is not None:
+                            self.on_error(job, e)
+                    else:
+                        g_logger.error('stage {} failed after an earlier error: {}'.format(stage.name, e))
+                with self.lock:
+                    stage.busy -= 1
+                    stage.seconds += time.time() - start
+                    if failed:
+                        stage.failed += 1
+                    else:
+                        stage.done += 1
+            if i + 1 < len(self.stages):
+                self.stages[i + 1].queue.put((job, future, error))
+            elif raised is not None:
+                future.set_exception(raised)
+            elif error is not None and not stage.always:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def info(self):
+        """
+        :return: {stage: {'queued', 'busy', 'workers', 'done', 'failed', 'avg_seconds'}}, a stage whose queue
+        stays full or whose workers are always busy is the one to give more workers
+        """
+        with self.lock:
+            return dict((x.name, {'queued': x.queue.qsize(), 'busy': x.busy, 'workers': x.workers, 'done': x.done,
+                                  'failed': x.failed,
+                                  'avg_seconds': round(x.seconds / (x.done + x.failed), 3) if x.done + x.failed else 0.0})
+                        for x in self.stages)
+
+
+def pipeline_stages():
+    return [
+        Stage('download', lambda p: p._download(), Config.STAGE_DOWNLOAD_WORKERS, Config.STAGE_QUEUE_SIZE),
+        Stage('cut', lambda p: p._cut(), Config.STAGE_CUT_WORKERS, Config.STAGE_QUEUE_SIZE),
+        Stage('ai', lambda p: p._ai(), Config.STAGE_AI_WORKERS, Config.STAGE_QUEUE_SIZE),
+        Stage('callback', lambda p: p.finish(), Config.STAGE_CALLBACK_WORKERS, Config.STAGE_QUEUE_SIZE, always=True),
+    ]
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = StagedExecutor(pipeline_stages(), on_error=lambda p, e: p.fail(e))
+    return _executor
+
+
+def run_staged(body, retry_overloaded=False):
+    """
+    drop-in for Pipeline(body, retry_overloaded).run() that goes through the shared stage workers
+    :return: whether the callback was delivered
+    :raise Overloaded: like Pipeline.run
+    """
+    from backend.pipeline import Pipeline
+    return get_executor().submit(Pipeline(body, retry_overloaded)).result()
+
+
+if __name__ == '__main__':
+    import sys
+    # python -m backend.stage_executor [n_jobs]: overlap of four stages that each take 50ms
+    n_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    step = 0.05
+    stages = [Stage(x, lambda job: time.sleep(step), 1, 2) for x in ('download', 'cut', 'ai', 'callback')]
+    start = time.time()
+    for _ in range(n_jobs):
+        for stage in stages:
+            stage.func(None)
+    print('sequential: {:.2f}s'.format(time.time() - start))
+    executor = StagedExecutor(stages)
+    start = time.time()
+    futures = [executor.submit(None) for _ in range(n_jobs)]
+    [x.result() for x in futures]
+    print('staged:     {:.2f}s'.format(time.time() - start), executor.info())
@@ -5,11 +5,12 @@ import logging
 import re
 import time
 import threading
-import requests
 
 from flask import Response
 
 from config import Config
+from backend.http_client import g_http
+from backend.metrics import timed, STEP_SECONDS, RETRIES, DOWNLOAD_BYTES, FAILURES
 
 g_logger = logging.getLogger(__name__)
 
@@ -38,6 +39,7 @@ class Const:
     ALI_ASR_ERR = 'ali asr error'
     NOT_VIDEO = 'file is not a video'
     FILE_TOO_BIG = 'file too big'
+    OVERLOADED = 'server busy'
 
 
 err_code = {
@@ -52,13 +54,14 @@ err_code = {
     Const.FILE_TOO_BIG: (3003074021, 400),
     Const.INTERNAL_ERR: (3003075000, 500),
     Const.ALI_ASR_ERR: (3003075001, 500),
+    Const.OVERLOADED: (3003075002, 503),
 }
 
 
-def make_response(msg, req_id):
+def make_response(msg, req_id, headers=None):
     return Response(json.dumps({"msg": msg, "data": {"requestId": req_id}, "code": err_code[msg][0],
                                 "requestId": req_id}, ensure_ascii=False),
-                    status=err_code[msg][1], content_type='application/json')
+                    status=err_code[msg][1], content_type='application/json', headers=headers)
 
 
 def type_dict(x):
@@ -86,6 +89,22 @@ class EvaEx(Exception):
         self.msg = msg
 
 
+_unsafe_chars = re.compile(r'[^0-9A-Za-z_.-]')
+
+
+def safe_name(req_id):
+    """
+    a file name for a caller's requestId: letters, digits, '_', '-' and '.' are kept, anything else and names
+    that are not kept whole get a hash suffix, so '../x' or 'a/b' can never leave the folder it is joined to
+    """
+    import hashlib
+    req_id = str(req_id)
+    name = _unsafe_chars.sub('_', req_id)[:64].lstrip('.')
+    if name != req_id or not name:
+        name = '{}_{}'.format(name, hashlib.sha1(req_id.encode('utf-8')).hexdigest()[:10])
+    return name
+
+
 class ReadLock:
     def __init__(self, size):
         self.size = size
@@ -109,51 +128,142 @@ class ReadLock:
             self.not_full.notify()
 
 
-def get_internal_url(src_url, req_id):
-    # 外网url转内网url
-    if not Config.DATA_CHANGE_URL:
-        return src_url
+def _change_urls(src_urls, req_id):
+    # 外网url转内网url, the result keeps the order of src_urls and falls back to the source url
     d = {
-        "urls": [src_url],
+        "urls": src_urls,
         "requestId": req_id,
         "sendTime": int(round(time.time() * 1000))
     }
     try:
-        ret = requests.post(Config.DATA_CHANGE_URL, json=d)
+        with timed(STEP_SECONDS, step='url_convert'):
+            ret = g_http.post(Config.DATA_CHANGE_URL, json=d)
         g_logger.debug("receive internal url:{}".format(ret.text))
         ret_json = ret.json()
-        if ret_json['code'] == 2000000:
-            dst_url = ret_json['resultBean'][0]['innerUrl']
-        else:
-            dst_url = src_url
+        if ret_json['code'] == 2000000 and len(ret_json['resultBean']) == len(src_urls):
+            return [x['innerUrl'] for x in ret_json['resultBean']]
     except Exception as e:
         g_logger.error("{} - error in change url:{}".format(req_id, e))
-        dst_url = src_url
-    return dst_url
+    return list(src_urls)
+
+
+class UrlBatcher:
+    """
+    coalesce the url conversions of concurrent requests: the first url of a batch waits `linger` seconds
+    for others, a batch of `max_urls` is sent at once
+    """
+    def __init__(self, linger, max_urls):
+        self.linger = linger
+        self.max_urls = max_urls
+        self.lock = threading.Lock()
+        self.pending = []
+        self.timer = None
+        self.batches = 0
+        self.urls = 0
+
+    def convert(self, src_url, req_id):
+        done = threading.Event()
+        item = {'url': src_url, 'req_id': req_id, 'done': done, 'result': src_url}
+        with self.lock:
+            self.pending.append(item)
+            if len(self.pending) >= self.max_urls:
+                batch = self._take()
+            else:
+                batch = None
+                if self.timer is None:
+                    self.timer = threading.Timer(self.linger, self._flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+        if batch:
+            self._send(batch)
+        done.wait()
+        return item['result']
+
+    def _take(self):
+        batch, self.pending = self.pending, []
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return batch
+
+    def _flush(self):
+        with self.lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+    def _send(self, batch):
+        try:
+            urls = sorted(set(x['url'] for x in batch))
+            # every request of the batch in requestId, so the conversion service logs can be traced per request
+            req_ids = ','.join(sorted(set(str(x['req_id']) for x in batch)))
+            g_logger.debug("change {} urls for {}".format(len(urls), req_ids))
+            mapping = dict(zip(urls, _change_urls(urls, req_ids)))
+            for x in batch:
+                x['result'] = mapping[x['url']]
+            with self.lock:
+                self.batches += 1
+                self.urls += len(urls)
+        finally:
+            for x in batch:
+                x['done'].set()
+
+
+url_batcher = UrlBatcher(Config.URL_BATCH_LINGER_MS / 1000.0, Config.URL_BATCH_MAX)
+
+
+def get_internal_url(src_url, req_id):
+    if not Config.DATA_CHANGE_URL:
+        return src_url
+    if Config.URL_BATCH:
+        return url_batcher.convert(src_url, req_id)
+    return _change_urls([src_url], req_id)[0]
 
 
 def try_post_json(url, js, idx=None) -> str or None:
-    for _ in range(3):
+    for attempt in range(3):
+        if attempt:
+            RETRIES.inc(kind='callback')
         try:
-            ret = requests.post(url, json=js, timeout=10).text
+            ret = g_http.post(url, json=js, timeout=10).text
             return ret
         except Exception as e:
             g_logger.error("{} - post json error: {}, {}".format(idx, url, e))
     return None
 
 
-def http_download(url, file_path, uid=""):
-    for _ in range(3):
+def http_download(url, file_path, uid="", max_bytes=None):
+    '''
+    :param max_bytes: raise EvaEx(FILE_TOO_BIG) once the declared or received size passes it
+    '''
+    for attempt in range(3):
+        if attempt:
+            RETRIES.inc(kind='download')
+        start = time.time()
+        size = 0
+        req = None
         try:
-            req = requests.get(url, stream=True, timeout=10)
-            f = open(file_path, 'wb')
-            for chunk in req.iter_content(chunk_size=65535):
-                f.write(chunk)
-                f.flush()
-            f.close()
+            req = g_http.get(url, stream=True, timeout=10)
+            if max_bytes is not None and int(req.headers.get('Content-Length') or 0) > max_bytes:
+                raise EvaEx(Const.FILE_TOO_BIG)
+            with open(file_path, 'wb') as f:
+                for chunk in req.iter_content(chunk_size=65535):
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise EvaEx(Const.FILE_TOO_BIG)
+                    f.write(chunk)
             return
+        except EvaEx:
+            raise
         except Exception as e:
+            FAILURES.inc(stage='download_http')
             g_logger.error("{} - download error: {}".format(uid, e))
+        finally:
+            # a streamed response holds its pooled connection until closed, also after a read error
+            if req is not None:
+                req.close()
+            DOWNLOAD_BYTES.inc(size)
+            STEP_SECONDS.observe(time.time() - start, step='download_http')
     raise EvaEx(Const.DOWNLOAD_ERR)
 
 
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+benchmarks of the hot paths on synthetic lectures, every case in its own process so peak RSS is per case.
+
+    python -m benchmarks.suite                         run all cases, compare with benchmarks/baseline.json
+    python -m benchmarks.suite --cases interval_gen,pipeline --seconds 1800
+    python -m benchmarks.suite --save benchmarks/baseline.json
+
+a case regresses when its fastest round or its peak RSS is more than --tolerance or --rss-tolerance above the
+baseline, the exit status is then 1. the fastest round is compared as medians of short cases move by half on a
+shared box. everything runs offline: the pipeline case downloads from and calls back to a local server.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+BASE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(BASE_FOLDER, 'benchmarks', 'baseline.json')
+CASES = ('interval_gen', 'interval_stream', 'clip_wav', 'opensmiler_from_list', 'batch_extract', 'predict',
+         'inference', 'pipeline')
+ROUNDS = {'interval_gen': 50, 'interval_stream': 50, 'clip_wav': 5, 'predict': 50}
+# latency changes below this are timer noise for the sub-millisecond cases
+MIN_DELTA_S = 0.001
+
+
+def _lecture_clips(workdir, seconds, n_clips):
+    '''
+    the first n_clips clips clip_wav cuts from a synthetic lecture, as wav files
+    '''
+    from benchmarks.workload import lecture, write_wav
+    from backend.slice_helper import clip_wav
+    asr_result, pcm = lecture(seconds)
+    clips = clip_wav(asr_result, write_wav(os.path.join(workdir, 'lecture.wav'), pcm), 'emotion')
+    return clips[:n_clips]
+
+
+def case_interval_gen(args, workdir):
+    from benchmarks.workload import lecture_asr
+    from backend.slice_helper import clip_intervals
+    asr_result = lecture_asr(args.seconds)
+    return lambda: (clip_intervals(asr_result, 'emotion'), len(asr_result))[1], 'sentences'
+
+
+def case_interval_stream(args, workdir):
+    from benchmarks.workload import lecture_asr
+    from backend.slice_helper import stream_intervals
+    asr_result = lecture_asr(args.seconds)
+    return lambda: (list(stream_intervals(iter(asr_result), 'emotion')), len(asr_result))[1], 'sentences'
+
+
+def case_clip_wav(args, workdir):
+    from benchmarks.workload import lecture, write_wav
+    from backend.slice_helper import clip_wav
+    asr_result, pcm = lecture(args.seconds)
+    source = write_wav(os.path.join(workdir, 'source.wav'), pcm)
+
+    def run():
+        # clip_wav removes its input, the copy is part of the round but small next to the cut
+        path = os.path.join(workdir, 'lecture.wav')
+        shutil.copyfile(source, path)
+        clips = clip_wav(asr_result, path, 'emotion')
+        shutil.rmtree(os.path.join(workdir, 'lecture'))
+        return len(clips)
+    return run, 'clips'
+
+
+def case_opensmiler_from_list(args, workdir):
+    from emotion_model.rehearsal_emo import opensmiler_from_list
+    wav_list = [x['wav_path'] for x in _lecture_clips(workdir, args.seconds, args.clips)]
+    return lambda: len(opensmiler_from_list(wav_list, os.path.join(workdir, 'txt'))), 'clips'
+
+
+def case_batch_extract(args, workdir):
+    from emotion_model.opensmile_extraction import batch_extract
+    clips = _lecture_clips(workdir, args.seconds, args.clips)
+    input_wavs = dict((os.path.basename(x['wav_path'])[:-4], x['wav_path']) for x in clips)
+    return lambda: len(batch_extract(input_wavs, os.path.join(workdir, 'txt'))), 'clips'
+
+
+def case_predict(args, workdir):
+    import numpy as np
+    from emotion_model.rehearsal_emo import RehearsalEmo
+    from emotion_model.feature_matrix import N_FEATURES
+    features = np.random.RandomState(0).randn(256, N_FEATURES).astype(np.float32)
+    return lambda: len(RehearsalEmo.predict(features, 1)), 'rows'
+
+
+def case_inference(args, workdir):
+    from emotion_model.rehearsal_emo import RehearsalEmo
+    clips = _lecture_clips(workdir, args.seconds, args.clips)
+    return lambda: len(RehearsalEmo.inference(clips, 1)['segment']), 'clips'
+
+
+def case_pipeline(args, workdir):
+    import threading
+    import functools
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from benchmarks.workload import lecture, write_wav
+    from config import Config
+    asr_result, pcm = lecture(args.pipeline_seconds)
+    write_wav(os.path.join(workdir, 'lecture.wav'), pcm)
+    callbacks = []
+
+    class Handler(SimpleHTTPRequestHandler):
+        def do_POST(self):
+            callbacks.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=workdir))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    Config.DATA_CHANGE_URL = ''
+    from backend.pipeline import Pipeline
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    counter = [0]
+
+    def run():
+        counter[0] += 1
+        body = {'requestId': 'bench{}'.format(counter[0]), 'callback': url + 'callback',
+                'video_url': url + 'lecture.wav', 'asr_result': asr_result, 'gender': 1}
+        if not Pipeline(body).run() or callbacks[-1]['msg'] != 'success':
+            raise RuntimeError('pipeline failed: {}'.format(callbacks[-1]['msg'] if callbacks else None))
+        return 1
+    return run, 'requests'
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))]
+
+
+def run_case(name, args):
+    '''
+    run one case in this process
+    :return: {'min_s', 'median_s', 'p95_s', 'throughput', 'unit', 'units', 'rounds', 'peak_rss_mb'}
+    '''
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        func, unit = globals()['case_' + name](args, workdir)
+        func()
+        rounds = args.rounds or ROUNDS.get(name, 3)
+        seconds = []
+        units = 0
+        for _ in range(rounds):
+            start = time.perf_counter()
+            units = func()
+            seconds.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    median = _percentile(seconds, 0.5)
+    return {
+        'min_s': round(min(seconds), 5), 'median_s': round(median, 5), 'p95_s': round(_percentile(seconds, 0.95), 5),
+        'throughput': round(units / median, 2) if median else 0.0, 'unit': '{}/s'.format(unit), 'units': units,
+        'rounds': rounds,
+        # kilobytes on linux. SMILExtract and ffmpeg are not included, RUSAGE_CHILDREN would report this
+        # process' own peak for them as linux keeps the maxrss from before their exec
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+    }
+
+
+def run_isolated(name, args):
+    out = tempfile.mktemp(suffix='.json')
+    cmd = [sys.executable, '-m', 'benchmarks.suite', '--case', name, '--out', out, '--seconds', str(args.seconds),
+           '--clips', str(args.clips), '--pipeline-seconds', str(args.pipeline_seconds),
+           '--rounds', str(args.rounds or 0)]
+    env = dict(os.environ)
+    # caches would turn later rounds into lookups
+    for key in ('FEATURE_CACHE', 'RESULT_CACHE', 'MICRO_BATCH'):
+        env.pop(key, None)
+    p = subprocess.Popen(cmd, cwd=BASE_FOLDER, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, err = p.communicate()
+    if p.returncode != 0 or not os.path.exists(out):
+        return {'error': err.decode('utf-8', 'replace').strip().splitlines()[-1:] or ['exit {}'.format(p.returncode)]}
+    with open(out) as f:
+        result = json.load(f)
+    os.remove(out)
+    return result
+
+
+def compare(results, baseline, tolerance, rss_tolerance):
+    '''
+    :return: [(case, what, baseline value, new value),] of the regressions
+    '''
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('cases', {}).get(name)
+        if not base or 'error' in result or 'error' in base:
+            continue
+        if result['min_s'] > max(base['min_s'] * (1 + tolerance), base['min_s'] + MIN_DELTA_S):
+            regressions.append((name, 'min_s', base['min_s'], result['min_s']))
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + rss_tolerance):
+            regressions.append((name, 'peak_rss_mb', base['peak_rss_mb'], result['peak_rss_mb']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='hot path benchmarks on synthetic lectures')
+    parser.add_argument('--cases', default=','.join(CASES), help='comma separated, of ' + ','.join(CASES))
+    parser.add_argument('--seconds', type=int, default=600, help='lecture length for the cut and asr cases')
+    parser.add_argument('--clips', type=int, default=16, help='clips for the extraction cases')
+    parser.add_argument('--pipeline-seconds', type=int, default=120, help='lecture length for the pipeline case')
+    parser.add_argument('--rounds', type=int, default=0, help='timed rounds per case, 0 for the case default')
+    parser.add_argument('--save', help='write the results as a baseline to this path')
+    parser.add_argument('--compare', default=DEFAULT_BASELINE, help='baseline to flag regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed increase of the fastest round')
+    parser.add_argument('--rss-tolerance', type=float, default=0.1, help='allowed peak RSS increase')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--out', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        with open(args.out, 'w') as f:
+            json.dump(run_case(args.case, args), f)
+        return 0
+
+    results = {}
+    for name in args.cases.split(','):
+        results[name] = run_isolated(name, args)
+        r = results[name]
+        if 'error' in r:
+            print('{:<22} failed: {}'.format(name, r['error']))
+        else:
+            print('{:<22} min {:>9.4f}s  median {:>9.4f}s  p95 {:>9.4f}s  {:>10.1f} {:<12} rss {:>6.1f}MB'.format(
+                name, r['min_s'], r['median_s'], r['p95_s'], r['throughput'], r['unit'], r['peak_rss_mb']))
+    report = {'host': {'machine': platform.machine(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+              'params': {'seconds': args.seconds, 'clips': args.clips, 'pipeline_seconds': args.pipeline_seconds},
+              'cases': results}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('baseline written to', args.save)
+        return 0
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != report['params']:
+            print('baseline was taken with {}, latencies are not comparable'.format(baseline.get('params')))
+        regressions = compare(results, baseline, args.tolerance, args.rss_tolerance)
+        for name, what, old, new in regressions:
+            print('REGRESSION {} {}: {} -> {}'.format(name, what, old, new))
+        if regressions:
+            return 1
+        print('no regression against', args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding: utf-8
+import math
+import wave
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+
+def lecture_asr(seconds, seed=0, mean_sentence=3.0, pause_prob=0.08):
+    '''
+    asr sentences of a lecture: lognormal sentence lengths around `mean_sentence` seconds, short breathing gaps
+    and now and then a pause of 4-12s (board writing, questions) that makes interval_gen cut
+    :return: [{'begin_time', 'end_time', 'text'},] in ms, as the asr service returns them
+    '''
+    rng = np.random.RandomState(seed)
+    result = []
+    t = rng.uniform(0.5, 2.0)
+    while True:
+        length = min(max(rng.lognormal(math.log(mean_sentence), 0.5), 0.4), 15.0)
+        if t + length > seconds:
+            break
+        result.append({'begin_time': int(t * 1000), 'end_time': int((t + length) * 1000),
+                       'text': '同学们' * max(1, int(length * 1.5))})
+        gap = rng.exponential(0.4) if rng.rand() > pause_prob else rng.uniform(4, 12)
+        t += length + gap
+    return result
+
+
+def lecture_audio(asr_result, seconds, seed=0):
+    '''
+    16k mono int16 audio for the sentences of lecture_asr: syllables of a harmonic voice with a moving pitch
+    inside the sentences, low room noise everywhere else
+    '''
+    rng = np.random.RandomState(seed)
+    n = int(seconds * SAMPLE_RATE)
+    pcm = (rng.randn(n) * 60).astype(np.int16)
+    for line in asr_result:
+        begin = int(line['begin_time']) * SAMPLE_RATE // 1000
+        end = min(int(line['end_time']) * SAMPLE_RATE // 1000, n)
+        t = np.arange(end - begin) / float(SAMPLE_RATE)
+        f0 = rng.uniform(110, 240) * (1 + 0.15 * np.sin(2 * np.pi * rng.uniform(0.3, 1.5) * t))
+        phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+        # about four syllables per second
+        syllables = np.abs(np.sin(np.pi * rng.uniform(3.5, 4.5) * t)) ** 0.6
+        voice = sum(np.sin(k * phase) / k for k in range(1, 10)) * syllables
+        voice = voice * rng.uniform(0.1, 0.3) + 0.01 * rng.randn(len(t))
+        pcm[begin:end] = np.clip(voice * 32767 + pcm[begin:end], -32768, 32767).astype(np.int16)
+    return pcm
+
+
+def write_wav(path, pcm):
+    w = wave.open(path, 'wb')
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(SAMPLE_RATE)
+    w.writeframes(np.ascontiguousarray(pcm, dtype='<i2').tobytes())
+    w.close()
+    return path
+
+
+def lecture(seconds, seed=0):
+    '''
+    :return: (asr_result, int16 pcm) of a synthetic lecture of `seconds`
+    '''
+    asr_result = lecture_asr(seconds, seed)
+    return asr_result, lecture_audio(asr_result, seconds, seed)
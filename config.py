@@ -2,8 +2,9 @@ import logging
 import os
 
 
-def env_int(key):
-    return int(os.environ.get(key)) if os.environ.get(key) else None
+def env_int(key, default=None):
+    # default only when unset or empty, an explicit 0 is kept
+    return int(os.environ.get(key)) if os.environ.get(key) else default
 
 
 class Config:
@@ -23,12 +24,143 @@ class Config:
     PORT = 5000
     REDIS_QUEUE = "video-analyse-emotion-v13"
     REDIS_EXPIRE = 3 * 24 * 60 * 60
-    REDIS_PW = os.environ.get("REDIS_HOST") or 'ib2nH4XAB!%PK*Ca'
+    REDIS_PW = os.environ.get("REDIS_PW") or 'ib2nH4XAB!%PK*Ca'
     REDIS_HOST = os.environ.get("REDIS_HOST") or 'r-2zeadx5rzfworu9w62.redis.rds.aliyuncs.com'
     REDIS_DB = os.environ.get("REDIS_DB") or 0
-    REDIS_PORT = env_int("REDIS_PORT") or 6379
+    REDIS_PORT = env_int("REDIS_PORT", 6379)
+    # seconds a popped job may go without a heartbeat before another worker re-queues it
+    REDIS_VISIBILITY_TIMEOUT = env_int("REDIS_VISIBILITY_TIMEOUT", 600)
+    # attempts before a job is moved to REDIS_QUEUE:dead, and deliveries of a callback that did not reach the caller.
+    # a job deferred while the worker is overloaded waits in REDIS_QUEUE:delayed and that is not an attempt
+    REDIS_MAX_RETRY = env_int("REDIS_MAX_RETRY", 3)
 
-    POOL_PROCESS = env_int('POOL_PROCESS') or 3
+    POOL_PROCESS = env_int('POOL_PROCESS', 3)
+    # run feature extraction and scoring in POOL_PROCESS worker processes with the models preloaded,
+    # optionally each pinned to its own cpu. see backend/process_engine.py
+    PROCESS_ENGINE = os.environ.get('PROCESS_ENGINE') == '1'
+    PROCESS_PIN_CPU = os.environ.get('PROCESS_PIN_CPU') == '1'
+    # keep-alive connections kept per host by backend/http_client.py, and its default (connect, read) timeouts
+    HTTP_POOL_SIZE = env_int('HTTP_POOL_SIZE', 10)
+    HTTP_CONNECT_TIMEOUT = env_int('HTTP_CONNECT_TIMEOUT', 3)
+    HTTP_READ_TIMEOUT = env_int('HTTP_READ_TIMEOUT', 30)
+    # hosts that keep their session, the least recently used is closed beyond it
+    HTTP_MAX_HOSTS = env_int('HTTP_MAX_HOSTS', 64)
+    # send the DATA_CHANGE_URL conversions of concurrent requests together, waiting up to the linger for others
+    URL_BATCH = os.environ.get('URL_BATCH') == '1'
+    URL_BATCH_LINGER_MS = env_int('URL_BATCH_LINGER_MS', 20)
+    URL_BATCH_MAX = env_int('URL_BATCH_MAX', 50)
+    # run download, cut, ai and callback on separate worker threads so jobs overlap. POOL_PROCESS then bounds
+    # the jobs in the stages and should be about the sum of the stage workers, see StagedExecutor.info().
+    # off by default: on one core with local downloads it measured slower than Pipeline.run, 4.0s against 3.0s
+    # for 6 jobs. turn it on only where downloads wait on the network and ai has more than one core
+    STAGED_PIPELINE = os.environ.get('STAGED_PIPELINE') == '1'
+    STAGE_DOWNLOAD_WORKERS = env_int('STAGE_DOWNLOAD_WORKERS', 4)
+    STAGE_CUT_WORKERS = env_int('STAGE_CUT_WORKERS', 2)
+    STAGE_AI_WORKERS = env_int('STAGE_AI_WORKERS', 2)
+    STAGE_CALLBACK_WORKERS = env_int('STAGE_CALLBACK_WORKERS', 2)
+    STAGE_QUEUE_SIZE = env_int('STAGE_QUEUE_SIZE', 4)
+    # weigh every request by its media seconds plus ADMISSION_SENTENCE_COST per asr sentence and admit new
+    # ones only while the running total stays under ADMISSION_CAPACITY, see backend/admission.py
+    ADMISSION = os.environ.get('ADMISSION') == '1'
+    ADMISSION_CAPACITY = env_int('ADMISSION_CAPACITY', 3600)
+    ADMISSION_SENTENCE_COST = env_int('ADMISSION_SENTENCE_COST', 2)
+    # seconds a request may wait for capacity before it is rejected with a retry-after hint, 0 rejects at once
+    ADMISSION_MAX_WAIT = env_int('ADMISSION_MAX_WAIT', 0)
+    # the same for jobs the redis and kafka workers already took, they are deferred rather than rejected, 0 at once
+    ADMISSION_WORKER_WAIT = env_int('ADMISSION_WORKER_WAIT', 600)
+    # requests allowed to wait at the same time, the rest are rejected without waiting
+    ADMISSION_MAX_WAITING = env_int('ADMISSION_MAX_WAITING', 16)
+    # retry-after until finished requests give a throughput estimate
+    ADMISSION_RETRY_AFTER = env_int('ADMISSION_RETRY_AFTER', 10)
+    # with ADMISSION, inputs beyond these are answered with FILE_TOO_BIG before anything is downloaded. downloads
+    # larger than MAX_VIDEO_MB are cut off in any case. 0, the default, is no limit: classroom recordings of
+    # several hours and GB are normal input, only the scratch quota bounds them
+    MAX_MEDIA_SECONDS = env_int('MAX_MEDIA_SECONDS', 0)
+    MAX_ASR_SENTENCES = env_int('MAX_ASR_SENTENCES', 0)
+    MAX_VIDEO_MB = env_int('MAX_VIDEO_MB', 0)
+    # live sessions of backend/live_session.py: scoring threads shared by all sessions of the node, sessions
+    # accepted at once, and seconds without a call before a session is closed
+    LIVE_WORKERS = env_int('LIVE_WORKERS', 4)
+    LIVE_MAX_SESSIONS = env_int('LIVE_MAX_SESSIONS', 200)
+    LIVE_IDLE_TIMEOUT = env_int('LIVE_IDLE_TIMEOUT', 300)
+    # per session bounds: seconds of audio waiting for its asr sentences, and events kept for polling
+    LIVE_MAX_BUFFER_SECONDS = env_int('LIVE_MAX_BUFFER_SECONDS', 120)
+    LIVE_MAX_EVENTS = env_int('LIVE_MAX_EVENTS', 1000)
+    # profile requests sent with "profile": true and this share of all others: cProfile, tracemalloc and the
+    # seconds per step, written to PROFILE_DIR/<requestId>.json and .prof. one request is profiled at a time,
+    # the others run without while it does
+    PROFILE_SAMPLE_PERCENT = float(os.environ.get('PROFILE_SAMPLE_PERCENT') or 0)
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(TMP_FOLDER, 'profiles')
+    PROFILE_TOP = env_int('PROFILE_TOP', 25)
+    # stack depth kept per allocation, deeper costs more while a profile runs
+    PROFILE_TRACE_FRAMES = env_int('PROFILE_TRACE_FRAMES', 1)
+    # per-request workspaces, w<host>_<pid>_<requestId>. a tmpfs such as /dev/shm/emotion keeps clips and
+    # opensmile output off the disk, size it for SCRATCH_TOTAL_MB per process
+    SCRATCH_DIR = os.environ.get('SCRATCH_DIR') or os.path.join(TMP_FOLDER, 'scratch')
+    # bytes one request may write (video, decoded audio, clips, opensmile output), past it the request fails.
+    # 0, the default, is up to SCRATCH_TOTAL_MB: recordings of several hours and GB are normal input
+    SCRATCH_REQUEST_MB = env_int('SCRATCH_REQUEST_MB', 0)
+    # bytes all requests of a process may hold, past it or below SCRATCH_MIN_FREE_MB free on the volume
+    # requests are given back to the queue workers to retry later, other callers get an OVERLOADED callback
+    SCRATCH_TOTAL_MB = env_int('SCRATCH_TOTAL_MB', 32768)
+    SCRATCH_MIN_FREE_MB = env_int('SCRATCH_MIN_FREE_MB', 512)
+    # workspaces of dead processes of the same host are removed when a process starts, those of a pid we may not
+    # signal, which can be a reused one of another user, once older than this. a live process' workspace is never
+    # removed, nor those of other hosts or containers sharing SCRATCH_DIR, their pids mean nothing here
+    SCRATCH_ORPHAN_SECONDS = env_int('SCRATCH_ORPHAN_SECONDS', 6 * 3600)
+    # decoded audio buffers kept for reuse with PCM_IN_MEMORY, and the largest kept
+    SCRATCH_BUFFERS = env_int('SCRATCH_BUFFERS', 4)
+    SCRATCH_BUFFER_MB = env_int('SCRATCH_BUFFER_MB', 512)
+
+    # decode the audio once into a 16k mono int16 buffer and stream clips to SMILExtract over pipes
+    PCM_IN_MEMORY = os.environ.get('PCM_IN_MEMORY') == '1'
+    # keep that buffer in a memory-mapped file under TMP_FOLDER instead of process memory
+    PCM_MMAP = os.environ.get('PCM_MMAP') == '1'
+    # let ffmpeg read the video url directly instead of downloading the whole file first
+    STREAM_INGEST = os.environ.get('STREAM_INGEST') == '1'
+    # clips per SMILExtract process. 1, one process per clip, is as fast as batching for clips of 8s and longer,
+    # the measured clips/s by batch size are in the docstring of emotion_model/smile_batch.py
+    SMILE_BATCH_SIZE = env_int('SMILE_BATCH_SIZE', 1)
+    # run SMILExtract with a config generated by emotion_model/smile_prune.py that leaves out the functionals and
+    # components no registered model reads. off by default: round_7 reads every column, so with the current models
+    # there is nothing to leave out. `python -m emotion_model.smile_prune` at build or deploy time writes it into
+    # SMILE_PRUNE_DIR and checks it against emobase2010 on test.wav, serving only loads a checked one
+    SMILE_PRUNE = os.environ.get('SMILE_PRUNE') == '1'
+    SMILE_PRUNE_DIR = os.environ.get('SMILE_PRUNE_DIR') or os.path.join(TMP_FOLDER, 'smile_prune')
+    # 'flat' scores the gbdt models from the node arrays in emotion_model/model/*.npz, same probabilities as
+    # 'sklearn' without unpickling scikit-learn objects, tests/test_gbdt_flat.py holds them to the predict_proba of
+    # the pickles under scikit-learn 0.20. rerun `python -m emotion_model.gbdt_flat` after retraining,
+    # `python -m emotion_model.flat_linear` for round_7.pkl, and tests/fixtures/make_model_reference.py
+    GBDT_ENGINE = os.environ.get('GBDT_ENGINE') or 'flat'
+    # map the flat models read-only from emotion_model/model/<name>/*.npy, one copy in the page cache for all
+    # processes on the host, instead of reading the npz into every process. only the npz are in git, the folders
+    # are written at build or deploy time by `python -m emotion_model.model_registry`, without them the npz is read
+    MODEL_MMAP = os.environ.get('MODEL_MMAP') != '0'
+    # load every model of emotion_model.model_registry at import, for gunicorn --preload so workers fork with
+    # them. off, each process loads a model on its first request
+    MODEL_PRELOAD = os.environ.get('MODEL_PRELOAD') == '1'
+    # comma separated names from emotion_model.model_registry, e.g. round_7, scored on the features of every
+    # request next to the gender model and returned under "models" in the callback data, for a/b and shadow runs
+    FAN_OUT_MODELS = [x for x in (os.environ.get('FAN_OUT_MODELS') or '').split(',') if x]
+    # score the clips of concurrent requests in one call per gender model, RehearsalEmo.batchers[..].info()
+    # shows the batch size distribution and queueing delay
+    MICRO_BATCH = os.environ.get('MICRO_BATCH') == '1'
+    MICRO_BATCH_ROWS = env_int('MICRO_BATCH_ROWS', 256)
+    MICRO_BATCH_WAIT_MS = env_int('MICRO_BATCH_WAIT_MS', 5)
+    # reuse features of clips whose samples were seen before, keyed by a hash of the pcm and the extractor
+    FEATURE_CACHE = os.environ.get('FEATURE_CACHE') == '1'
+    FEATURE_CACHE_DIR = os.environ.get('FEATURE_CACHE_DIR') or os.path.join(TMP_FOLDER, 'feature_cache')
+    # local tier bound over all workers sharing FEATURE_CACHE_DIR, least recently used entries are removed beyond
+    # it. one clip is about 6KB
+    FEATURE_CACHE_MB = env_int('FEATURE_CACHE_MB', 256)
+    # share the cache between workers through redis, entries expire after REDIS_EXPIRE
+    FEATURE_CACHE_REDIS = os.environ.get('FEATURE_CACHE_REDIS') == '1'
+    # answer a job whose url without signature, asr times and gender were seen before from the stored result,
+    # and let identical jobs running at the same time share one computation, see backend/result_cache.py
+    RESULT_CACHE = os.environ.get('RESULT_CACHE') == '1'
+    RESULT_CACHE_SIZE = env_int('RESULT_CACHE_SIZE', 1000)
+    # keep results in redis for REDIS_EXPIRE and deduplicate between workers too
+    RESULT_CACHE_REDIS = os.environ.get('RESULT_CACHE_REDIS') == '1'
 
     DEPLOY_ENV = os.environ.get('DEPLOY_ENV') or 'local'
     if DEPLOY_ENV == 'local':
@@ -54,6 +186,17 @@ class Config:
         APOLLO_URL = os.environ.get('APOLLO_URL')
 
     APOLLO_KAFKA = os.environ.get('APOLLO_KAFKA') or 'kafka-bootstrap-servers'
+    # comma separated brokers, read from apollo's APOLLO_KAFKA key when empty
+    KAFKA_SERVERS = os.environ.get('KAFKA_SERVERS') or ''
+    KAFKA_TOPIC = os.environ.get('KAFKA_TOPIC') or 'video-analyse-emotion'
+    KAFKA_GROUP = os.environ.get('KAFKA_GROUP') or 'video-analyse-emotion'
+    # jobs that failed KAFKA_MAX_RETRY times go to this topic and their offset is committed
+    KAFKA_DEAD_TOPIC = os.environ.get('KAFKA_DEAD_TOPIC') or KAFKA_TOPIC + '-dead'
+    # running jobs per partition, the partition is paused while it has that many
+    KAFKA_PARTITION_INFLIGHT = env_int('KAFKA_PARTITION_INFLIGHT', 4)
+    # attempts at a job that raised, and deliveries of a callback that did not reach the caller. an Overloaded job
+    # is run again after its retry_after with the partition paused, that is not an attempt
+    KAFKA_MAX_RETRY = env_int('KAFKA_MAX_RETRY', 3)
     VERSION = os.environ.get('VERSION') or '1.3'
 
     if os.environ.get('LOG_LEVEL') == 'DEBUG':
@@ -1,24 +1,34 @@
 #coding=utf-8
 import os
-import sys
-base_path = os.path.dirname(os.path.realpath(__file__))
-sys.path.append(os.path.join(base_path))
-import shutil
-import pickle
-import numpy as np
-import json
 import uuid
-from opensmile_extraction import batch_extract, logger
+import json
+import numpy as np
+from backend.utility import g_logger as logger
+from emotion_model.model_registry import g_models
+from emotion_model.feature_matrix import N_FEATURES
+base_path = os.path.dirname(os.path.realpath(__file__))
 
 __all__ = ["audio_emotion_model"]
 
 class Emotion:
 
-    def __init__(self, sklearn_model_path):
-        self.emotion_model = pickle.load(open(sklearn_model_path, 'rb'))
+    def __init__(self, model_name):
+        self.model_name = model_name
         self.thread = 0.5
 
+    @property
+    def emotion_model(self):
+        # loaded by the registry on the first prediction, not at import
+        return g_models.get(self.model_name)['model']
+
     def predict(self, wav_clips_list):
+        '''
+        the features come from the same extraction as rehearsal_emo, RehearsalEmo.score_all(clips, is_male,
+        ['round_7']) scores this model next to the gender model on one opensmile pass. they are parsed as float64,
+        the python floats the model was trained and used to be called on. a clip whose extraction fails is scored
+        on all zero features, as before
+        '''
+        from emotion_model.rehearsal_emo import features_from_list
         logger.debug("开始预测，收到输入的音频切片为:{}".format(str(wav_clips_list)))
         logger.info("开始预测，收到输入的音频切片数量为:{}".format(len(wav_clips_list)))
 
@@ -34,37 +44,36 @@ class Emotion:
             logger.info("输入列表为空，返回默认值。")
             return json.dumps(default_result)
 
-        uid = uuid.uuid1()
-        temp_dir = os.path.join(base_path, "temp_{}".format(uid))
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-        os.mkdir(temp_dir)
-        logger.info("创建文件夹：{}".format(temp_dir))
-
-
-        wav_clips = {}
-        for clip_path in wav_clips_list:
-            clip_name = clip_path.split("/")[-1]
-            wav_clips[clip_name] = clip_path
-
-        clips_features = batch_extract(wav_clips, temp_dir)
+        wav_list = [x for x in wav_clips_list if '.wav' in x]
+        temp_dir = os.path.join(base_path, "tmp", "temp_{}".format(uuid.uuid1()))
+        try:
+            _, features = features_from_list(wav_list, temp_dir, np.float64)
+        except (TypeError, Warning) as e:
+            # one call for all clips lost the ones that worked, find the failed ones clip by clip
+            logger.warning("opensmile提取失败: {}, 逐个提取".format(e))
+            features = np.zeros((len(wav_list), N_FEATURES), dtype=np.float64)
+            for i, clip_path in enumerate(wav_list):
+                try:
+                    features[i] = features_from_list([clip_path], temp_dir, np.float64)[1][0]
+                except (TypeError, Warning):
+                    logger.warning("提取{}的opensmile特征失败，使用全0特征。".format(clip_path.split("/")[-1]))
         result = {
             "segment": {},
             "total": {}
         }
         scores = []
-        for clip in clips_features:
-            features = clips_features[clip]
-            score = self.emotion_model.predict_proba([features])[0][-1]
+        for clip_path, score in zip(wav_list, self.emotion_model.predict_proba(features)[:, -1]):
+            score = float(score)
             if score > self.thread:
                 label = 1
             else:
                 label = 0
-            result["segment"][clip] = {
+            result["segment"][clip_path.split("/")[-1]] = {
                 "score": score,
                 "label": label
             }
             scores.append(score)
+        # as before, the last clip is left out of the total
         total_score = float(np.mean(scores[:-1]))
         if total_score > self.thread:
             total_label = 1
@@ -74,14 +83,9 @@ class Emotion:
         result["total"]["score"] = total_score
         result["total"]["label"] = total_label
 
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-            logger.info("删除文件夹：{}".format(temp_dir))
-
         result_str = json.dumps(result)
         logger.debug("预测结束，返回的结果为：{}".format(result_str))
         return result_str
 
 
-audio_emotion_model = Emotion(os.path.join(base_path, "round_7.pkl"))
-
+audio_emotion_model = Emotion("round_7")
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import io
+import time
+import wave
+import hashlib
+import threading
+import numpy as np
+from config import Config
+from backend.utility import g_logger
+
+
+def pcm_key(pcm_bytes, config_name):
+    """
+    content address of one clip: sha1 over the extractor config name and the raw 16k int16 samples,
+    so a resubmitted recording hits whatever its requestId or wav file name is
+    """
+    h = hashlib.sha1(config_name.encode('utf-8') + b'\0')
+    h.update(pcm_bytes)
+    return h.hexdigest()
+
+
+def wav_key(wav_path, config_name):
+    """
+    pcm_key of the sample data of a wav file, the header is not hashed
+    """
+    w = wave.open(wav_path, 'rb')
+    try:
+        return pcm_key(w.readframes(w.getnframes()), config_name)
+    finally:
+        w.close()
+
+
+def _dumps(features):
+    buf = io.BytesIO()
+    np.save(buf, np.asarray(features), allow_pickle=False)
+    return buf.getvalue()
+
+
+def _loads(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+class FeatureCache(object):
+    """
+    feature vectors by content key. a local directory is the first tier, redis is an optional second tier shared
+    by all workers and expires after Config.REDIS_EXPIRE. a redis hit is copied into the local tier.
+    the directory may be shared by all workers of the host, so its bound is kept from what it holds: a hit
+    touches the file's mtime, and once this process wrote 10% of max_bytes or enough to pass it, or every
+    scan_seconds, the folder is listed and the least recently used files of every worker are removed down to 90%
+    of max_bytes. the folder passes the bound by at most 10% of it per worker.
+    """
+
+    def __init__(self, folder, max_bytes, use_redis=False, scan_seconds=10):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.scan_seconds = scan_seconds
+        self.lock = threading.Lock()
+        self.scanning = threading.Lock()
+        self.stats = {'local_hit': 0, 'redis_hit': 0, 'miss': 0, 'evict': 0}
+        os.makedirs(folder, exist_ok=True)
+        # bytes in the folder at the last scan plus what this process wrote since
+        self.size = 0
+        self.written = 0
+        self.entries = 0
+        self.scanned = 0
+        self.evict()
+        self.redis = None
+        if use_redis:
+            import redis
+            self.redis = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB,
+                                           password=Config.REDIS_PW, socket_timeout=2)
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.npy')
+
+    def _get_local(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            # the mtime is the last use every worker evicts by
+            os.utime(self._path(key), None)
+            return _loads(data)
+        except (IOError, OSError, ValueError):
+            # not cached, evicted by a worker sharing the folder, or a torn write
+            return None
+
+    def _put_local(self, key, data):
+        tmp_path = '{}.{}.{}.tmp'.format(self._path(key), os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        with self.lock:
+            self.size += len(data)
+            self.written += len(data)
+            due = self.size > self.max_bytes or self.written > self.max_bytes * 0.1 or \
+                time.time() - self.scanned > self.scan_seconds
+        if due:
+            self.evict()
+
+    def evict(self):
+        '''
+        list the folder and remove the least recently used files of any worker past max_bytes, down to 90% of it.
+        one thread of a process scans at a time, the others go on
+        :return: number of files removed
+        '''
+        if not self.scanning.acquire(False):
+            return 0
+        try:
+            entries = []
+            for entry in os.scandir(self.folder):
+                if entry.name.endswith('.npy'):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            size = sum(x[1] for x in entries)
+            removed = 0
+            if size > self.max_bytes:
+                entries.sort()
+                for _, nbytes, path in entries:
+                    if size <= self.max_bytes * 0.9:
+                        break
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        # removed by another worker at the same time
+                        pass
+                    size -= nbytes
+            with self.lock:
+                self.size = size
+                self.written = 0
+                self.entries = len(entries) - removed
+                self.scanned = time.time()
+                self.stats['evict'] += removed
+            return removed
+        finally:
+            self.scanning.release()
+
+    def get(self, key):
+        """
+        :return: feature vector or None
+        """
+        features = self._get_local(key)
+        if features is not None:
+            self._count('local_hit')
+            return features
+        if self.redis is not None:
+            try:
+                data = self.redis.get('feature:' + key)
+            except Exception as e:
+                g_logger.warning('feature cache redis get failed: {}'.format(e))
+                data = None
+            if data is not None:
+                self._put_local(key, data)
+                self._count('redis_hit')
+                return _loads(data)
+        self._count('miss')
+        return None
+
+    def put(self, key, features):
+        data = _dumps(features)
+        self._put_local(key, data)
+        if self.redis is not None:
+            try:
+                self.redis.setex('feature:' + key, Config.REDIS_EXPIRE, data)
+            except Exception as e:
+                g_logger.warning('feature cache redis set failed: {}'.format(e))
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def info(self):
+        with self.lock:
+            lookups = self.stats['local_hit'] + self.stats['redis_hit'] + self.stats['miss']
+            return dict(self.stats, entries=self.entries, bytes=self.size,
+                        hit_rate=round(1 - self.stats['miss'] / lookups, 4) if lookups else 0.0)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    the process wide cache, None unless Config.FEATURE_CACHE is on
+    """
+    global _cache
+    if not Config.FEATURE_CACHE:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = FeatureCache(Config.FEATURE_CACHE_DIR, Config.FEATURE_CACHE_MB * 1024 * 1024,
+                                  Config.FEATURE_CACHE_REDIS)
+    return _cache
+
+
+def cached_features(keys, extract, dtype=np.float32):
+    """
+    :param keys: content key of every clip, a key holds rows of one dtype
+    :param extract: called with the positions of the missed clips, returns their feature rows in that order
+    :return: (len(keys), n_features) matrix of dtype
+    """
+    cache = get_cache()
+    if cache is None or len(keys) == 0:
+        return extract(list(range(len(keys))))
+    hits = [cache.get(k) for k in keys]
+    missed = [i for i, x in enumerate(hits) if x is None]
+    if missed:
+        start = time.time()
+        extracted = extract(missed)
+        for i, features in zip(missed, extracted):
+            cache.put(keys[i], features)
+        g_logger.debug('feature cache: {} hit, {} extracted in {:.2f}s'.format(
+            len(keys) - len(missed), len(missed), time.time() - start))
+    n_features = len(extracted[0]) if missed else len(hits[0])
+    result = np.empty((len(keys), n_features), dtype=dtype)
+    for i, features in enumerate(hits):
+        if features is not None:
+            result[i] = features
+    if missed:
+        result[missed] = extracted
+    return result
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import time
+import wave
+import numpy as np
+
+SAMPLE_RATE = 16000
+# low level descriptors of opensmile-2.3.0/config/emobase2010.conf and the functionals applied to them
+LLD_NAMES = (['pcm_loudness'] + ['pcm_fftMag_mfcc[{}]'.format(i) for i in range(15)] +
+             ['logMelFreqBand[{}]'.format(i) for i in range(8)] +
+             ['lspFreq[{}]'.format(i) for i in range(8)] + ['F0finEnv', 'voicingFinalUnclipped'])
+LLD2_NAMES = ['F0final', 'jitterLocal', 'jitterDDP', 'shimmerLocal']
+FUNCTIONALS = ['maxPos', 'minPos', 'amean', 'linregc1', 'linregc2', 'linregerrA', 'linregerrQ', 'stddev',
+               'skewness', 'kurtosis', 'quartile1', 'quartile2', 'quartile3', 'iqr1-2', 'iqr2-3', 'iqr1-3',
+               'percentile1.0', 'percentile99.0', 'pctlrange0-1', 'upleveltime75', 'upleveltime90']
+FUNCTIONALS_NZ = [x for x in FUNCTIONALS if x not in ('percentile1.0', 'pctlrange0-1')]
+
+
+def _sma_name(name):
+    # pcm_fftMag_mfcc[0] -> pcm_fftMag_mfcc_sma[0]
+    if name.endswith(']'):
+        base, _, index = name.partition('[')
+        return '{}_sma[{}'.format(base, index)
+    return name + '_sma'
+
+
+def _de_name(name):
+    if name.endswith(']'):
+        base, _, index = name.partition('[')
+        return '{}_de[{}'.format(base, index)
+    return name + '_de'
+
+
+def feature_names():
+    """
+    the 1582 feature names, in the order of the emobase2010 arff output
+    """
+    lld = [_sma_name(x) for x in LLD_NAMES]
+    lld2 = [_sma_name(x) for x in LLD2_NAMES]
+    names = []
+    for group, functionals in ((lld, FUNCTIONALS), ([_de_name(x) for x in lld], FUNCTIONALS),
+                               (lld2, FUNCTIONALS_NZ), ([_de_name(x) for x in lld2], FUNCTIONALS_NZ)):
+        names += ['{}_{}'.format(x, f) for x in group for f in functionals]
+    return names + ['F0final__Turn_numOnsets', 'F0final__Turn_duration']
+
+
+def arff_columns():
+    """
+    feature names as arff attribute lines, the column names the gbdt models are trained on
+    """
+    return ['@attribute {} numeric\n'.format(x) for x in feature_names()]
+
+
+COLUMNS = arff_columns()
+N_FEATURES = len(COLUMNS)
+_positions = dict((x, i) for i, x in enumerate(COLUMNS))
+
+
+def new_matrix(n_clips, dtype=np.float32):
+    """
+    C contiguous (n_clips, N_FEATURES), float32 is the dtype the gbdt trees compare in, the linear models take
+    float64 like the python floats they were trained on
+    """
+    return np.empty((n_clips, N_FEATURES), dtype=dtype)
+
+
+def parse_row(line, out, positions=None):
+    """
+    parse one arff data line of SMILExtract, 'name',v1,...,vN,? , into the row `out`, in its dtype
+    :param line: str or bytes
+    :param positions: where the values go in `out` for a config with fewer columns, see smile_prune. the other
+                      columns are set to nan
+    """
+    if isinstance(line, bytes):
+        line = line.decode('latin-1')
+    text = line[line.index(',') + 1:line.rindex(',')]
+    values = np.array(text.split(',') if text else [], dtype=out.dtype)
+    n_columns = len(out) if positions is None else len(positions)
+    if len(values) != n_columns:
+        raise ValueError('expected {} features, got {}'.format(n_columns, len(values)))
+    if positions is None:
+        out[:] = values
+    else:
+        out[:] = np.nan
+        out[positions] = values
+    return out
+
+
+def last_data_line(data):
+    """
+    the last line of SMILExtract output that holds values, the header lines are skipped
+    """
+    if isinstance(data, str):
+        data = data.encode('latin-1')
+    end = len(data.rstrip())
+    start = data.rfind(b'\n', 0, end) + 1
+    if not data.startswith(b"'", start):
+        raise ValueError('no feature line in SMILExtract output')
+    return data[start:end]
+
+
+def read_row(txt_path, out, positions=None):
+    """
+    parse the feature line of an arff output file into `out`, the file is read once
+    """
+    with open(txt_path, 'rb') as f:
+        return parse_row(last_data_line(f.read()), out, positions)
+
+
+def column_index(feature_columns):
+    """
+    positions of a model's feature columns in the extracted matrix, resolve once per model
+    """
+    return np.array([_positions[x] for x in feature_columns], dtype=np.intp)
+
+
+def to_frame(clip_ids, matrix):
+    """
+    the DataFrame layout of opensmiler_from_list: 'id' and one column per arff attribute line
+    """
+    import pandas as pd
+    df = pd.DataFrame(matrix, columns=COLUMNS)
+    df.insert(0, 'id', list(clip_ids))
+    return df
+
+
+def benchmark(txt_path, model, n_clips=64, rounds=20):
+    """
+    latency and peak traced memory of the old dict/string DataFrame transport against the float32 matrix,
+    both from the same arff output file up to predict_proba
+    :param model: one of the pickled {'model': gbdt, 'feature': columns} dicts
+    """
+    import tracemalloc
+    import pandas as pd
+
+    def old():
+        rows = []
+        for i in range(n_clips):
+            lines = open(txt_path, 'r').readlines()
+            rows.append(dict([('id', str(i))] + list(zip(lines[3:-5], np.array(lines[-1].split(',')[1:-1])))))
+        df = pd.DataFrame(rows)
+        return model['model'].predict_proba(df[model['feature']])[:, 1]
+
+    index = column_index(model['feature'])
+
+    def new():
+        x = new_matrix(n_clips)
+        for i in range(n_clips):
+            read_row(txt_path, x[i])
+        return model['model'].predict_proba(x[:, index])[:, 1]
+
+    result = {}
+    for name, func in (('dataframe', old), ('float32', new)):
+        func()
+        start = time.time()
+        for _ in range(rounds):
+            probe = func()
+        cost = (time.time() - start) / rounds
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result[name] = {'ms': round(cost * 1000, 2), 'peak_mb': round(peak / 2 ** 20, 2), 'probe': probe}
+    result['max_probe_diff'] = float(np.abs(result['dataframe'].pop('probe') - result['float32'].pop('probe')).max())
+    return result
+
+
+if __name__ == '__main__':
+    import sys
+    import pickle
+    import tempfile
+    from emotion_model.rehearsal_emo import opensmiler
+    # python -m emotion_model.feature_matrix [n_clips]
+    base_path = os.path.dirname(os.path.realpath(__file__))
+    n_clips = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    model = pickle.load(open(os.path.join(base_path, 'model/beike-female_gbdt-online.pkl'), 'rb'))
+    with tempfile.TemporaryDirectory() as tmp:
+        opensmiler(os.path.join(base_path, 'test.wav'), tmp, toolfold=os.path.join(base_path, 'opensmile-2.3.0'))
+        print(benchmark(os.path.join(tmp, 'test.txt'), model, n_clips))
+
+
+def read_pcm(wav_path):
+    """
+    int16 samples of a 16k 16bit mono wav, the input of rehearsal_emo.features_from_pcm_list
+    """
+    with wave.open(wav_path, 'rb') as w:
+        if w.getframerate() != SAMPLE_RATE or w.getsampwidth() != 2 or w.getnchannels() != 1:
+            raise ValueError('{} is not 16k 16bit mono pcm'.format(wav_path))
+        return np.frombuffer(w.readframes(w.getnframes()), dtype='<i2')
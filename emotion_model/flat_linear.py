@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import numpy as np
+from emotion_model.gbdt_flat import expit, load_arrays, model_path, unpack
+
+
+def export(pkl_path, npz_path=None):
+    """
+    the coefficients of a pickled binary LogisticRegression(CV), like round_7.pkl, as an npz and its unpacked
+    folder. only this step needs scikit-learn.
+    :return: npz path, next to the pickle by default
+    """
+    import pickle
+    npz_path = npz_path or os.path.splitext(pkl_path)[0] + '.npz'
+    with open(pkl_path, 'rb') as f:
+        model = pickle.load(f)
+    if model.coef_.shape[0] != 1 or len(model.classes_) != 2 or model.multi_class not in ('ovr', 'warn'):
+        raise ValueError('only binary one-vs-rest models can be flattened')
+    np.savez(npz_path, coef=np.asarray(model.coef_, dtype=np.float64),
+             intercept=np.asarray(model.intercept_, dtype=np.float64))
+    unpack(npz_path)
+    return npz_path
+
+
+class FlatLogistic(object):
+    """
+    predict_proba of a binary one-vs-rest logistic regression: expit of X . coef.T + intercept, done as
+    scikit-learn 0.20 does it, the input as float64 and one dot product
+    """
+
+    def __init__(self, path):
+        data = load_arrays(path)
+        self.coef = data['coef']
+        self.intercept = data['intercept']
+        self.n_features_ = self.coef.shape[1]
+
+    def decision_function(self, X):
+        return (np.dot(np.asarray(X, dtype=np.float64), self.coef.T) + self.intercept).ravel()
+
+    def predict_proba(self, X):
+        proba = expit(self.decision_function(X))
+        return np.vstack([1 - proba, proba]).T
+
+
+def load_model(name, mmap=True):
+    """
+    {'model': FlatLogistic, 'feature': None}, the model scores all extracted columns in order
+    """
+    return {'model': FlatLogistic(model_path(name, mmap)), 'feature': None}
+
+
+if __name__ == '__main__':
+    import sys
+    import pickle
+    # python -m emotion_model.flat_linear [pkl], needs the scikit-learn of requirements.txt
+    base_path = os.path.dirname(os.path.realpath(__file__))
+    pkl_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(base_path, 'round_7.pkl')
+    npz_path = export(pkl_path, os.path.join(base_path, 'model', os.path.basename(pkl_path)[:-4] + '.npz'))
+    sk = pickle.load(open(pkl_path, 'rb'))
+    X = np.random.RandomState(0).randn(64, sk.coef_.shape[1]) * 10
+    flat = FlatLogistic(os.path.splitext(npz_path)[0])
+    print('max difference:', np.abs(sk.predict_proba(X) - flat.predict_proba(X)).max())
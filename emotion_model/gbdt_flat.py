@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import math
+import numpy as np
+
+base_path = os.path.dirname(os.path.realpath(__file__))
+
+
+# exp of the C library, as scipy.special.expit uses. numpy's own vectorised exp can differ in the last bit
+_exp = np.frompyfunc(math.exp, 1, 1)
+
+
+def expit(x):
+    '''
+    the logistic function scikit-learn 0.20 turns scores into probabilities with, without scipy. exp is clipped
+    so scores beyond +-709 do not overflow
+    '''
+    x = np.clip(np.asarray(x, dtype=np.float64), -709.0, 709.0)
+    return 1.0 / (1.0 + _exp(-x).astype(np.float64))
+
+
+def export(pkl_path, npz_path=None):
+    """
+    flatten a pickled {'model': GradientBoostingClassifier, 'feature': columns} into contiguous node arrays.
+    only this step needs the pinned scikit-learn to unpickle the model, serving reads the npz.
+    :return: npz path, next to the pickle by default
+    """
+    import pickle
+    npz_path = npz_path or os.path.splitext(pkl_path)[0] + '.npz'
+    with open(pkl_path, 'rb') as f:
+        model = pickle.load(f)
+    gbdt = model['model']
+    if gbdt.loss != 'deviance' or gbdt.n_classes_ != 2 or gbdt.estimators_.shape[1] != 1:
+        raise ValueError('only binary deviance models can be flattened')
+    feature, threshold, left, right, value, roots = [], [], [], [], [], []
+    offset = 0
+    max_depth = 0
+    for estimator in gbdt.estimators_[:, 0]:
+        state = estimator.tree_.__getstate__()
+        nodes = state['nodes'][:state['node_count']]
+        leaf = nodes['left_child'] == -1
+        index = np.arange(len(nodes)) + offset
+        # a leaf points at itself, so every tree can be walked max_depth steps in lock step
+        left.append(np.where(leaf, index, nodes['left_child'] + offset))
+        right.append(np.where(leaf, index, nodes['right_child'] + offset))
+        feature.append(np.where(leaf, 0, nodes['feature']))
+        threshold.append(np.where(leaf, np.inf, nodes['threshold']))
+        value.append(state['values'][:state['node_count'], 0, 0])
+        roots.append(offset)
+        offset += len(nodes)
+        max_depth = max(max_depth, int(state['max_depth']))
+    np.savez(npz_path,
+             feature=np.concatenate(feature).astype(np.int32),
+             threshold=np.concatenate(threshold).astype(np.float64),
+             left=np.concatenate(left).astype(np.int32),
+             right=np.concatenate(right).astype(np.int32),
+             value=np.concatenate(value).astype(np.float64),
+             roots=np.array(roots, dtype=np.int32),
+             max_depth=np.array(max_depth),
+             prior=np.array(float(gbdt.init_.prior)),
+             learning_rate=np.array(float(gbdt.learning_rate)),
+             columns=np.array(model['feature']))
+    unpack(npz_path)
+    return npz_path
+
+
+def unpack(npz_path, folder=None):
+    """
+    write every array of an npz as its own .npy, the layout load_arrays maps read-only
+    :return: the folder, the npz path without extension by default
+    """
+    folder = folder or os.path.splitext(npz_path)[0]
+    os.makedirs(folder, exist_ok=True)
+    with np.load(npz_path, allow_pickle=False) as data:
+        for key in data.files:
+            np.save(os.path.join(folder, key + '.npy'), data[key], allow_pickle=False)
+    return folder
+
+
+def unpack_all(model_folder=os.path.join(base_path, 'model')):
+    """
+    unpack every npz of model_folder, only the npz are in git, run at build or deploy time for MODEL_MMAP
+    :return: the folders written
+    """
+    return [unpack(os.path.join(model_folder, name)) for name in sorted(os.listdir(model_folder))
+            if name.endswith('.npz')]
+
+
+def load_arrays(path):
+    """
+    :param path: a folder written by unpack, its arrays are memory-mapped read-only so every process serving
+                 the model shares the page cache instead of holding a private copy. or an npz, read into memory
+    :return: {name: array}
+    """
+    if os.path.isdir(path):
+        return dict((name[:-4], np.asarray(np.load(os.path.join(path, name), mmap_mode='r', allow_pickle=False)))
+                    for name in os.listdir(path) if name.endswith('.npy'))
+    with np.load(path, allow_pickle=False) as data:
+        return dict((key, data[key]) for key in data.files)
+
+
+class FlatGbdt(object):
+    """
+    predict_proba of a flattened binary GradientBoostingClassifier, all clips and trees walked at once.
+    the result is bit for bit the one of scikit-learn 0.20: X is compared as float32 against float64
+    thresholds, stages are added one after another to the log odds prior as learning_rate * leaf, then expit.
+    """
+
+    def __init__(self, path):
+        data = load_arrays(path)
+        for key in ('feature', 'threshold', 'left', 'right', 'value', 'roots'):
+            setattr(self, key, data[key])
+        self.max_depth = int(data['max_depth'])
+        self.prior = float(data['prior'])
+        self.learning_rate = float(data['learning_rate'])
+        self.columns = data['columns'].tolist()
+        self.n_features_ = len(self.columns)
+
+    def leaf_values(self, X):
+        """
+        :return: (n_clips, n_trees) float64 value of the leaf each clip reaches in each tree
+        :raise ValueError: X holds nan or inf or values too large for float32, like scikit-learn's check_array
+        """
+        with np.errstate(over='ignore'):
+            X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_:
+            raise ValueError('expected (n_clips, {}) features, got {}'.format(self.n_features_, X.shape))
+        if not np.isfinite(X).all():
+            raise ValueError("Input contains NaN, infinity or a value too large for dtype('float32').")
+        rows = np.arange(len(X))[:, None]
+        node = np.repeat(self.roots[None, :], len(X), 0)
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[node]] <= self.threshold[node]
+            node = np.where(go_left, self.left[node], self.right[node])
+        return self.value[node]
+
+    def decision_function(self, X):
+        leaf = self.leaf_values(X)
+        score = np.full(len(leaf), self.prior, dtype=np.float64)
+        # one add per stage in tree order, a pairwise sum over the trees would round differently
+        for t in range(leaf.shape[1]):
+            score += self.learning_rate * leaf[:, t]
+        return score
+
+    def predict_proba(self, X):
+        proba = np.ones((len(X), 2), dtype=np.float64)
+        proba[:, 1] = expit(self.decision_function(X))
+        proba[:, 0] -= proba[:, 1]
+        return proba
+
+
+def model_path(name, mmap=True):
+    '''
+    the unpacked folder of a model when mmap is set and it exists, see unpack_all, its npz otherwise
+    '''
+    folder = os.path.join(base_path, 'model', name)
+    if mmap and os.path.isdir(folder):
+        return folder
+    return folder + '.npz'
+
+
+def load_model(name, mmap=True):
+    """
+    {'model': FlatGbdt, 'feature': columns}, the layout of the pickled models
+    """
+    model = FlatGbdt(model_path(name, mmap))
+    return {'model': model, 'feature': model.columns}
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import pickle
+    from emotion_model.feature_matrix import read_pcm
+    from emotion_model.rehearsal_emo import features_from_pcm_list
+    # python -m emotion_model.gbdt_flat [n_clips], needs the scikit-learn of requirements.txt
+    n_clips = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    for name in ('beike-male_gbdt-online', 'beike-female_gbdt-online'):
+        pkl_path = os.path.join(base_path, 'model/{}.pkl'.format(name))
+        export(pkl_path)
+        sk = pickle.load(open(pkl_path, 'rb'))['model']
+        flat = load_model(name)['model']
+        # 3s clips of test.wav every 0.25s, and the same rows with noise to reach other branches
+        pcm = read_pcm(os.path.join(base_path, 'test.wav'))
+        _, X = features_from_pcm_list([{'clip_id': str(i), 'pcm': pcm[i:i + 48000]}
+                                       for i in range(0, len(pcm) - 48000, 4000)])
+        noise = np.random.RandomState(0).randn(*X.shape).astype(np.float32)
+        X = np.concatenate([X, X * (1 + 0.2 * noise)])[:n_clips]
+        for label, func in (('sklearn', sk.predict_proba), ('flat', flat.predict_proba)):
+            func(X)
+            start = time.time()
+            func(X)
+            print('{} {:8s} {:.2f}ms for {} clips'.format(name, label, (time.time() - start) * 1000, len(X)))
+        print('bit identical:', np.array_equal(sk.predict_proba(X), flat.predict_proba(X)))
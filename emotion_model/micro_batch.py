@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding: utf-8
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+from backend.utility import g_logger
+
+
+class BatchStats(object):
+    """
+    batch size distribution in power of two buckets of rows, and queueing delay of the submitted requests
+    """
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.rows = 0
+        self.size_buckets = {}
+        self.delays = deque(maxlen=window)
+        self.delay_max = 0.0
+
+    def record(self, rows, delays):
+        bucket = 1
+        while bucket < rows:
+            bucket *= 2
+        with self.lock:
+            self.batches += 1
+            self.rows += rows
+            self.size_buckets[bucket] = self.size_buckets.get(bucket, 0) + 1
+            self.delays.extend(delays)
+            self.delay_max = max([self.delay_max] + delays)
+
+    def info(self):
+        """
+        :return: dict. size_buckets-{upper bound of rows: batches}, delay_*_ms over the last `window` requests
+        """
+        with self.lock:
+            delays = np.array(self.delays) * 1000
+            return {
+                'batches': self.batches,
+                'rows': self.rows,
+                'mean_rows': round(self.rows / self.batches, 2) if self.batches else 0.0,
+                'size_buckets': dict(sorted(self.size_buckets.items())),
+                'delay_p50_ms': round(float(np.percentile(delays, 50)), 3) if len(delays) else 0.0,
+                'delay_p95_ms': round(float(np.percentile(delays, 95)), 3) if len(delays) else 0.0,
+                'delay_max_ms': round(self.delay_max * 1000, 3),
+            }
+
+
+class MicroBatcher(object):
+    """
+    collect feature rows of concurrent requests for one model and score them with one call.
+    a batch is closed when it holds max_rows rows or max_wait seconds after its first request arrived,
+    a single request with more than max_rows rows is scored on its own.
+    """
+
+    def __init__(self, predict, max_rows=256, max_wait=0.01, name='model'):
+        """
+        :param predict: (n, n_features) matrix -> (n,) scores, rows must be scored independently
+        """
+        self.predict = predict
+        self.max_rows = max_rows
+        self.max_wait = max_wait
+        self.name = name
+        self.stats = BatchStats()
+        self.queue = queue.Queue()
+        self._pending = None
+        worker = threading.Thread(target=self._loop, name='micro-batch-{}'.format(name))
+        worker.daemon = True
+        worker.start()
+
+    def submit(self, features):
+        """
+        :return: Future of the (n,) scores of the rows of `features`
+        """
+        future = Future()
+        if len(features) == 0:
+            future.set_result(np.zeros(0))
+            return future
+        self.queue.put((features, future, time.time()))
+        return future
+
+    def _next(self, timeout=None):
+        if self._pending is not None:
+            item, self._pending = self._pending, None
+            return item
+        return self.queue.get(timeout=timeout)
+
+    def _loop(self):
+        while True:
+            batch = [self._next()]
+            rows = len(batch[0][0])
+            deadline = batch[0][2] + self.max_wait
+            while rows < self.max_rows:
+                try:
+                    item = self._next(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if rows + len(item[0]) > self.max_rows:
+                    self._pending = item
+                    break
+                batch.append(item)
+                rows += len(item[0])
+            self._run(batch, rows)
+
+    def _run(self, batch, rows):
+        start = time.time()
+        try:
+            scores = self.predict(np.concatenate([x[0] for x in batch]) if len(batch) > 1 else batch[0][0])
+        except Exception as e:
+            g_logger.error('{} micro batch of {} rows failed: {}'.format(self.name, rows, e))
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        self.stats.record(rows, [start - x[2] for x in batch])
+        offset = 0
+        for features, future, _ in batch:
+            future.set_result(scores[offset:offset + len(features)])
+            offset += len(features)
+
+    def info(self):
+        return dict(self.stats.info(), queued=self.queue.qsize())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import pickle
+import time
+import threading
+from config import Config
+from emotion_model import gbdt_flat, flat_linear
+from emotion_model.feature_matrix import column_index
+
+base_path = os.path.dirname(os.path.realpath(__file__))
+
+
+def _gbdt(name):
+    def load():
+        if Config.GBDT_ENGINE == 'flat':
+            model = gbdt_flat.load_model(name, Config.MODEL_MMAP)
+        else:
+            with open(os.path.join(base_path, 'model/{}.pkl'.format(name)), 'rb') as f:
+                model = pickle.load(f)
+        model['index'] = column_index(model['feature'])
+        return model
+    return load
+
+
+def _linear(name, pkl_path):
+    def load():
+        if Config.GBDT_ENGINE == 'flat':
+            model = flat_linear.load_model(name, Config.MODEL_MMAP)
+        else:
+            with open(pkl_path, 'rb') as f:
+                model = {'model': pickle.load(f), 'feature': None}
+        # all extracted columns, in arff order
+        model['index'] = None
+        return model
+    return load
+
+
+class ModelRegistry(object):
+    """
+    models by name, loaded on first get() and kept for the process. call preload() in the process that forks
+    the workers, gunicorn --preload or its on_starting hook, so the workers start with the models in place.
+    with MODEL_MMAP the node arrays are read-only maps of emotion_model/model/<name>/*.npy: the pages are shared
+    by every process on the host, forked or not, and never copied on write.
+    """
+
+    def __init__(self):
+        self.loaders = {}
+        self.models = {}
+        self.seconds = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, loader):
+        '''
+        loader: called once without arguments, returns {'model': with predict_proba, 'feature': columns or None,
+        'index': column_index of the features or None for all columns, 'threshold': optional, 0.5 otherwise}
+        '''
+        with self.lock:
+            self.loaders[name] = loader
+            self.models.pop(name, None)
+
+    def names(self):
+        return list(self.loaders)
+
+    def get(self, name):
+        model = self.models.get(name)
+        if model is not None:
+            return model
+        with self.lock:
+            if name not in self.models:
+                start = time.time()
+                self.models[name] = self.loaders[name]()
+                self.seconds[name] = time.time() - start
+            return self.models[name]
+
+    def preload(self, names=None):
+        '''
+        :return: seconds spent loading
+        '''
+        start = time.time()
+        for name in names or self.names():
+            self.get(name)
+        return time.time() - start
+
+    def info(self):
+        with self.lock:
+            return dict((name, {'loaded': name in self.models, 'seconds': round(self.seconds.get(name, 0), 4)})
+                        for name in self.loaders)
+
+
+g_models = ModelRegistry()
+g_models.register('beike-male_gbdt-online', _gbdt('beike-male_gbdt-online'))
+g_models.register('beike-female_gbdt-online', _gbdt('beike-female_gbdt-online'))
+g_models.register('round_7', _linear('round_7', os.path.join(base_path, 'round_7.pkl')))
+if Config.MODEL_PRELOAD:
+    g_models.preload()
+
+
+if __name__ == '__main__':
+    # python -m emotion_model.model_registry, at build or deploy time: the npy folders MODEL_MMAP maps
+    for folder in gbdt_flat.unpack_all():
+        print('unpacked', folder)
+    g_models.preload()
+    print(g_models.info())
@@ -4,6 +4,9 @@ import os
 import shutil
 import subprocess
 from backend.utility import g_logger
+from backend.metrics import timed, STEP_SECONDS, RETRIES
+from config import Config
+from emotion_model.smile_batch import opensmiler_batch
 base_path = os.path.dirname(os.path.realpath(__file__))
 
 
@@ -30,10 +33,12 @@ def opensmiler(infile, outfold, config='emobase2010',toolfold=os.path.join(base_
     while not success and retry < max_retry:
         if retry > 0:
             g_logger.info("{}重试第{}次".format(infile, retry))
+            RETRIES.inc(kind='smile')
 
         # if subprocess.call(cmd, shell=True) !=0:
         #     g_logger.error('opensmile extract {} features fail'.format(infile))
-        subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True).communicate()
+        with timed(STEP_SECONDS, step='smile_call'):
+            subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True).communicate()
 
         success = os.path.exists(outfilename)
         retry += 1
@@ -56,9 +61,11 @@ def batch_extract(input_wavs, output_path):
         shutil.rmtree(outfold)
     os.makedirs(outfold)
 
+    opensmiler_batch(list(input_wavs.values()), outfold, config='emobase2010',
+                     batch_size=Config.SMILE_BATCH_SIZE)
     for clip in input_wavs:
         f = input_wavs[clip]
-        txt_file = opensmiler(f, outfold=outfold,config='emobase2010')
+        txt_file = '%s/%s%s' % (outfold, f.split('/')[-1].split('.wav')[0], '.txt')
         if not os.path.exists(txt_file):
             g_logger.warning("提取{}的opensmile特征失败，使用全0特征。".format(clip))
             results[clip] = [float(0)]*1582
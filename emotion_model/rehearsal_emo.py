@@ -1,109 +1,311 @@
 import os
 import re
 import uuid
-import pickle
+import functools
+import struct
+import shutil
+import tempfile
+import threading
 import subprocess
 import numpy as np
 import json
-import pandas as pd
 import multiprocessing
+from config import Config
+from emotion_model.smile_batch import opensmiler_batch, config_path, _outfile
+from emotion_model.feature_cache import get_cache, cached_features, pcm_key, wav_key
+from emotion_model.model_registry import g_models
+from emotion_model.micro_batch import MicroBatcher
+from emotion_model.smile_prune import serving_config
+from emotion_model.feature_matrix import new_matrix, parse_row, last_data_line, read_row, to_frame
+from backend.metrics import timed, STEP_SECONDS
+from backend.profiling import bind
 
 base_path = os.path.dirname(os.path.realpath(__file__))
+SAMPLE_RATE = 16000
+_columns_cache = {}
 
 
 def opensmiler(infile, outfold, config='emobase2010', toolfold='./opensmile-2.3.0/', extension='.txt'):
     '''
     infile: single input file to be extracted
     outfold: where to save the extracted file with the same name
-    config: opensmile config file
+    config: opensmile config name, or the path of a generated one
     toolfold: opensmile tool folder
     extension: ".txt" or ".csv"
     '''
     # tool and config
     tool = os.path.join(toolfold, 'bin/linux_x64_standalone_libstdc6/SMILExtract')
-    config = os.path.join(toolfold, 'config/{}.conf'.format(config))
+    config = config_path(config, toolfold)
 
     # get infile and outfile names
     infilename = infile
     outfilename = os.path.join(outfold, os.path.basename(infile).split('.wav')[0] + extension)
     cmd = '"%s" -C "%s" -I "%s" -O "%s"' % (tool, config, infilename, outfilename)
     # execute
-    subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True).communicate()
+    with timed(STEP_SECONDS, step='smile_call'):
+        subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True).communicate()
     if not os.path.exists(outfilename):
         raise TypeError('something wrong happened')
 
 
+def _read_arff(txt_path):
+    lines = open(txt_path, 'r').readlines()
+    columns = lines[3:-5]
+    features = lines[-1].split(',')[1:-1]
+    return columns, features
+
+
+def _wav_header(n_samples, sample_rate=SAMPLE_RATE):
+    data_size = n_samples * 2
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, 1,
+                       sample_rate, sample_rate * 2, 2, 16, b'data', data_size)
+
+
+def smile_columns(config='emobase2010', toolfold=os.path.join(base_path, 'opensmile-2.3.0')):
+    '''
+    attribute lines of the arff header for a config, resolved once per process.
+    SMILExtract appends to existing outputs without a header, so stdout results carry no column names.
+    '''
+    if config not in _columns_cache:
+        with tempfile.TemporaryDirectory() as tmp:
+            wav_path = os.path.join(tmp, 'header.wav')
+            with open(wav_path, 'wb') as f:
+                f.write(_wav_header(SAMPLE_RATE))
+                f.write(bytes(SAMPLE_RATE * 2))
+            opensmiler(wav_path, tmp, config, toolfold, '.txt')
+            _columns_cache[config] = _read_arff(os.path.join(tmp, 'header.txt'))[0]
+    return _columns_cache[config]
+
+
+def _feed_pcm(stream, pcm):
+    try:
+        stream.write(_wav_header(len(pcm)))
+        stream.write(memoryview(np.ascontiguousarray(pcm)).cast('B'))
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+
+@timed(STEP_SECONDS, step='smile_call')
+def opensmiler_pcm(pcm, config='emobase2010', toolfold=os.path.join(base_path, 'opensmile-2.3.0'), out=None,
+                   positions=None):
+    '''
+    pcm: 16k mono int16 samples of one clip, streamed to SMILExtract's stdin as a wav
+    config: opensmile config name, or the path of a generated one
+    toolfold: opensmile tool folder
+    out: float32 row to parse the features into, a new one if None
+    positions: positions of the config's columns in the row, for the pruned configs of smile_prune
+    return: feature values of the clip, as in the last line of the txt output
+    '''
+    tool = os.path.join(toolfold, 'bin/linux_x64_standalone_libstdc6/SMILExtract')
+    config = config_path(config, toolfold)
+    p = subprocess.Popen([tool, '-C', config, '-I', '/dev/stdin', '-O', '/dev/stdout'],
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    writer = threading.Thread(target=_feed_pcm, args=(p.stdin, pcm))
+    writer.start()
+    out_bytes = p.stdout.read()
+    p.stdout.close()
+    p.wait()
+    writer.join()
+    try:
+        line = last_data_line(out_bytes)
+    except ValueError:
+        raise TypeError('something wrong happened')
+    return parse_row(line, new_matrix(1)[0] if out is None else out, positions)
+
+
+def _cache_config(dtype=np.float32):
+    name = os.path.basename(serving_config()[0]).split('.conf')[0]
+    # float32 rows were cached without a suffix
+    return name if np.dtype(dtype) == np.float32 else name + '/' + np.dtype(dtype).name
+
+
+def features_from_list(wav_list, txt_root, dtype=np.float32):
+    '''
+    dtype: of the matrix, the values are parsed in it. float64 for the linear models, see Emotion.predict
+    return: (clip_ids, matrix) in wav_list order, columns as feature_matrix.COLUMNS
+    '''
+    wav_list = [x for x in wav_list if '.wav' in x]
+    clip_ids = [os.path.basename(x)[:-4] for x in wav_list]
+    if get_cache() is None:
+        return clip_ids, _extract_from_list(wav_list, txt_root, dtype)
+    keys = [wav_key(x, _cache_config(dtype)) for x in wav_list]
+    return clip_ids, cached_features(
+        keys, lambda missed: _extract_from_list([wav_list[i] for i in missed], txt_root, dtype), dtype)
+
+
 def opensmiler_from_list(wav_list, txt_root):
-    os.makedirs(txt_root, exist_ok=True)
+    clip_ids, features = features_from_list(wav_list, txt_root)
+    with timed(STEP_SECONDS, step='feature_frame'):
+        return to_frame(clip_ids, features)
+
+
+def _extract_from_list(wav_list, txt_root, dtype=np.float32):
+    config, positions = serving_config()
+    failed = opensmiler_batch(wav_list, txt_root, config, os.path.join(base_path, 'opensmile-2.3.0'), '.txt',
+                              batch_size=Config.SMILE_BATCH_SIZE)
+    with timed(STEP_SECONDS, step='feature_frame'):
+        features = new_matrix(len(wav_list), dtype)
+        for i, wav_path in enumerate(wav_list):
+            if wav_path in failed:
+                continue
+            txt_path = _outfile(wav_path, txt_root, '.txt')
+            try:
+                read_row(txt_path, features[i], positions)
+            except ValueError:
+                failed[wav_path] = 'no feature line'
+            os.remove(txt_path)
+    shutil.rmtree(txt_root, ignore_errors=True)
+    if len(failed) == len(wav_list):
+        raise TypeError('no opensmil txt generated!')
+    if len(failed) > 0:
+        raise Warning('opensmile extract failed for {} clips!'.format(len(failed)))
+    return features
+
+
+def features_from_pcm_list(clip_list):
+    '''
+    clip_list: [{"clip_id": ..., "pcm": int16 array},], see backend.slice_helper.clip_pcm
+    return: (clip_ids, float32 matrix) like features_from_list, without any wav or txt file on disk
+    '''
+    clip_ids = [x['clip_id'] for x in clip_list]
+    if get_cache() is None:
+        return clip_ids, _extract_from_pcm_list(clip_list)
+    keys = [pcm_key(np.ascontiguousarray(x['pcm'], dtype='<i2').tobytes(), _cache_config()) for x in clip_list]
+    return clip_ids, cached_features(keys, lambda missed: _extract_from_pcm_list([clip_list[i] for i in missed]))
+
+
+def opensmiler_from_pcm_list(clip_list):
+    '''
+    same DataFrame as opensmiler_from_list, without any wav or txt file on disk
+    '''
+    clip_ids, features = features_from_pcm_list(clip_list)
+    with timed(STEP_SECONDS, step='feature_frame'):
+        return to_frame(clip_ids, features)
+
+
+def _extract_from_pcm_list(clip_list):
+    config, positions = serving_config()
+    features = new_matrix(len(clip_list))
     p = multiprocessing.pool.ThreadPool(processes=10)
-    for wav_path in wav_list:
-        p.apply_async(
-            opensmiler, args=(
-                wav_path, txt_root, 'emobase2010',
-                os.path.join(base_path, 'opensmile-2.3.0'),
-                '.txt'
-            )
-        )
+    jobs = [p.apply_async(bind(opensmiler_pcm), args=(x['pcm'], config),
+                          kwds={'out': features[i], 'positions': positions}) for i, x in enumerate(clip_list)]
     p.close()
     p.join()
-    result_list = []
-    for txt_name in os.listdir(txt_root):
-        if '.txt' not in txt_name:
-            continue
-        txt_path = os.path.join(txt_root, txt_name)
-        columns_line = open(txt_path, 'r').readlines()[3:-5]
-        features_line = open(txt_path, 'r').readlines()[-1]
-        columns = columns_line
-        features = features_line.split(',')
-        features = features[1:-1]
-        features = np.array(features)
-        result_list.append(dict([('id', txt_name[:-4])] + list(zip(columns, features))))
-        os.remove(txt_path)
-    os.rmdir(txt_root)
-    if len(result_list) == 0:
+    n_failed = len([x for x in jobs if not x.successful()])
+    if n_failed == len(clip_list):
         raise TypeError('no opensmil txt generated!')
-    target_list = [os.path.basename(x)[:-4] for x in wav_list if '.wav' in x]
-    miss_list = list(set(target_list).difference([x['id'] for x in result_list]))
-    if len(miss_list) > 0:
-        raise Warning('opensmile extract failed for {} clips!'.format(len(miss_list)))
-    result_df = pd.DataFrame(result_list)
-    return result_df
+    if n_failed > 0:
+        raise Warning('opensmile extract failed for {} clips!'.format(n_failed))
+    return features
+
+
+def _clip_id(clip):
+    if 'clip_id' in clip:
+        return clip['clip_id']
+    return os.path.basename(clip['wav_path'])[:-4]
+
+
+@timed(STEP_SECONDS, step='predict')
+def _predict(model, features):
+    if model.get('index') is None:
+        return model['model'].predict_proba(features)[:, 1]
+    return model['model'].predict_proba(features[:, model['index']])[:, 1]
+
+
+def _result(input_list, clip_ids, probe_result, threshold):
+    probe_dict = dict(zip(clip_ids, probe_result))
+    flag_dict = dict(zip(clip_ids, [int(x > threshold) for x in probe_result]))
+    output_list = [
+        {
+            'begin_time': x['begin_time'], 'end_time': x['end_time'],
+            'score': probe_dict.get(_clip_id(x), -1),
+            'label': flag_dict.get(_clip_id(x), -1)
+        } for x in input_list
+    ]
+    if len([x for x in output_list if x['score'] != -1]) > 0:
+        total_score = np.mean([x['score'] for x in output_list if x['score'] != -1])
+        total_label = int(total_score > threshold)
+    else:
+        total_score = -1
+        total_label = -1
+    return {'segment': output_list, 'total': {'score': total_score, 'label': total_label}}
 
 
 class rehearsal_emo(object):
+    # the models come from model_registry on first use, importing this module loads nothing
+    MODELS = {0: 'beike-female_gbdt-online', 1: 'beike-male_gbdt-online'}
+
     def __init__(self):
-        self.male_model = pickle.load(open(os.path.join(base_path, 'model/beike-male_gbdt-online.pkl'), 'rb'))
-        self.female_model = pickle.load(open(os.path.join(base_path, 'model/beike-female_gbdt-online.pkl'), 'rb'))
         self.threshold = 0.5
+        self.batchers = {}
+        self.lock = threading.Lock()
 
-    def inference(self, input_list, is_male=0):
-        wav_list = [x['wav_path'] for x in input_list]
-        uid = uuid.uuid1()
-        op_features = opensmiler_from_list(wav_list, os.path.join(base_path, 'tmp/{}'.format(uid)))
+    @property
+    def male_model(self):
+        return g_models.get(self.MODELS[1])
+
+    @property
+    def female_model(self):
+        return g_models.get(self.MODELS[0])
+
+    def _batcher(self, is_male):
+        with self.lock:
+            if is_male not in self.batchers:
+                self.batchers[is_male] = MicroBatcher(
+                    functools.partial(_predict, g_models.get(self.MODELS[is_male])), Config.MICRO_BATCH_ROWS,
+                    Config.MICRO_BATCH_WAIT_MS / 1000.0, 'male' if is_male else 'female')
+            return self.batchers[is_male]
+
+    def predict(self, features, is_male=0):
+        '''
+        features: float32 matrix of features_from_list, rows of concurrent calls are scored together
+        if Config.MICRO_BATCH is on
+        return: probability of every row
+        '''
         if is_male == 0:
-            probe_result = self.female_model['model'].predict_proba(op_features[self.female_model['feature']])[:, 1]
+            model = self.female_model
         elif is_male == 1:
-            probe_result = self.male_model['model'].predict_proba(op_features[self.male_model['feature']])[:, 1]
+            model = self.male_model
         else:
             raise ValueError('parameter for is_male shoud be 0 or 1!')
-        probe_dict = dict(zip(op_features['id'].tolist(), probe_result))
-        flag_dict = dict(zip(op_features['id'].tolist(), [int(x > self.threshold) for x in probe_result]))
-        output_list = [
-            {
-                'begin_time': x['begin_time'], 'end_time': x['end_time'],
-                'score': probe_dict.get(os.path.basename(x['wav_path'])[:-4], -1),
-                'label': flag_dict.get(os.path.basename(x['wav_path'])[:-4], -1)
-            } for x in input_list
-        ]
-        if len([x for x in output_list if x['score'] != -1]) > 0:
-            total_score = np.mean([x['score'] for x in output_list if x['score'] != -1])
-            total_label = int(total_score > self.threshold)
-        else:
-            total_score = -1
-            total_label = -1
-        result = {'segment': output_list, 'total': {'score': total_score, 'label': total_label}}
+        if Config.MICRO_BATCH:
+            return self._batcher(is_male).submit(features).result()
+        return _predict(model, features)
+
+    def inference(self, input_list, is_male=0, txt_root=None):
+        '''
+        txt_root: folder for the opensmile output of wav clips, removed afterwards. a new one under
+        emotion_model/tmp when not given
+        '''
+        return self.score_all(input_list, is_male, (), txt_root)['emotion']
 
-        return result
+    def score_all(self, input_list, is_male=0, models=(), txt_root=None):
+        '''
+        extract the features of the clips once and score them with the gender model and every model named in
+        `models`, registered in model_registry. a shadow or candidate model costs a predict_proba, not another
+        opensmile pass
+        return: {'emotion': result of the gender model, 'models': {name: result}}, 'models' only if any are
+        named. a result is {'segment': [{'begin_time', 'end_time', 'score', 'label'},], 'total': {'score', 'label'}}
+        '''
+        if len(input_list) > 0 and 'pcm' in input_list[0]:
+            clip_ids, features = features_from_pcm_list(input_list)
+        else:
+            wav_list = [x['wav_path'] for x in input_list]
+            txt_root = txt_root or os.path.join(base_path, 'tmp/{}'.format(uuid.uuid1()))
+            clip_ids, features = features_from_list(wav_list, txt_root)
+        output = {'emotion': _result(input_list, clip_ids, self.predict(features, is_male), self.threshold)}
+        if models:
+            output['models'] = {}
+            for name in models:
+                model = g_models.get(name)
+                output['models'][name] = _result(input_list, clip_ids, _predict(model, features),
+                                                 model.get('threshold', self.threshold))
+        return output
 
 
 RehearsalEmo = rehearsal_emo()
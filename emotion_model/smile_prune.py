@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import numpy as np
+from config import Config
+from backend.utility import g_logger
+from emotion_model.smile_batch import load_config, parse_sections, config_path, default_toolfold, _instance_pattern
+from emotion_model.feature_matrix import COLUMNS, column_index
+from emotion_model.model_registry import g_models
+
+base_path = os.path.dirname(os.path.realpath(__file__))
+FULL_CONFIG = 'emobase2010'
+
+_contour_pattern = re.compile(r'^(.*?)(_de)?(?:\[(\d+)\])?$')
+# contour of a column -> the cFunctionals component of its functionals
+_CONTOURS = {
+    'pcm_loudness_sma': 'functL1', 'pcm_fftMag_mfcc_sma': 'functL1', 'logMelFreqBand_sma': 'functL1',
+    'lspFreq_sma': 'functL1', 'F0finEnv_sma': 'functL1', 'voicingFinalUnclipped_sma': 'functL1',
+    'F0final_sma': 'functL1nz', 'jitterLocal_sma': 'functL1nz', 'jitterDDP_sma': 'functL1nz',
+    'shimmerLocal_sma': 'functL1nz', 'F0final__Turn': 'functOnsets',
+}
+# contours that are one output of their component and can be switched off when unused. the deltas are all kept,
+# and one output of the pitch levels: the functionals see the shortest level, leaving it out changes every value
+_FLAGS = {
+    'voicingFinalUnclipped_sma': ('pitchSmooth', 'voicingFinalUnclipped'),
+    'jitterLocal_sma': ('pitchJitter', 'jitterLocal'),
+    'jitterDDP_sma': ('pitchJitter', 'jitterDDP'),
+    'shimmerLocal_sma': ('pitchJitter', 'shimmerLocal'),
+}
+_OUTPUTS = {
+    'pitchSmooth': ('F0raw', 'F0final', 'F0finalEnv', 'voicingFinalUnclipped'),
+    'pitchJitter': ('jitterLocal', 'jitterDDP', 'jitterLocalEnv', 'jitterDDPEnv', 'shimmerLocal', 'shimmerLocalEnv'),
+}
+# contour -> the level a contour smoother reads it from. a smoother drops the levels no column uses but keeps
+# the ones in _SMOOTHERS, the pitch levels framed at 40ms have the fewest frames, see check()
+_LEVELS = {
+    'pcm_loudness_sma': 'intens', 'pcm_fftMag_mfcc_sma': 'mfcc', 'logMelFreqBand_sma': 'mspec2log',
+    'lspFreq_sma': 'lsp', 'F0finEnv_sma': 'pitch', 'voicingFinalUnclipped_sma': 'pitch',
+    'F0final_sma': 'pitchF', 'jitterLocal_sma': 'jitter', 'jitterDDP_sma': 'jitter', 'shimmerLocal_sma': 'jitter',
+}
+_SMOOTHERS = {'lld': ('pitch',), 'lld2': ('pitchF',)}
+# functional of a column -> cFunctionals option that enables it, percentile<p> is the Percentiles.percentile list
+_FUNCTIONALS = {
+    'maxPos': 'Extremes.maxpos', 'minPos': 'Extremes.minpos', 'amean': 'Extremes.amean',
+    'linregc1': 'Regression.linregc1', 'linregc2': 'Regression.linregc2',
+    'linregerrA': 'Regression.linregerrA', 'linregerrQ': 'Regression.linregerrQ',
+    'stddev': 'Moments.stddev', 'skewness': 'Moments.skewness', 'kurtosis': 'Moments.kurtosis',
+    'quartile1': 'Percentiles.quartiles', 'quartile2': 'Percentiles.quartiles', 'quartile3': 'Percentiles.quartiles',
+    'iqr1-2': 'Percentiles.iqr', 'iqr2-3': 'Percentiles.iqr', 'iqr1-3': 'Percentiles.iqr',
+    'pctlrange0-1': 'Percentiles.pctlrange',
+    'upleveltime75': 'Times.upleveltime75', 'upleveltime90': 'Times.upleveltime90', 'duration': 'Times.duration',
+    'numOnsets': 'Onset.numOnsets',
+}
+
+
+def _parse_column(column):
+    '''
+    '@attribute pcm_fftMag_mfcc_sma_de[4]_iqr1-2 numeric' -> ('pcm_fftMag_mfcc_sma', True, 4, 'iqr1-2')
+    '''
+    contour, functional = column.split()[1].rsplit('_', 1)
+    m = _contour_pattern.match(contour)
+    return m.group(1), bool(m.group(2)), None if m.group(3) is None else int(m.group(3)), functional
+
+
+def _split_columns(model):
+    '''
+    columns a tree ensemble compares, all feature columns of any other model
+    '''
+    clf = model['model']
+    if hasattr(clf, 'roots'):
+        # FlatGbdt, a leaf points at itself
+        used = clf.feature[clf.left != np.arange(len(clf.left))]
+    elif hasattr(clf, 'estimators_'):
+        used = np.concatenate([x.tree_.feature[x.tree_.children_left != -1] for x in np.ravel(clf.estimators_)])
+    else:
+        return set(model['feature'])
+    return set(model['feature'][i] for i in np.unique(used))
+
+
+def used_columns(names):
+    '''
+    :param names: models of model_registry
+    :return: the columns of COLUMNS they read, all of them if any model has no feature list
+    '''
+    used = set()
+    for name in names:
+        model = g_models.get(name)
+        if model.get('index') is None:
+            return list(COLUMNS)
+        used |= _split_columns(model)
+    return [x for x in COLUMNS if x in used]
+
+
+def _options(body):
+    options, comment = [], False
+    for line in body:
+        # parse_sections keeps the lines of /* */ blocks
+        if line.startswith('/*') or line.startswith('*/'):
+            comment = line.startswith('/*')
+        elif not comment:
+            options.append([line.partition('=')[0].strip(), line.partition('=')[2].strip()])
+    return options
+
+
+def _set(options, key, value):
+    for option in options:
+        if option[0] == key:
+            option[1] = value
+
+
+def _get(options, key):
+    return dict(options).get(key)
+
+
+def _prune_functionals(options, functionals):
+    '''
+    switch off every functional of one cFunctionals component that no column uses, and groups left empty
+    '''
+    enabled = set(_FUNCTIONALS[x] for x in functionals if x in _FUNCTIONALS)
+    for key, value in options:
+        if key in _FUNCTIONALS.values() and value == '1' and key not in enabled:
+            _set(options, key, '0')
+    percentiles = _get(options, 'Percentiles.percentile')
+    if percentiles and 'Percentiles.pctlrange' not in enabled:
+        # pctlrange counts in the list, without it only the used percentiles are kept
+        kept = [x for x in percentiles.split(';') if 'percentile{:.1f}'.format(float(x) * 100) in functionals]
+        if kept:
+            _set(options, 'Percentiles.percentile', ';'.join(kept))
+            enabled.add('Percentiles.percentile')
+        else:
+            options[:] = [x for x in options if x[0] != 'Percentiles.percentile']
+        options[:] = [x for x in options if x[0] != 'Percentiles.pctlrange']
+    elif percentiles:
+        enabled.add('Percentiles.percentile')
+    groups = [x for x in _get(options, 'functionalsEnabled').split(';')
+              if any(y.startswith(x + '.') for y in enabled)]
+    _set(options, 'functionalsEnabled', ';'.join(groups))
+
+
+def config_name(columns):
+    '''
+    name of the pruned config of a column set, the full config when it needs every column
+    '''
+    if set(columns) >= set(COLUMNS):
+        return FULL_CONFIG
+    digest = hashlib.sha1(''.join(sorted(columns)).encode('utf-8')).hexdigest()[:8]
+    return '{}_p{}'.format(FULL_CONFIG, digest)
+
+
+def generate(columns, folder=None, toolfold=default_toolfold):
+    '''
+    write an emobase2010 variant into `folder` that computes only what `columns` need: unused functionals,
+    contours, mfccs and the components feeding only them are left out. the columns it outputs are a superset of
+    `columns`, in their emobase2010 order, the others are not written at all. run at build or deploy time, and
+    check() the result before serving it
+    :param columns: '@attribute ... numeric' lines of feature_matrix.COLUMNS
+    :param folder: Config.SMILE_PRUNE_DIR by default, never the config folder of the package
+    :return: path of the config for the -C option of SMILExtract, FULL_CONFIG when nothing can be left out
+    '''
+    name = config_name(columns)
+    if name == FULL_CONFIG:
+        return name
+    folder = folder or Config.SMILE_PRUNE_DIR
+    conf_path = os.path.join(folder, '{}.conf'.format(name))
+    parsed = [_parse_column(x) for x in columns]
+    sections = parse_sections(load_config(config_path(FULL_CONFIG, toolfold)))
+    options = dict((x[0], _options(x[2])) for x in sections)
+    original = dict((x[0], _options(x[2])) for x in sections)
+
+    functionals, elements = {}, {}
+    for contour, _, element, functional in parsed:
+        functionals.setdefault(_CONTOURS[contour], set()).add(functional)
+        elements.setdefault(contour, set()).add(element)
+    for component in functionals:
+        _prune_functionals(options[component], functionals[component])
+    for contour, (component, option) in sorted(_FLAGS.items()):
+        if contour not in elements:
+            _set(options[component], option, '0')
+    for component, outputs in _OUTPUTS.items():
+        # a component keeps one output, its level still counts in the frames of the smoother
+        if all(_get(options[component], x) != '1' for x in outputs):
+            _set(options[component], min(y for x, y in _FLAGS.values() if x == component), '1')
+    for smoother, levels in _SMOOTHERS.items():
+        _set(options[smoother], 'reader.dmLevel', ';'.join(
+            x for x in _get(options[smoother], 'reader.dmLevel').split(';')
+            if x in levels or any(_LEVELS.get(y) == x for y in elements)))
+    mfcc = [x for x in elements.get('pcm_fftMag_mfcc_sma', ()) if x is not None]
+    if mfcc:
+        first, last = min(mfcc), max(mfcc)
+        if first == last:
+            # a single coefficient is written without its [n], keep a neighbour for the column names
+            first, last = (first, last + 1) if last < int(_get(original['mfcc'], 'lastMfcc')) else (first - 1, last)
+        _set(options['mfcc'], 'firstMfcc', str(first))
+        _set(options['mfcc'], 'lastMfcc', str(last))
+    writers = dict((_get(options[x], 'writer.dmLevel'), x) for x in functionals)
+    sink = [x[0] for x in sections if x[1] == 'cArffSink'][0]
+    _set(options[sink], 'reader.dmLevel', ';'.join(
+        x for x in _get(options[sink], 'reader.dmLevel').split(';') if x in writers))
+
+    # keep the components the sink reads from, directly or through other components
+    writer_of = dict((_get(options[x[0]], 'writer.dmLevel'), x[0]) for x in sections if x[0] != 'componentInstances')
+    needed, todo = set(), [sink]
+    while todo:
+        component = todo.pop()
+        if component in needed:
+            continue
+        needed.add(component)
+        for key, value in options[component]:
+            if key.endswith('reader.dmLevel'):
+                todo += [writer_of[x] for x in value.split(';') if x in writer_of]
+
+    manager = [x[2] for x in sections if x[0] == 'componentInstances'][0]
+    instances = [m.group(1) for m in (_instance_pattern.match(x) for x in manager) if m]
+    if options == original and all(x in needed for x in instances if x != 'dataMemory'):
+        g_logger.info('smile_prune: every component and functional of {} is used'.format(FULL_CONFIG))
+        return FULL_CONFIG
+    lines = ['// generated by emotion_model/smile_prune.py from {}.conf, do not edit'.format(FULL_CONFIG),
+             '// {} of {} columns'.format(len(columns), len(COLUMNS))]
+    for component, component_type, body in sections:
+        if component == 'componentInstances':
+            lines.append('[{}:{}]'.format(component, component_type))
+            for line in body:
+                m = _instance_pattern.match(line)
+                if not m or m.group(1) == 'dataMemory' or m.group(1) in needed:
+                    lines.append(line)
+        elif component in needed:
+            lines.append('[{}:{}]'.format(component, component_type))
+            lines += ['{} = {}'.format(k, v) for k, v in options[component]]
+    os.makedirs(folder, exist_ok=True)
+    if os.path.exists(_record_path(conf_path)):
+        # checked for an earlier version of the config
+        os.remove(_record_path(conf_path))
+    tmp_path = '{}.{}'.format(conf_path, os.getpid())
+    with open(tmp_path, 'w', encoding='latin-1') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, conf_path)
+    g_logger.info('smile_prune: wrote {} for {} of {} columns, {} of {} components'.format(
+        conf_path, len(columns), len(COLUMNS), len(needed), len(sections) - 1))
+    return conf_path
+
+
+def _read_pcm(wav_path, seconds):
+    from emotion_model.feature_matrix import read_pcm
+    return read_pcm(wav_path)[:int(seconds * 16000)]
+
+
+def check(config, columns, wav_path=os.path.join(base_path, 'test.wav'), seconds=(1.5, 6, 20)):
+    '''
+    run the full and the pruned config on the first seconds of wav_path, for each length of `seconds`
+    :return: positions of the pruned columns in COLUMNS if they cover `columns` with identical values, else None
+    '''
+    from emotion_model.rehearsal_emo import opensmiler_pcm, smile_columns
+    try:
+        pruned_columns = smile_columns(config)
+    except TypeError:
+        g_logger.error('smile_prune: SMILExtract failed with {}'.format(config))
+        return None
+    if not set(pruned_columns) >= set(columns):
+        g_logger.error('smile_prune: {} misses {} columns'.format(config, len(set(columns) - set(pruned_columns))))
+        return None
+    positions = column_index(pruned_columns)
+    index = column_index(columns)
+    for length in seconds:
+        pcm = _read_pcm(wav_path, length)
+        full = opensmiler_pcm(pcm, FULL_CONFIG)
+        pruned = opensmiler_pcm(pcm, config, positions=positions)
+        if not np.array_equal(full[index], pruned[index]):
+            g_logger.error('smile_prune: {} differs from {} on {} columns of a {}s clip'.format(
+                config, FULL_CONFIG, int((full[index] != pruned[index]).sum()), length))
+            return None
+    return positions
+
+
+def _record_path(conf_path):
+    return conf_path.split('.conf')[0] + '.json'
+
+
+def record(conf_path, positions):
+    '''
+    mark a generated config as checked, with the positions of its columns, for serving_config()
+    '''
+    tmp_path = '{}.{}'.format(_record_path(conf_path), os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump({'positions': [int(x) for x in positions]}, f)
+    os.replace(tmp_path, _record_path(conf_path))
+
+
+def checked_config(columns, folder=None):
+    '''
+    :return: (path, positions) of the pruned config of `columns` if it was generated and passed check(), else None
+    '''
+    conf_path = os.path.join(folder or Config.SMILE_PRUNE_DIR, '{}.conf'.format(config_name(columns)))
+    try:
+        with open(_record_path(conf_path)) as f:
+            positions = np.array(json.load(f)['positions'], dtype=np.intp)
+    except (OSError, ValueError, KeyError):
+        return None
+    if not os.path.exists(conf_path):
+        return None
+    return conf_path, positions
+
+
+def serving_models():
+    '''
+    every model of model_registry, they all score the features of the shared extraction: the gender models,
+    FAN_OUT_MODELS and round_7 of Emotion.predict
+    '''
+    return sorted(g_models.names())
+
+
+_serving = None
+_serving_lock = threading.Lock()
+
+
+def serving_config():
+    '''
+    the config SMILExtract runs with in serving, resolved once per process: with SMILE_PRUNE the pruned config
+    of serving_models() if `python -m emotion_model.smile_prune` wrote and checked it, nothing is generated or
+    checked here
+    :return: (config name or path, positions of its columns in COLUMNS or None for all of them)
+    '''
+    global _serving
+    with _serving_lock:
+        if _serving is None:
+            _serving = (FULL_CONFIG, None)
+            if Config.SMILE_PRUNE:
+                columns = used_columns(serving_models())
+                if config_name(columns) != FULL_CONFIG:
+                    checked = checked_config(columns)
+                    if checked is None:
+                        g_logger.warning('smile_prune: no checked config for {} columns in {}, run `python -m '
+                                         'emotion_model.smile_prune` at deploy'.format(len(columns),
+                                                                                       Config.SMILE_PRUNE_DIR))
+                    else:
+                        _serving = checked
+                g_logger.info('smile_prune: serving {}, {} of {} columns used'.format(
+                    _serving[0], len(columns), len(COLUMNS)))
+    return _serving
+
+
+def cpu_seconds(config, pcm, rounds=5, positions=None):
+    '''
+    SMILExtract cpu time of one clip, user and system of the child processes
+    '''
+    from emotion_model.rehearsal_emo import opensmiler_pcm
+    before = os.times()
+    for _ in range(rounds):
+        opensmiler_pcm(pcm, config, positions=positions)
+    after = os.times()
+    return (after.children_user + after.children_system - before.children_user - before.children_system) / rounds
+
+
+if __name__ == '__main__':
+    import sys
+    # python -m emotion_model.smile_prune [model ...], at build or deploy time: writes the pruned config of the
+    # serving models into SMILE_PRUNE_DIR and records it for SMILE_PRUNE=1 if it passes check()
+    names = sys.argv[1:] or serving_models()
+    columns = used_columns(names)
+    print('{}: {} of {} columns'.format(', '.join(names), len(columns), len(COLUMNS)))
+    config = generate(columns)
+    if config == FULL_CONFIG:
+        print('every contour and functional is used, nothing to prune')
+        sys.exit(0)
+    start = time.time()
+    positions = check(config, columns)
+    print('{} check: {} ({:.2f}s)'.format(config, 'ok' if positions is not None else 'FAILED', time.time() - start))
+    if positions is None:
+        sys.exit(1)
+    record(config, positions)
+    pcm = _read_pcm(os.path.join(base_path, 'test.wav'), 3)
+    full, pruned = cpu_seconds(FULL_CONFIG, pcm, 20), cpu_seconds(config, pcm, 20, positions)
+    print('cpu per 3s clip: {} {:.3f}s, pruned {:.3f}s, {:.0%} saved'.format(
+        FULL_CONFIG, full, pruned, 1 - pruned / full))
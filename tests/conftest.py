@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import sys
+
+# the modules import each other as `config`, `backend.x` and `emotion_model.x`, from the repo root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
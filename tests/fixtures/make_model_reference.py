@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+writes model_reference.npz, the inputs and predict_proba of the pickled models the flat models are checked
+against. run from the repo root with the packages of requirements.txt, scikit-learn 0.20, and SMILExtract:
+python tests/fixtures/make_model_reference.py
+"""
+import os
+import sys
+import wave
+import pickle
+import shutil
+import tempfile
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+
+from emotion_model.smile_batch import opensmiler_batch, _outfile
+from emotion_model.feature_matrix import COLUMNS, last_data_line
+
+GBDT = ('beike-male_gbdt-online', 'beike-female_gbdt-online')
+
+
+def features(wav_path, n_clips=24, seconds=3):
+    """
+    full emobase2010 rows of n_clips clips of wav_path, parsed as float64
+    """
+    with wave.open(wav_path) as f:
+        pcm = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+    folder = tempfile.mkdtemp()
+    try:
+        wav_list = []
+        for i, start in enumerate(np.linspace(0, len(pcm) - seconds * 16000, n_clips).astype(int)):
+            wav_list.append(os.path.join(folder, 'c{}.wav'.format(i)))
+            with wave.open(wav_list[-1], 'wb') as f:
+                f.setnchannels(1)
+                f.setsampwidth(2)
+                f.setframerate(16000)
+                f.writeframes(pcm[start:start + seconds * 16000].tobytes())
+        failed = opensmiler_batch(wav_list, folder, 'emobase2010', batch_size=1)
+        assert not failed, failed
+        rows = []
+        for wav_path in wav_list:
+            with open(_outfile(wav_path, folder, '.txt'), 'rb') as f:
+                line = last_data_line(f.read()).decode('latin-1')
+            rows.append([float(x) for x in line[line.index(',') + 1:line.rindex(',')].split(',')])
+        return np.array(rows, dtype=np.float64)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def main(out=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_reference.npz')):
+    real = features(os.path.join(ROOT, 'emotion_model', 'test.wav'))
+    # the same rows with noise, to reach other branches of the trees
+    noise = np.random.RandomState(0).randn(*real.shape)
+    x = np.concatenate([real, real * (1 + 0.2 * noise)])
+    reference = {'x': x}
+    for name in GBDT:
+        with open(os.path.join(ROOT, 'emotion_model', 'model', name + '.pkl'), 'rb') as f:
+            model = pickle.load(f)
+        assert list(model['feature']) == COLUMNS
+        reference[name] = model['model'].predict_proba(x.astype(np.float32))
+    with open(os.path.join(ROOT, 'emotion_model', 'round_7.pkl'), 'rb') as f:
+        reference['round_7'] = pickle.load(f).predict_proba(x)
+    np.savez_compressed(out, **reference)
+    return out
+
+
+if __name__ == '__main__':
+    print(main())
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# coding: utf-8
+from backend.app import create_app
+from config import Config
+
+
+def test_metrics_registered():
+    client = create_app().test_client()
+    response = client.get(Config.APP_URL + '/metrics')
+    assert response.status_code == 200 and response.content_type.startswith('text/plain')
+    assert b'# TYPE' in response.data
+
+
+def test_load_registered():
+    response = create_app().test_client().get(Config.APP_URL + '/load')
+    assert response.status_code == 200
+    assert {'load', 'capacity', 'inflight', 'retry_after'} <= set(response.get_json())
+
+
+def test_live_registered(monkeypatch):
+    from backend import live_session
+    monkeypatch.setattr(live_session, '_manager', live_session.SessionManager(workers=1))
+    client = create_app().test_client()
+    session_id = client.post(Config.APP_URL + '/live', json={'gender': 1}).get_json()['sessionId']
+    response = client.get(Config.APP_URL + '/live/{}/events'.format(session_id))
+    assert response.get_json() == {'sessionId': session_id, 'events': []}
+    assert client.post(Config.APP_URL + '/live/{}/close'.format(session_id)).status_code == 200
+    assert client.get(Config.APP_URL + '/live/unknown/events').status_code == 400
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import multiprocessing
+import numpy as np
+from emotion_model.feature_cache import FeatureCache
+
+
+def _folder_bytes(folder):
+    return sum(os.path.getsize(os.path.join(folder, x)) for x in os.listdir(folder) if x.endswith('.npy'))
+
+
+def _fill(folder, max_bytes, worker, n):
+    cache = FeatureCache(folder, max_bytes)
+    for i in range(n):
+        cache.put('w{}_{}'.format(worker, i), np.full(1582, i, dtype=np.float32))
+
+
+def test_shared_folder_bound(tmp_path):
+    folder = str(tmp_path)
+    # room for about 40 rows of 6.4KB, four workers writing 50 each
+    max_bytes = 40 * 6456
+    workers = [multiprocessing.Process(target=_fill, args=(folder, max_bytes, k, 50)) for k in range(4)]
+    for x in workers:
+        x.start()
+    for x in workers:
+        x.join()
+        assert x.exitcode == 0
+    # a worker only sees the others' writes when it scans, every 10% of the bound it wrote
+    assert _folder_bytes(folder) <= 1.4 * max_bytes
+    FeatureCache(folder, max_bytes)
+    assert _folder_bytes(folder) <= max_bytes
+
+
+def test_hit_from_other_worker_and_lru(tmp_path):
+    folder = str(tmp_path)
+    row = np.arange(1582, dtype=np.float32)
+    # scan_seconds=0 lists the folder on every put, so one sees what two wrote
+    one, two = FeatureCache(folder, 3 * 6456, scan_seconds=0), FeatureCache(folder, 3 * 6456, scan_seconds=0)
+    one.put('a', row)
+    np.testing.assert_array_equal(two.get('a'), row)
+    os.utime(os.path.join(folder, 'a.npy'), (1, 1))
+    for key in 'bc':
+        two.put(key, row)
+    # 'a' is the least recently used and goes first
+    os.utime(os.path.join(folder, 'b.npy'), (2, 2))
+    one.put('d', row)
+    assert sorted(os.listdir(folder)) == ['c.npy', 'd.npy']
+    assert one.get('a') is None
+
+
+def test_float64_rows_keep_their_dtype(tmp_path):
+    cache = FeatureCache(str(tmp_path), 1 << 20)
+    cache.put('x', np.full(4, 0.1))
+    assert cache.get('x').dtype == np.float64 and cache.get('x')[0] == 0.1
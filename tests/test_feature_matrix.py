@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding: utf-8
+import wave
+import warnings
+import numpy as np
+import pytest
+
+from emotion_model.feature_matrix import COLUMNS, parse_row, last_data_line, read_pcm
+
+
+def test_parse_row():
+    out = np.zeros(3, dtype=np.float32)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        parse_row(b"'noname',1.5,-2.000000e-03,7,?", out)
+    assert out.tolist() == [1.5, np.float32(-2e-3), 7.0]
+    row = parse_row("'noname',4,5,?", np.zeros(4), positions=[3, 0])
+    assert row[3] == 4 and row[0] == 5 and np.isnan(row[1:3]).all()
+
+
+def test_parse_row_errors():
+    with pytest.raises(ValueError):
+        parse_row("'noname',1,2,?", np.zeros(3))
+    with pytest.raises(ValueError):
+        parse_row("'noname',1,x,3,?", np.zeros(3))
+    with pytest.raises(ValueError):
+        last_data_line(b'@relation x\n\n@data\n\n')
+    assert last_data_line(b"@data\n\n'a',1,?\n") == b"'a',1,?"
+
+
+def test_columns():
+    assert len(COLUMNS) == len(set(COLUMNS)) == 1582
+    assert COLUMNS[0] == '@attribute pcm_loudness_sma_maxPos numeric\n'
+    assert COLUMNS[-1] == '@attribute F0final__Turn_duration numeric\n'
+    assert '@attribute pcm_fftMag_mfcc_sma_de[14]_upleveltime90 numeric\n' in COLUMNS
+
+
+def test_read_pcm(tmp_path):
+    pcm = np.array([0, 1, -1, 32767, -32768], dtype=np.int16)
+    for channels, ok in ((1, True), (2, False)):
+        path = str(tmp_path / '{}.wav'.format(channels))
+        with wave.open(path, 'wb') as f:
+            f.setnchannels(channels)
+            f.setsampwidth(2)
+            f.setframerate(16000)
+            f.writeframes(np.repeat(pcm, channels).tobytes())
+        if ok:
+            assert read_pcm(path).dtype == np.int16 and read_pcm(path).tolist() == pcm.tolist()
+        else:
+            with pytest.raises(ValueError):
+                read_pcm(path)
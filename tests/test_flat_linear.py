@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import numpy as np
+import pytest
+from emotion_model import flat_linear, gbdt_flat
+
+# inputs and scikit-learn 0.20 probabilities of round_7.pkl, see fixtures/make_model_reference.py
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'model_reference.npz')
+
+
+@pytest.fixture(scope='module')
+def reference():
+    with np.load(REFERENCE, allow_pickle=False) as data:
+        return data['x'], data['round_7']
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_matches_sklearn(reference, mmap, tmp_path):
+    path = gbdt_flat.model_path('round_7', mmap=False)
+    if mmap:
+        # the folders are written at deploy time, not kept in git
+        path = gbdt_flat.unpack(path, str(tmp_path / 'round_7'))
+    x, proba = reference
+    model = flat_linear.FlatLogistic(path)
+    # the dot product may sum in another order than the blas scikit-learn used, the last bits can differ
+    np.testing.assert_allclose(model.predict_proba(x), proba, rtol=1e-12, atol=1e-15)
+    assert ((model.predict_proba(x)[:, 1] > 0.5) == (proba[:, 1] > 0.5)).all()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import numpy as np
+import pytest
+from emotion_model import gbdt_flat
+
+# inputs and scikit-learn 0.20 probabilities of the pickled models, see fixtures/make_model_reference.py
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'model_reference.npz')
+
+
+@pytest.fixture(scope='module')
+def reference():
+    with np.load(REFERENCE, allow_pickle=False) as data:
+        return dict((key, data[key]) for key in data.files)
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+@pytest.mark.parametrize('name', ['beike-male_gbdt-online', 'beike-female_gbdt-online'])
+def test_matches_sklearn(reference, name, mmap, tmp_path):
+    path = gbdt_flat.model_path(name, mmap=False)
+    if mmap:
+        # the folders are written at deploy time, not kept in git
+        path = gbdt_flat.unpack(path, str(tmp_path / name))
+    model = gbdt_flat.FlatGbdt(path)
+    x = reference['x'].astype(np.float32)
+    np.testing.assert_array_equal(model.predict_proba(x), reference[name])
+    # one clip at a time like the micro batcher's smallest batch
+    np.testing.assert_array_equal(model.predict_proba(x[:1]), reference[name][:1])
+
+
+@pytest.mark.parametrize('bad', [np.nan, np.inf, -np.inf, 1e39])
+def test_rejects_non_finite(reference, bad):
+    model = gbdt_flat.load_model('beike-male_gbdt-online')['model']
+    x = reference['x'][:4].copy()
+    x[2, 100] = bad
+    with pytest.raises(ValueError):
+        model.predict_proba(x)
+
+
+def test_rejects_wrong_width(reference):
+    model = gbdt_flat.load_model('beike-male_gbdt-online')['model']
+    with pytest.raises(ValueError):
+        model.predict_proba(reference['x'][:, :-1])
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding: utf-8
+import time
+import threading
+import pytest
+
+from backend import utility
+from backend.http_client import HttpClient
+from backend.utility import EvaEx, Const, http_download
+
+
+class FakeResponse(object):
+    def __init__(self, chunks, length=None):
+        self.chunks = chunks
+        self.headers = {'Content-Length': str(length)} if length is not None else {}
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for x in self.chunks:
+            if isinstance(x, Exception):
+                raise x
+            yield x
+
+    def close(self):
+        self.closed = True
+
+
+class FakeHttp(object):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def get(self, url, **kwargs):
+        self.sent.append(self.responses.pop(0))
+        return self.sent[-1]
+
+
+def test_download_closes_response(monkeypatch, tmp_path):
+    path = str(tmp_path / 'v.mp4')
+    http = FakeHttp(FakeResponse([b'ab', IOError('reset')]), FakeResponse([b'ab', b'cd']))
+    monkeypatch.setattr(utility, 'g_http', http)
+    http_download('http://h/v.mp4', path)
+    assert [x.closed for x in http.sent] == [True, True]
+    with open(path, 'rb') as f:
+        assert f.read() == b'abcd'
+
+
+def test_download_errors_close_response(monkeypatch, tmp_path):
+    path = str(tmp_path / 'v.mp4')
+    http = FakeHttp(*[FakeResponse([IOError('reset')]) for _ in range(3)])
+    monkeypatch.setattr(utility, 'g_http', http)
+    with pytest.raises(EvaEx) as e:
+        http_download('http://h/v.mp4', path)
+    assert e.value.msg == Const.DOWNLOAD_ERR and [x.closed for x in http.sent] == [True] * 3
+
+    for response in (FakeResponse([b'x'], length=10), FakeResponse([b'abc', b'def'])):
+        monkeypatch.setattr(utility, 'g_http', FakeHttp(response))
+        with pytest.raises(EvaEx) as e:
+            http_download('http://h/v.mp4', path, max_bytes=5)
+        assert e.value.msg == Const.FILE_TOO_BIG and response.closed
+
+
+def _batcher(monkeypatch, linger, max_urls):
+    sent = []
+
+    def change(urls, req_ids):
+        sent.append((list(urls), req_ids))
+        return [x + '-internal' for x in urls]
+    monkeypatch.setattr(utility, '_change_urls', change)
+    return utility.UrlBatcher(linger, max_urls), sent
+
+
+def _convert_all(batcher, items):
+    results = {}
+
+    def convert(url, req_id):
+        results[req_id] = batcher.convert(url, req_id)
+    threads = [threading.Thread(target=convert, args=x) for x in items]
+    [x.start() for x in threads]
+    [x.join(5) for x in threads]
+    return results
+
+
+def test_url_batch_linger_flush(monkeypatch):
+    batcher, sent = _batcher(monkeypatch, linger=0.2, max_urls=10)
+    start = time.time()
+    results = _convert_all(batcher, [('http://a', 'r1'), ('http://b', 'r2'), ('http://a', 'r3')])
+    # fewer than max_urls: one batch once the first url waited the linger
+    assert time.time() - start >= 0.2
+    assert sent == [(['http://a', 'http://b'], 'r1,r2,r3')]
+    assert results == {'r1': 'http://a-internal', 'r2': 'http://b-internal', 'r3': 'http://a-internal'}
+    assert batcher.batches == 1 and batcher.urls == 2 and batcher.timer is None
+
+
+def test_url_batch_full_sent_at_once(monkeypatch):
+    batcher, sent = _batcher(monkeypatch, linger=10, max_urls=2)
+    start = time.time()
+    results = _convert_all(batcher, [('http://a', 'r1'), ('http://b', 'r2')])
+    assert time.time() - start < 5 and batcher.timer is None
+    assert sent == [(['http://a', 'http://b'], 'r1,r2')] and len(results) == 2
+
+
+def test_host_lru_eviction():
+    client = HttpClient(max_hosts=2)
+    _, a = client.session('http://a/x')
+    _, b = client.session('https://b:8080/y')
+    assert client.session('http://a/z')[1] is a
+    closed = []
+    b.close = lambda: closed.append('b')
+    # b was used least recently
+    host, c = client.session('http://c/')
+    assert host == 'http://c' and closed == ['b']
+    assert list(client.sessions) == ['http://a', 'http://c'] and set(client.stats) == {'http://a', 'http://c'}
+    assert client.session('https://b:8080/y')[1] is not b
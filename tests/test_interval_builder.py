@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# coding: utf-8
+import random
+import pytest
+from backend.slice_helper import interval_gen, interval_stream
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_stream_equals_gen(seed):
+    # random asr results, thresholds and gaps
+    rng = random.Random(seed)
+    for _ in range(2500):
+        time1, time2, time3 = rng.randint(0, 40), rng.randint(0, 40), rng.randint(0, 8)
+        time4 = rng.choice([None, rng.randint(0, 60000)])
+        asr_content = []
+        t = rng.randint(0, 5000)
+        for _ in range(rng.randint(0, 40)):
+            t = max(t + rng.choice([0, rng.randint(-2000, 0), rng.randint(0, 1500), rng.randint(0, 12000)]), 0)
+            length = rng.randint(0, 15000)
+            asr_content.append({'begin_time': t, 'end_time': t + length})
+            t += length
+        expected = interval_gen(asr_content, time1, time2, time3, time4)
+        got = list(interval_stream(iter(asr_content), time1, time2, time3, time4))
+        assert got == expected, (asr_content, time1, time2, time3, time4)
+
+
+@pytest.mark.parametrize('asr_content', [
+    [],
+    [{'begin_time': 0, 'end_time': 0}],
+    [{'begin_time': 0, 'end_time': 31000}],
+    [{'begin_time': 1000, 'end_time': 9000}, {'begin_time': 9000, 'end_time': 25000},
+     {'begin_time': 40000, 'end_time': 41000}],
+])
+def test_edge_cases(asr_content):
+    for args in [(30, 20, 5, None), (12, 8, 4, None), (30, 20, 5, 20000)]:
+        assert list(interval_stream(iter(asr_content), *args)) == interval_gen(asr_content, *args)
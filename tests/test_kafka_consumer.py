@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding: utf-8
+import sys
+import json
+import time
+import types
+import threading
+from collections import namedtuple
+import pytest
+
+from backend import kafka_consumer
+from backend.kafka_consumer import KafkaIngest
+
+TopicPartition = namedtuple('TopicPartition', ['topic', 'partition'])
+Record = namedtuple('Record', ['offset', 'value'])
+
+
+class FakeConsumer(object):
+    """
+    the broker side KafkaIngest sees: records per partition, a position, pause/resume and the committed offsets
+    """
+
+    def __init__(self, values):
+        self.records = dict((tp, [Record(i, json.dumps(x).encode()) for i, x in enumerate(batch)])
+                            for tp, batch in values.items())
+        self.position = dict((tp, 0) for tp in values)
+        self.paused = set()
+        self.committed = {}
+
+    def poll(self, timeout_ms=0, max_records=500):
+        out = {}
+        for tp in sorted(self.records):
+            if tp in self.paused:
+                continue
+            start = self.position[tp]
+            batch = self.records[tp][start:start + max_records - sum(len(x) for x in out.values())]
+            if batch:
+                out[tp] = batch
+                self.position[tp] += len(batch)
+        if not out:
+            time.sleep(timeout_ms / 1000.0)
+        return out
+
+    def commit(self, offsets):
+        for tp, x in offsets.items():
+            assert x.metadata is None
+            self.committed[tp] = x.offset
+
+    def pause(self, *tps):
+        self.paused.update(tps)
+
+    def resume(self, *tps):
+        self.paused.difference_update(tps)
+
+
+@pytest.fixture(params=[2, 3])
+def structs(request, monkeypatch):
+    # kafka.structs.OffsetAndMetadata before and after kafka-python 2.1 added leader_epoch
+    fields = ['offset', 'metadata', 'leader_epoch'][:request.param]
+    module = types.ModuleType('kafka.structs')
+    module.OffsetAndMetadata = namedtuple('OffsetAndMetadata', fields)
+    monkeypatch.setitem(sys.modules, 'kafka', types.ModuleType('kafka'))
+    monkeypatch.setitem(sys.modules, 'kafka.structs', module)
+    return module
+
+
+def _serve(ingest, until, timeout=10):
+    deadline = time.time() + timeout
+    while not until() and time.time() < deadline:
+        ingest.step(poll_ms=10)
+    ingest.executor.shutdown(wait=True)
+    ingest._commit()
+
+
+def test_inflight_limit_and_commit(structs):
+    tp0, tp1 = TopicPartition('t', 0), TopicPartition('t', 1)
+    consumer = FakeConsumer({tp0: [{'i': i} for i in range(12)], tp1: [{'i': i} for i in range(5)]})
+    most = []
+
+    def handler(job):
+        most.append(ingest.info()['inflight'])
+        time.sleep(0.01)
+        return True
+
+    ingest = KafkaIngest(consumer, handler, concurrency=8, partition_inflight=2, max_retry=2)
+    _serve(ingest, lambda: consumer.committed == {tp0: 12, tp1: 5})
+    assert consumer.committed == {tp0: 12, tp1: 5}
+    # two partitions with two running jobs each
+    assert max(most) <= 4
+    assert ingest.info()['done'] == 17 and ingest.info()['backlog'] == 0
+
+
+def test_partition_inflight_bounded(structs):
+    tp = TopicPartition('t', 0)
+    consumer = FakeConsumer({tp: [{'i': i} for i in range(10)]})
+    lock = threading.Lock()
+    state = {'running': 0, 'most': 0}
+
+    def handler(job):
+        with lock:
+            state['running'] += 1
+            state['most'] = max(state['most'], state['running'])
+        time.sleep(0.02)
+        with lock:
+            state['running'] -= 1
+        return True
+
+    ingest = KafkaIngest(consumer, handler, concurrency=8, partition_inflight=3, max_retry=2)
+    _serve(ingest, lambda: consumer.committed.get(tp) == 10)
+    assert consumer.committed[tp] == 10
+    assert state['most'] == 3
+
+
+def test_exhausted_job_dead_lettered_and_committed(structs):
+    tp = TopicPartition('t', 0)
+    consumer = FakeConsumer({tp: [{'i': 0}, {'i': 1, 'bad': True}, {'i': 2}, {'i': 3, 'lost': True}]})
+    calls, dead = [], []
+
+    def handler(job):
+        calls.append(job['i'])
+        if job.get('bad'):
+            raise ValueError('boom')
+        return not job.get('lost')
+
+    ingest = KafkaIngest(consumer, handler, concurrency=2, partition_inflight=4, max_retry=2,
+                         dead_letter=lambda value, reason: dead.append((json.loads(value)['i'], reason)))
+    _serve(ingest, lambda: consumer.committed.get(tp) == 4)
+    assert consumer.committed[tp] == 4
+    assert sorted(dead) == [(1, 'boom'), (3, 'callback not delivered')]
+    # a job that raised runs again, an undelivered callback is not a reason to run the job again
+    assert calls.count(1) == 2 and calls.count(3) == 1
+    info = ingest.info()
+    assert (info['done'], info['failed'], info['dead']) == (2, 2, 2)
+
+
+def test_dead_letter_failure_keeps_offset(structs):
+    tp = TopicPartition('t', 0)
+    consumer = FakeConsumer({tp: [{'i': 0}, {'i': 1}, {'i': 2}]})
+
+    def dead_letter(value, reason):
+        raise IOError('broker down')
+
+    ingest = KafkaIngest(consumer, lambda job: job['i'] != 1, concurrency=2, partition_inflight=4, max_retry=1,
+                         dead_letter=dead_letter)
+    _serve(ingest, lambda: ingest.info()['done'] + ingest.info()['failed'] == 3)
+    assert consumer.committed[tp] == 1
+    assert ingest.info()['uncommitted'] == 2
+
+
+def test_overloaded_deferred_not_committed(structs):
+    tp = TopicPartition('t', 0)
+    consumer = FakeConsumer({tp: [{'i': 0}, {'i': 1}, {'i': 2}]})
+    calls, seen = [], []
+
+    def handler(job):
+        calls.append((job['i'], time.time()))
+        seen.append(consumer.committed.get(tp))
+        if job['i'] == 1 and len([x for x in calls if x[0] == 1]) < 4:
+            raise kafka_consumer.Overloaded(0.05)
+        return True
+
+    ingest = KafkaIngest(consumer, handler, concurrency=1, partition_inflight=1, max_retry=1,
+                         dead_letter=lambda value, reason: pytest.fail('dead-lettered: {}'.format(reason)))
+    _serve(ingest, lambda: consumer.committed.get(tp) == 3)
+    assert consumer.committed[tp] == 3
+    # not counted against max_retry 1, and 2 did not start while 1 waited, nor was 1 committed
+    assert [x[0] for x in calls] == [0, 1, 1, 1, 1, 2]
+    assert all(x in (None, 1) for x in seen[:5])
+    runs = [t for i, t in calls if i == 1]
+    assert all(b - a >= 0.05 for a, b in zip(runs, runs[1:]))
+    info = ingest.info()
+    assert (info['done'], info['failed'], info['dead'], info['deferred'], info['delayed']) == (3, 0, 0, 3, 0)
+
+
+def test_run_pipeline_resends_callback_only(monkeypatch):
+    from backend import pipeline
+    sent = []
+    for name in ('ADMISSION', 'RESULT_CACHE', 'STAGED_PIPELINE'):
+        monkeypatch.setattr(kafka_consumer.Config, name, False)
+    monkeypatch.setattr(kafka_consumer.Config, 'KAFKA_MAX_RETRY', 2)
+    monkeypatch.setattr(pipeline.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(pipeline.Pipeline, 'run', lambda self: sent.append('run') or False)
+    monkeypatch.setattr(pipeline.Pipeline, 'finish', lambda self: sent.append('finish') or True)
+    assert kafka_consumer.run_pipeline({'requestId': 'r1'})
+    assert sent == ['run', 'finish']
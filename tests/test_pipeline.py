@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# coding: utf-8
+import pytest
+
+from backend import pipeline, scratch
+from backend.admission import Overloaded
+from backend.pipeline import Pipeline
+from backend.utility import Const
+
+
+@pytest.fixture
+def sent(monkeypatch, tmp_path):
+    monkeypatch.setattr(scratch, '_scratch', scratch.ScratchManager(root=str(tmp_path), host='h1'))
+    calls = []
+
+    def post(url, data, uid):
+        calls.append(data)
+        return 'ok'
+    monkeypatch.setattr(pipeline, 'try_post_json', post)
+
+    def overloaded(self):
+        self.workspace.open()
+        raise Overloaded(7)
+    monkeypatch.setattr(Pipeline, '_download', overloaded)
+    return calls
+
+
+def _body():
+    return {'requestId': 'r1', 'callback': 'http://cb', 'video_url': 'http://v', 'gender': 1, 'asr_result': []}
+
+
+def test_overloaded_calls_back(sent):
+    p = Pipeline(_body())
+    assert p.run() is True
+    assert [x['msg'] for x in sent] == [Const.OVERLOADED]
+    assert not p.workspace.opened
+
+
+def test_overloaded_raised_for_workers(sent):
+    p = Pipeline(_body(), retry_overloaded=True)
+    with pytest.raises(Overloaded) as e:
+        p.run()
+    assert e.value.retry_after == 7 and sent == []
+    assert not p.workspace.opened and scratch.get_scratch().reserved == 0
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# coding: utf-8
+import threading
+import time
+import numpy as np
+from concurrent.futures import Future
+
+from backend.process_engine import ProcessEngine
+
+
+class FakeEngine(ProcessEngine):
+    # map_extract without worker processes: every chunk finishes on its own thread, the last one first
+    def __init__(self):
+        self.chunks = []
+
+    def extract(self, clip_list):
+        future = Future()
+        self.chunks.append([x['clip_id'] for x in clip_list])
+        delay = 0.2 / len(self.chunks)
+
+        def finish():
+            time.sleep(delay)
+            ids = [x['clip_id'] for x in clip_list]
+            future.set_result((ids, np.array([[float(x)] * 3 for x in ids], dtype=np.float32)))
+        threading.Thread(target=finish).start()
+        return future
+
+
+def test_map_extract_keeps_clip_order():
+    clips = [{'clip_id': str(i), 'pcm': None} for i in range(10)]
+    engine = FakeEngine()
+    ids, matrix = engine.map_extract(clips, chunk=3)
+    assert engine.chunks == [['0', '1', '2'], ['3', '4', '5'], ['6', '7', '8'], ['9']]
+    assert ids == [str(i) for i in range(10)]
+    assert matrix.dtype == np.float32 and matrix.shape == (10, 3)
+    assert matrix[:, 0].tolist() == list(range(10))
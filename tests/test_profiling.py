@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import json
+from multiprocessing.pool import ThreadPool
+
+from backend import profiling
+from backend.metrics import timed, STEP_SECONDS
+from backend.profiling import RequestProfile, should_profile, bind, current
+
+
+def test_should_profile(monkeypatch):
+    monkeypatch.setattr(profiling.Config, 'PROFILE_SAMPLE_PERCENT', 0)
+    assert should_profile({'profile': True}) and not should_profile({})
+    monkeypatch.setattr(profiling.Config, 'PROFILE_SAMPLE_PERCENT', 100)
+    assert should_profile({})
+
+
+def _step(name):
+    with timed(STEP_SECONDS, step=name):
+        return current()
+
+
+def test_request_profile(tmp_path):
+    pool = ThreadPool(2)
+    with RequestProfile('../r1', folder=str(tmp_path)) as profile:
+        assert _step('transcode') is profile
+        # pool threads count for the request only through bind
+        assert pool.apply(bind(_step), ('smile_call',)) is profile
+        assert pool.apply(_step, ('predict',)) is None
+        [bytearray(1024) for _ in range(10)]
+    pool.close()
+    assert current() is None
+    names = sorted(os.listdir(str(tmp_path)))
+    assert len(names) == 2 and names[0].endswith('.json') and names[1].endswith('.prof') and '/' not in names[0]
+    with open(str(tmp_path / names[0])) as f:
+        report = json.load(f)
+    assert report['requestId'] == '../r1' and report['profile'] == str(tmp_path / names[1])
+    assert sorted(report['steps']) == ['smile_call', 'transcode'] and report['steps']['transcode']['calls'] == 1
+    assert report['subprocess_wait_seconds'] == round(sum(x['seconds'] for x in report['steps'].values()), 4)
+    assert report['top_functions'] and report['wall_seconds'] >= 0
+
+
+def test_one_profile_at_a_time(tmp_path):
+    with RequestProfile('r1', folder=str(tmp_path)) as first:
+        with RequestProfile('r2', folder=str(tmp_path)) as second:
+            assert not second.active and current() is first
+    assert sorted(os.listdir(str(tmp_path))) == ['r1.json', 'r1.prof']
+    # the lock is released, the next request is profiled
+    with RequestProfile('r3', folder=str(tmp_path)) as third:
+        assert third.active
+    assert not profiling.tracemalloc.is_tracing()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# coding: utf-8
+import json
+import time
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from backend import redis_worker
+from backend.redis_worker import RedisWorker, enqueue
+from backend.admission import Overloaded
+
+
+def _take(worker):
+    # what serve() does for one job, without its threads
+    worker.slots.acquire()
+    raw = worker.client.brpoplpush(worker.queue, worker.processing, timeout=1)
+    worker.running[raw] = time.time()
+    worker.client.zadd(worker.deadline, {raw: time.time() + worker.visibility})
+    return raw
+
+
+def _worker(handler, **kwargs):
+    return RedisWorker(fakeredis.FakeStrictRedis(), handler, queue='q', concurrency=2, **kwargs)
+
+
+def failing(body):
+    raise ValueError('boom')
+
+
+def test_done():
+    worker = _worker(lambda body: True)
+    enqueue(worker.client, {'requestId': 'r1'}, queue='q')
+    worker._run(_take(worker))
+    assert worker.info() == {'done': 1, 'failed': 0, 'requeued': 0, 'dead': 0, 'deferred': 0, 'running': 0,
+                             'queued': 0, 'processing': 0, 'dead_letter': 0, 'delayed': 0}
+    assert worker.client.zcard(worker.deadline) == 0
+
+
+def test_retry_then_dead_letter():
+    worker = _worker(failing, max_retry=3)
+    enqueue(worker.client, {'requestId': 'r1'}, queue='q')
+    for attempt in range(1, 3):
+        worker._run(_take(worker))
+        assert worker.client.llen('q') == 1 and worker.client.llen('q:processing') == 0
+        assert json.loads(worker.client.lindex('q', 0))['attempts'] == attempt
+    worker._run(_take(worker))
+    assert worker.client.llen('q') == 0 and worker.client.llen('q:processing') == 0
+    job = json.loads(worker.client.lindex('q:dead', 0))
+    assert job['attempts'] == 3 and job['error'] == 'boom' and job['body'] == {'requestId': 'r1'}
+    assert worker.client.zcard(worker.deadline) == 0
+    assert dict((k, worker.stats[k]) for k in ('failed', 'requeued', 'dead')) == {'failed': 3, 'requeued': 2, 'dead': 1}
+
+
+def test_reap_expired_job_once():
+    worker = _worker(failing, visibility=0.01)
+    enqueue(worker.client, {'requestId': 'r1'}, queue='q')
+    raw = _take(worker)
+    # a worker that stopped heartbeating: not in running, deadline passed
+    worker.running.pop(raw)
+    time.sleep(0.05)
+    other = RedisWorker(worker.client, failing, queue='q', visibility=0.01)
+    assert other.reap() == 1
+    assert worker.reap() == 0
+    assert worker.client.llen('q') == 1 and worker.client.llen('q:processing') == 0
+    # the late worker's own failure does not requeue the job a second time
+    worker._run(raw)
+    assert worker.client.llen('q') == 1 and worker.stats['requeued'] == 0
+
+
+def test_undelivered_callback_is_dead_letter():
+    calls = []
+    worker = _worker(lambda body: calls.append(body) or False)
+    enqueue(worker.client, {'requestId': 'r1'}, queue='q')
+    worker._run(_take(worker))
+    # not run again, the handler sent the callback as often as it could
+    assert len(calls) == 1 and worker.client.llen('q') == 0
+    job = json.loads(worker.client.lindex('q:dead', 0))
+    assert job['attempts'] == 1 and job['error'] == 'callback not delivered'
+
+
+def test_overloaded_is_delayed_not_counted():
+    def overloaded(body):
+        raise Overloaded(0.05)
+    worker = _worker(overloaded, max_retry=1)
+    enqueue(worker.client, {'requestId': 'r1'}, queue='q')
+    for _ in range(3):
+        worker._run(_take(worker))
+        assert worker.client.llen('q') == 0 and worker.client.zcard('q:delayed') == 1
+        assert worker.promote() == 0
+        time.sleep(0.06)
+        assert worker.promote() == 1
+        job = json.loads(worker.client.lindex('q', 0))
+        assert job['attempts'] == 0 and worker.client.zcard('q:delayed') == 0
+    assert worker.client.llen('q:dead') == 0
+    assert dict((k, worker.stats[k]) for k in ('failed', 'dead', 'deferred')) == {'failed': 0, 'dead': 0, 'deferred': 3}
+
+
+def test_run_job_resends_only_the_callback(monkeypatch):
+    from backend import pipeline
+    runs, sends = [], []
+
+    class Job(object):
+        uid = 'r1'
+
+        def __init__(self, body, retry_overloaded=False):
+            assert retry_overloaded
+
+        def run(self):
+            runs.append(1)
+            return False
+
+        def finish(self):
+            sends.append(1)
+            return len(sends) == 2
+    monkeypatch.setattr(pipeline, 'Pipeline', Job)
+    monkeypatch.setattr(pipeline.time, 'sleep', lambda seconds: None)
+    for name in ('ADMISSION', 'RESULT_CACHE', 'STAGED_PIPELINE'):
+        monkeypatch.setattr(pipeline.Config, name, False)
+    monkeypatch.setattr(redis_worker.Config, 'REDIS_MAX_RETRY', 3)
+    assert redis_worker.run_pipeline({'requestId': 'r1'}) is True
+    assert len(runs) == 1 and len(sends) == 2
+    sends[:] = [1, 1]
+    assert pipeline.run_job({'requestId': 'r1'}, 2) is False and len(runs) == 2
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding: utf-8
+import threading
+import time
+
+from backend.admission import Overloaded
+from backend.result_cache import ResultCache, normalize_url, fingerprint
+from backend.utility import Const, EvaEx
+
+
+def _body(url, **kwargs):
+    body = {'requestId': 'r1', 'callback': 'http://cb', 'video_url': url, 'gender': 1,
+            'asr_result': [{'begin_time': 0, 'end_time': 1500}]}
+    body.update(kwargs)
+    return body
+
+
+def test_signature_stripped():
+    url = 'HTTP://Bucket.OSS.example.com/a/B.mp4?b=2&OSSAccessKeyId=k&Expires=1&Signature=s%2B&a=1'
+    assert normalize_url(url) == 'http://bucket.oss.example.com/a/B.mp4?a=1&b=2'
+    assert normalize_url('http://h/v.mp4?x-oss-credential=c&x-oss-signature=s&security-token=t') == 'http://h/v.mp4'
+    assert normalize_url('http://cdn/v.mp4?auth_key=1-0-0-abc') == 'http://cdn/v.mp4'
+
+
+def test_fingerprint():
+    fp = fingerprint(_body('http://h/v.mp4?Expires=1&Signature=a'))
+    assert fingerprint(_body('http://h/v.mp4?Expires=2&Signature=b', requestId='r2', callback='http://x')) == fp
+    assert fingerprint(_body('http://h/v.mp4', gender=0)) != fp
+    assert fingerprint(_body('http://h/v.mp4', asr_result=[])) != fp
+
+
+def test_generic_params_kept():
+    # t is a start offset on many media urls, sign a content hash
+    assert fingerprint(_body('http://h/v.mp4?t=10')) != fingerprint(_body('http://h/v.mp4?t=20'))
+    assert fingerprint(_body('http://h/v.mp4?sign=a')) != fingerprint(_body('http://h/v.mp4?sign=b'))
+
+
+class FakePipeline(object):
+    def __init__(self, body):
+        self.input_dict = body
+        self.uid = body['requestId']
+        self.status = Const.SUCCESS
+        self.output_dict = {}
+        self.sent = []
+
+    def fail(self, e):
+        self.status = e.msg if isinstance(e, EvaEx) else Const.INTERNAL_ERR
+
+    def finish(self):
+        self.sent.append((self.status, dict(self.output_dict)))
+        return True
+
+
+def _concurrent(cache, compute, n=4):
+    '''
+    n identical jobs, the first is the leader, compute waits until the others follow it
+    '''
+    pipelines = [FakePipeline(_body('http://h/v.mp4?Signature={}'.format(i), requestId='r{}'.format(i)))
+                 for i in range(n)]
+    errors = []
+
+    def run(p):
+        try:
+            cache.run(p, compute)
+        except Exception as e:
+            errors.append((p.uid, e))
+    leader = threading.Thread(target=run, args=(pipelines[0],))
+    leader.start()
+    while not cache.flights:
+        time.sleep(0.01)
+    followers = [threading.Thread(target=run, args=(p,)) for p in pipelines[1:]]
+    [x.start() for x in followers]
+    while list(cache.flights.values())[0].followers < n - 1:
+        time.sleep(0.01)
+    return pipelines, errors, [leader] + followers
+
+
+def test_single_flight_followers():
+    cache = ResultCache(max_entries=2)
+    release = threading.Event()
+    computed = []
+
+    def compute(p):
+        computed.append(p.uid)
+        release.wait(5)
+        p.output_dict = {'score': 1}
+        return p.finish()
+    pipelines, errors, threads = _concurrent(cache, compute)
+    release.set()
+    [x.join(5) for x in threads]
+    assert computed == ['r0'] and errors == []
+    assert all(p.sent == [(Const.SUCCESS, {'score': 1})] for p in pipelines)
+    # later ones are served from the cache
+    p = FakePipeline(_body('http://h/v.mp4', requestId='r9'))
+    assert cache.run(p, None) is True and p.sent == [(Const.SUCCESS, {'score': 1})]
+    info = cache.info()
+    assert (info['requests'], info['computed'], info['deduplicated'], info['local_hit'], info['running']) == \
+        (5, 1, 3, 1, 0)
+
+
+def test_leader_error_reaches_followers():
+    cache = ResultCache()
+    release = threading.Event()
+
+    def compute(p):
+        release.wait(5)
+        raise Overloaded(3)
+    pipelines, errors, threads = _concurrent(cache, compute, n=3)
+    release.set()
+    [x.join(5) for x in threads]
+    # the leader raises, its followers call back with the error
+    assert [(uid, type(e)) for uid, e in errors] == [('r0', Overloaded)]
+    assert pipelines[0].sent == []
+    assert pipelines[1].sent == pipelines[2].sent == [(Const.OVERLOADED, {})]
+    # nothing was cached, the next one computes again
+    assert cache.info()['entries'] == 0 and cache.flights == {}
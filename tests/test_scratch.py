@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import collections
+import pytest
+
+from backend import scratch
+from backend.admission import Overloaded
+from backend.scratch import ScratchManager, MB
+from backend.utility import EvaEx, Const
+
+Usage = collections.namedtuple('Usage', 'total used free')
+
+
+def _manager(tmp_path, **kwargs):
+    kwargs.setdefault('total_bytes', 10 * MB)
+    kwargs.setdefault('min_free_bytes', 0)
+    return ScratchManager(root=str(tmp_path), host='h1', **kwargs)
+
+
+def test_request_quota(tmp_path):
+    manager = _manager(tmp_path, request_bytes=4 * MB)
+    ws = manager.workspace('r1').open()
+    ws.reserve(3 * MB)
+    with pytest.raises(EvaEx) as e:
+        ws.reserve(2 * MB)
+    assert e.value.msg == Const.FILE_TOO_BIG and not isinstance(e.value, Overloaded)
+    assert ws.reserved == 3 * MB and manager.reserved == 3 * MB
+    ws.close()
+    assert manager.reserved == 0 and not os.path.exists(ws.path)
+
+
+def test_request_quota_defaults_to_total(tmp_path):
+    manager = _manager(tmp_path, request_bytes=0)
+    assert manager.workspace('r1').quota == 10 * MB
+    ws = manager.workspace('r1').open()
+    ws.reserve(9 * MB)
+    with pytest.raises(EvaEx) as e:
+        ws.reserve(2 * MB)
+    assert e.value.msg == Const.FILE_TOO_BIG
+
+
+def test_total_quota_is_overloaded(tmp_path):
+    manager = _manager(tmp_path, request_bytes=8 * MB)
+    first, second = manager.workspace('r1').open(), manager.workspace('r2').open()
+    first.reserve(6 * MB)
+    with pytest.raises(Overloaded):
+        second.reserve(6 * MB)
+    assert second.available() == 4 * MB
+    first.close()
+    second.reserve(6 * MB)
+    assert manager.stats['rejected'] == 1
+
+
+def test_free_space(tmp_path, monkeypatch):
+    manager = _manager(tmp_path, request_bytes=8 * MB, min_free_bytes=2 * MB)
+    monkeypatch.setattr(scratch.shutil, 'disk_usage', lambda path: Usage(100 * MB, 95 * MB, 5 * MB))
+    ws = manager.workspace('r1').open()
+    assert ws.available() == 3 * MB
+    with pytest.raises(Overloaded):
+        ws.reserve(4 * MB)
+    ws.reserve(3 * MB)
+
+
+def test_refresh_accounts_written_bytes(tmp_path):
+    manager = _manager(tmp_path)
+    ws = manager.workspace('r1').open()
+    with open(ws.join('clip.wav'), 'wb') as f:
+        f.write(bytes(MB))
+    ws.reserve(MB // 2)
+    assert ws.refresh() == MB and ws.reserved == MB
+
+
+def test_buffer_pool(tmp_path):
+    manager = _manager(tmp_path, buffers=2, buffer_bytes=4 * MB)
+    ws = manager.workspace('r1')
+    small, large, huge = ws.buffer(MB), ws.buffer(3 * MB), ws.buffer(8 * MB)
+    ws.close()
+    # over buffer_bytes is not kept
+    assert sorted(len(x) for x in manager.free_buffers) == [MB, 3 * MB]
+    ws = manager.workspace('r2')
+    assert ws.buffer(2 * MB) is large
+    assert ws.buffer(MB) is small
+    assert len(ws.buffer(MB)) == MB
+    assert manager.stats['buffer_hits'] == 2 and manager.stats['buffer_misses'] == 4
+    ws.close()
+    # the largest are kept
+    assert sorted(len(x) for x in manager.free_buffers) == [MB, 3 * MB]
+
+
+def test_workspace_name_is_safe(tmp_path):
+    ws = _manager(tmp_path).workspace('../../x')
+    assert os.path.dirname(ws.path) == str(tmp_path)
+    assert os.path.basename(ws.path).startswith('wh1_{}_'.format(os.getpid()))
+
+
+def test_sweep_only_own_dead_workspaces(tmp_path, monkeypatch):
+    manager = _manager(tmp_path)
+    live = manager.workspace('live').open()
+    alive = {101: True, 102: False, 103: None, 104: None}
+    monkeypatch.setattr(scratch, '_pid_alive', lambda pid: alive[pid])
+    for name in ('wh1_101_a', 'wh1_102_b', 'wh1_103_c', 'wh1_104_d', 'wh2_102_e', 'w102_f', 'other'):
+        os.makedirs(str(tmp_path / name))
+    # a pid we may not signal, removed once older than max_age
+    os.utime(str(tmp_path / 'wh1_104_d'), (0, 0))
+    assert manager.sweep(max_age=3600) == 2
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        ['wh1_101_a', 'wh1_103_c', 'wh2_102_e', 'w102_f', 'other', os.path.basename(live.path)])
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import threading
+
+from emotion_model import smile_batch
+
+
+def _flaky(tmp_path, monkeypatch, fails):
+    # SMILExtract that writes nothing for the first `fails` runs of a clip
+    runs = {}
+    lock = threading.Lock()
+
+    def run_batch(wav_list, outfold, config, toolfold, extension):
+        missing = []
+        for wav_path in wav_list:
+            with lock:
+                runs[wav_path] = runs.get(wav_path, 0) + 1
+                ok = runs[wav_path] > fails.get(os.path.basename(wav_path), 0)
+            if ok:
+                open(smile_batch._outfile(wav_path, outfold, extension), 'w').close()
+            else:
+                missing.append(wav_path)
+        return missing
+    monkeypatch.setattr(smile_batch, '_run_batch', run_batch)
+    wav_list = []
+    for name in ('a.wav', 'b.wav', 'c.wav'):
+        wav_list.append(str(tmp_path / name))
+        open(wav_list[-1], 'w').close()
+    return wav_list, runs
+
+
+def test_single_clip_failures_retried(tmp_path, monkeypatch):
+    wav_list, runs = _flaky(tmp_path, monkeypatch, {'b.wav': 3, 'c.wav': 20})
+    failed = smile_batch.opensmiler_batch(wav_list, str(tmp_path / 'out'), batch_size=1, max_retry=10)
+    assert list(failed) == [wav_list[2]] and failed[wav_list[2]] == 'no output from SMILExtract'
+    assert [runs[x] for x in wav_list] == [1, 4, 10]
+
+
+def test_batch_failures_retried_alone(tmp_path, monkeypatch):
+    wav_list, runs = _flaky(tmp_path, monkeypatch, {'a.wav': 1})
+    assert smile_batch.opensmiler_batch(wav_list, str(tmp_path / 'out'), batch_size=3) == {}
+    assert [runs[x] for x in wav_list] == [2, 1, 1]
+
+
+def test_missing_input_not_retried(tmp_path, monkeypatch):
+    wav_list, runs = _flaky(tmp_path, monkeypatch, {'a.wav': 100})
+    os.remove(wav_list[0])
+    failed = smile_batch.opensmiler_batch(wav_list, str(tmp_path / 'out'), batch_size=1)
+    assert failed == {wav_list[0]: 'input not found'} and runs[wav_list[0]] == 1
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import pytest
+from emotion_model import smile_prune
+from emotion_model.smile_prune import _parse_column
+from emotion_model.feature_matrix import COLUMNS
+
+
+def pick(accept):
+    return [x for x in COLUMNS if accept(*_parse_column(x))]
+
+
+CASES = {
+    # one mfcc is written without its [n] by SMILExtract
+    'mfcc3': pick(lambda c, d, e, f: c == 'pcm_fftMag_mfcc_sma' and not d and e == 3),
+    'loudness_amean': pick(lambda c, d, e, f: c == 'pcm_loudness_sma' and not d and f == 'amean'),
+    'jitter_turn': pick(lambda c, d, e, f: c in ('jitterLocal_sma', 'F0final__Turn') and not d
+                        and f in ('amean', 'duration')),
+    'lsp_mel_de': pick(lambda c, d, e, f: c in ('lspFreq_sma', 'logMelFreqBand_sma') and d and f == 'stddev'),
+}
+
+
+@pytest.mark.parametrize('case', sorted(CASES))
+def test_pruned_config_matches_full(case, tmp_path):
+    config = smile_prune.generate(CASES[case], str(tmp_path))
+    assert config.startswith(str(tmp_path))
+    try:
+        from emotion_model.rehearsal_emo import smile_columns
+        smile_columns(smile_prune.FULL_CONFIG)
+    except (OSError, TypeError) as e:
+        pytest.skip('SMILExtract not runnable here: {}'.format(e))
+    assert smile_prune.check(config, CASES[case], seconds=(1.5, 6)) is not None
+
+
+def test_unused_levels_left_out(tmp_path):
+    with open(smile_prune.generate(CASES['loudness_amean'], str(tmp_path))) as f:
+        text = f.read()
+    assert 'reader.dmLevel = intens;pitch\n' in text
+    assert '[mfcc:cMfcc]' not in text and '[lsp:cLsp]' not in text and '[functL1nz:' not in text
+
+
+def test_every_model_served():
+    assert {'round_7', 'beike-male_gbdt-online', 'beike-female_gbdt-online'} <= set(smile_prune.serving_models())
+    assert smile_prune.config_name(smile_prune.used_columns(['round_7'])) == smile_prune.FULL_CONFIG
+
+
+def test_serving_loads_only_checked_configs(monkeypatch, tmp_path):
+    columns = CASES['mfcc3']
+    monkeypatch.setattr(smile_prune.Config, 'SMILE_PRUNE', True)
+    monkeypatch.setattr(smile_prune.Config, 'SMILE_PRUNE_DIR', str(tmp_path))
+    monkeypatch.setattr(smile_prune, 'used_columns', lambda names: columns)
+    monkeypatch.setattr(smile_prune, 'check', None)
+
+    def serving():
+        monkeypatch.setattr(smile_prune, '_serving', None)
+        return smile_prune.serving_config()
+    assert serving() == (smile_prune.FULL_CONFIG, None)
+    config = smile_prune.generate(columns)
+    assert serving() == (smile_prune.FULL_CONFIG, None)
+    smile_prune.record(config, [1, 2, 3])
+    assert serving()[0] == config and list(serving()[1]) == [1, 2, 3]
+    # a regenerated config needs a new check
+    os.remove(config)
+    assert smile_prune.generate(columns) == config
+    assert serving() == (smile_prune.FULL_CONFIG, None)
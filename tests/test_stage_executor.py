@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding: utf-8
+import threading
+import pytest
+
+from backend.stage_executor import Stage, StagedExecutor
+
+
+def _executor(funcs, always=(), on_error=None):
+    return StagedExecutor([Stage(name, func, 2, 4, always=name in always) for name, func in funcs], on_error=on_error)
+
+
+def _recorder(log, name, fail=()):
+    lock = threading.Lock()
+
+    def func(job):
+        with lock:
+            log.setdefault(job, []).append(name)
+        if job in fail:
+            raise ValueError('{} failed {}'.format(name, job))
+        return '{}:{}'.format(name, job)
+    return func
+
+
+def test_stages_in_order():
+    log = {}
+    executor = _executor([(x, _recorder(log, x)) for x in ('download', 'cut', 'ai', 'callback')])
+    futures = dict((job, executor.submit(job)) for job in range(20))
+    assert dict((job, x.result(timeout=5)) for job, x in futures.items()) == \
+        dict((job, 'callback:{}'.format(job)) for job in range(20))
+    assert all(x == ['download', 'cut', 'ai', 'callback'] for x in log.values()) and len(log) == 20
+    info = executor.info()
+    assert [info[x]['done'] for x in ('download', 'cut', 'ai', 'callback')] == [20] * 4
+    assert all(x['failed'] == 0 and x['busy'] == 0 for x in info.values())
+
+
+def test_error_skips_to_always_stage():
+    log, errors = {}, []
+    stages = [(x, _recorder(log, x, fail=(1,) if x == 'cut' else ())) for x in ('download', 'cut', 'ai', 'callback')]
+    executor = _executor(stages, always=('callback',), on_error=lambda job, e: errors.append((job, str(e))))
+    assert executor.submit(1).result(timeout=5) == 'callback:1'
+    assert executor.submit(2).result(timeout=5) == 'callback:2'
+    assert log[1] == ['download', 'cut', 'callback'] and log[2] == ['download', 'cut', 'ai', 'callback']
+    assert errors == [(1, 'cut failed 1')]
+    assert executor.info()['cut']['failed'] == 1 and executor.info()['ai']['done'] == 1
+
+
+def test_future_exception():
+    log = {}
+    # no always stage: the future gets the error of the stage that failed
+    executor = _executor([(x, _recorder(log, x, fail=(1,) if x == 'a' else ())) for x in ('a', 'b')])
+    with pytest.raises(ValueError, match='a failed 1'):
+        executor.submit(1).result(timeout=5)
+    assert log[1] == ['a']
+    # an always stage that raises itself, e.g. the Overloaded of a job to retry, after an earlier error too
+    executor = _executor([(x, _recorder(log, x, fail=(2, 3) if x == 'last' else (3,))) for x in ('first', 'last')],
+                         always=('last',))
+    with pytest.raises(ValueError, match='last failed 2'):
+        executor.submit(2).result(timeout=5)
+    with pytest.raises(ValueError, match='last failed 3'):
+        executor.submit(3).result(timeout=5)